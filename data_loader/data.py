@@ -6,7 +6,7 @@ import math
 from collections import OrderedDict
 
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 
 import sys
 import os
@@ -25,6 +25,11 @@ MODIS_PREFIX = 'MODIS'
 Landsat_PREFIX = 'Landsat'
 Sentinel_PREFIX = 'Sentinel'
 SCALE_FACTOR = 3
+DERIVED_PREFIX = 'derived'
+
+# Grid of each image of a pair relative to the Landsat grid, without and with the derived layers
+PAIR_SCALES = [SCALE_FACTOR, 1, SCALE_FACTOR, SCALE_FACTOR, 1]
+DERIVED_PAIR_SCALES = [SCALE_FACTOR, SCALE_FACTOR, SCALE_FACTOR, SCALE_FACTOR, 1, 1]
 
 
 from pathlib import Path
@@ -68,12 +73,22 @@ def get_pair_path_with_masks(im_dir):
 
     return paths
 
-def load_image_and_mask_pair(im_dir):
+def derived_paths(im_dir):
+    """
+    Paths of the derived layers of a pair (see data_preparation/DerivedInputs.py): Landsat t1 upsampled to
+    the Sentinel grid and MODIS t2 pooled to the Landsat grid, with their masks.
+    """
+    return OrderedDict((name, Path(im_dir) / f'{DERIVED_PREFIX}_{name}.npy')
+                       for name in ('Landsat_t1', 'Landsat_t1_mask', 'MODIS_t2', 'MODIS_t2_mask'))
+
+def load_image_and_mask_pair(im_dir, derived=False):
     """
     Load all image and mask pairs from the specified directory.
 
     Args:
         im_dir (str): Path to the directory containing both image and mask files.
+        derived (bool): Replace Landsat t1 by its upsampled layer and insert the pooled MODIS t2 before
+                        Landsat t2, i.e. [MODIS t1, Landsat t1 (10 m), Sentinel t1, MODIS t2, MODIS t2 (30 m), Landsat t2].
 
     Returns:
         tuple:
@@ -96,8 +111,35 @@ def load_image_and_mask_pair(im_dir):
         mask = np.load(mask_path).astype(np.float32)  # H*W (numpy.ndarray)
         masks.append(mask)
 
+    if derived:
+        paths = derived_paths(im_dir)
+        missing = [str(path) for path in paths.values() if not path.exists()]
+        if missing:
+            raise FileNotFoundError(f"Derived inputs not found: {missing} (see data_preparation/DerivedInputs.py)")
+        layers = {name: np.load(path).astype(np.float32) for name, path in paths.items()}
+        images[1], masks[1] = layers['Landsat_t1'], layers['Landsat_t1_mask']
+        images.insert(4, layers['MODIS_t2'])
+        masks.insert(4, layers['MODIS_t2_mask'])
+
     return images, masks
 
+def load_scenes(image_dir, derived=False):
+    """
+    Decodes every image pair of a PatchSet directory once, so that datasets built on the same data
+    (e.g. at different patch sizes) can share them instead of decoding the files for every sample.
+    With `derived`, the pairs include their derived layers (see load_image_and_mask_pair).
+
+    Returns:
+        list of tuples: (images, masks) per pair, in the order of the pair directories; masks have a channel axis.
+    """
+    scenes = []
+    for im_dir in sorted(p for p in Path(image_dir).glob('*') if p.is_dir()):
+        images, masks = load_image_and_mask_pair(im_dir, derived=derived)
+        masks = [mask[np.newaxis, ...] if len(mask.shape) == 2 else mask for mask in masks]
+        scenes.append((images, masks))
+    return scenes
+
+
 def im2tensor(im):
     im = torch.from_numpy(im)
     return im
@@ -113,10 +155,13 @@ class PatchSet(Dataset):
 
     This is useful for training on high-resolution satellite imagery where loading entire images 
     into memory is inefficient. Patches are extracted with a sliding window strategy.
+    With `scenes` (see load_scenes), patches are cut from the already decoded pairs instead.
+    With `derived`, samples include the precomputed derived layers of each pair (see load_image_and_mask_pair);
+    `scenes` must then be loaded with derived=True as well.
 
     """
 
-    def __init__(self, image_dir, image_size, patch_size, patch_stride=None):
+    def __init__(self, image_dir, image_size, patch_size, patch_stride=None, scenes=None, derived=False):
         super(PatchSet, self).__init__()
         patch_size = make_tuple(patch_size)
         if not patch_stride:
@@ -128,17 +173,27 @@ class PatchSet(Dataset):
         self.image_size = image_size
         self.patch_size = patch_size
         self.patch_stride = patch_stride
+        self.derived = derived
 
         self.image_dirs = [p for p in self.root_dir.glob('*') if p.is_dir()]
+        self.scenes = scenes
+        if scenes is not None:
+            self.image_dirs = sorted(self.image_dirs)  # order of load_scenes
         self.num_im_pairs = len(self.image_dirs)
 
-        self.num_patches_x = math.ceil((image_size[0] - patch_size[0] + 1) / patch_stride[0])
-        self.num_patches_y = math.ceil((image_size[1] - patch_size[1] + 1) / patch_stride[1])
+        self.num_patches_x, self.num_patches_y = self.grid(image_size, patch_size, patch_stride)
         self.num_patches = self.num_im_pairs * self.num_patches_x * self.num_patches_y
 
         self.transform = im2tensor
         self.transform_mask = im2tensor_mask
 
+    @staticmethod
+    def grid(image_size, patch_size, patch_stride):
+        """Number of patches per image pair along each axis."""
+        num_patches_x = math.ceil((image_size[0] - patch_size[0] + 1) / patch_stride[0])
+        num_patches_y = math.ceil((image_size[1] - patch_size[1] + 1) / patch_stride[1])
+        return num_patches_x, num_patches_y
+
     def map_index(self, index):
         id_n = index // (self.num_patches_x * self.num_patches_y)
         residual = index % (self.num_patches_x * self.num_patches_y)
@@ -150,7 +205,10 @@ class PatchSet(Dataset):
     def __getitem__(self, index):
         id_n, id_x, id_y = self.map_index(index)
         
-        images, masks = load_image_and_mask_pair(self.image_dirs[id_n])
+        if self.scenes is not None:
+            images, masks = (list(arrays) for arrays in self.scenes[id_n])
+        else:
+            images, masks = load_image_and_mask_pair(self.image_dirs[id_n], derived=self.derived)
 
         image_patches = [None] * len(images)
         mask_patches = [None] * len(masks)
@@ -163,10 +221,10 @@ class PatchSet(Dataset):
         mask_patches = [None] * len(masks)
         #scales = [1, 1, SCALE_FACTOR]
 
-        scales = [SCALE_FACTOR, 1, SCALE_FACTOR]
+        scales = DERIVED_PAIR_SCALES if self.derived else PAIR_SCALES
 
         for i in range(len(image_patches)):
-            scale = scales[i % 3]
+            scale = scales[i]
 
             # Extract patches for images
             im = images[i][:,
@@ -190,4 +248,110 @@ class PatchSet(Dataset):
 
 
     def __len__(self):
-        return self.num_patches
\ No newline at end of file
+        return self.num_patches
+
+class TileSet(Dataset):
+    """
+    Dataset of large random tiles for training the fully convolutional generator on whole tiles.
+
+    Instead of enumerating every overlapping patch, an epoch is defined by pixel coverage: each image
+    pair contributes enough tiles to cover its Landsat grid `coverage` times on average. Tile positions
+    are drawn at random for every sample, so tile borders fall at different places from one epoch to
+    the next. Decoded pairs are kept in memory (one copy per DataLoader worker), or shared through
+    `scenes` (see load_scenes).
+
+    Samples have the same layout as PatchSet samples (including `derived`), with patch_size replaced by tile_size.
+    """
+
+    def __init__(self, image_dir, image_size, tile_size, coverage=1.0, scenes=None, derived=False):
+        super(TileSet, self).__init__()
+        tile_size = make_tuple(tile_size)
+        if tile_size[0] > image_size[0] or tile_size[1] > image_size[1]:
+            raise ValueError(f'Tile size {tile_size} is larger than the image size {image_size}')
+
+        self.root_dir = image_dir
+        self.image_size = image_size
+        self.tile_size = tile_size
+        self.coverage = coverage
+        self.derived = derived
+
+        self.image_dirs = [p for p in self.root_dir.glob('*') if p.is_dir()]
+        self.num_im_pairs = len(self.image_dirs)
+
+        # Tiles per pair so that the tiles of an epoch cover `coverage` times the Landsat pixels of the pair
+        self.tiles_per_pair = math.ceil(coverage * image_size[0] * image_size[1] / (tile_size[0] * tile_size[1]))
+        self.num_tiles = self.num_im_pairs * self.tiles_per_pair
+
+        self.transform = im2tensor
+        self.transform_mask = im2tensor_mask
+        self.scenes = {}
+        if scenes is not None:
+            self.image_dirs = sorted(self.image_dirs)  # order of load_scenes
+            self.scenes = dict(enumerate(scenes))
+
+    def load(self, id_n):
+        if id_n not in self.scenes:
+            images, masks = load_image_and_mask_pair(self.image_dirs[id_n], derived=self.derived)
+            masks = [mask[np.newaxis, ...] if len(mask.shape) == 2 else mask for mask in masks]
+            self.scenes[id_n] = (images, masks)
+        return self.scenes[id_n]
+
+    def __getitem__(self, index):
+        id_n = index // self.tiles_per_pair
+        images, masks = self.load(id_n)
+
+        id_x = int(torch.randint(0, self.image_size[0] - self.tile_size[0] + 1, ()))
+        id_y = int(torch.randint(0, self.image_size[1] - self.tile_size[1] + 1, ()))
+
+        scales = DERIVED_PAIR_SCALES if self.derived else PAIR_SCALES
+        image_tiles = [None] * len(images)
+        mask_tiles = [None] * len(masks)
+        for i in range(len(images)):
+            scale = scales[i]
+            window = (slice(None),
+                      slice(id_x * scale, (id_x + self.tile_size[0]) * scale),
+                      slice(id_y * scale, (id_y + self.tile_size[1]) * scale))
+            image_tiles[i] = self.transform(np.ascontiguousarray(images[i][window]))
+            mask_tiles[i] = self.transform_mask(np.ascontiguousarray(masks[i][window]))
+
+        return image_tiles, mask_tiles
+
+    def __len__(self):
+        return self.num_tiles
+
+
+class ResumableSampler(Sampler):
+    """
+    Random sampler whose order only depends on a seed and the epoch, so that an interrupted epoch can be
+    continued at the exact next sample.
+
+    Call `set_epoch(epoch, start)` before iterating: the sampler yields the permutation of that epoch
+    from position `start` on (e.g. steps done x batch size). With `num_replicas` > 1, each distributed
+    rank gets a disjoint shard of the permutation (the remainder is dropped, as DistributedSampler does).
+    """
+
+    def __init__(self, data_source, seed=0, num_replicas=1, rank=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(len(self.data_source), generator=generator)
+        order = order[:self.num_samples * self.num_replicas][self.rank::self.num_replicas]
+        return iter(order[self.start:].tolist())
+
+    @property
+    def num_samples(self):
+        return len(self.data_source) // self.num_replicas
+
+    def __len__(self):
+        return max(0, self.num_samples - self.start)
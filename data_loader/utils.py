@@ -1,7 +1,16 @@
 import sys
+import os
 import logging
+import queue
+import shutil
+import threading
 import csv
+import json
 from pathlib import Path
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from timeit import default_timer as timer
+import numpy as np
 import rasterio
 
 import torch
@@ -32,6 +41,168 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
+class DeviceAverageMeter(object):
+    """
+    Computes and stores the average of tensor values on their device.
+
+    Updates never synchronize the host with the device. The average is read either at the end of the
+    epoch (`avg`, reduced across distributed ranks) or, for progress display, through `lagged`, which
+    returns the average at the previous snapshot and only waits for that older copy to land on the host.
+    """
+
+    def __init__(self):
+        self.sum = None
+        self.count = 0
+        self.pending = None  # (host tensor, count, event) of the last snapshot
+
+    def update(self, val, n=1):
+        if not torch.is_tensor(val):
+            val = torch.tensor(float(val))
+        val = val.detach()
+        if self.sum is None:
+            self.sum = torch.zeros((), dtype=torch.float32, device=val.device)
+        self.sum.add_(val.to(self.sum.dtype), alpha=n)
+        self.count += n
+
+    def lagged(self):
+        value = None
+        if self.pending is not None:
+            host, count, event = self.pending
+            if event is not None:
+                event.synchronize()
+            value = host.item() / count
+
+        if self.sum is not None:
+            is_cuda = self.sum.device.type == 'cuda'
+            host = torch.empty((), dtype=self.sum.dtype, pin_memory=is_cuda)
+            host.copy_(self.sum, non_blocking=is_cuda)
+            event = None
+            if is_cuda:
+                event = torch.cuda.Event()
+                event.record()
+            self.pending = (host, self.count, event)
+        return value
+
+    def state_dict(self):
+        return {'sum': self.sum, 'count': self.count}
+
+    def load_state_dict(self, state, device=None):
+        self.sum = state['sum'] if state['sum'] is None else state['sum'].to(device)
+        self.count = state['count']
+        self.pending = None
+
+    @property
+    def avg(self):
+        if self.sum is None:
+            return 0.0
+        total = torch.stack((self.sum, torch.tensor(float(self.count), device=self.sum.device)))
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.all_reduce(total)
+        total = total.tolist()
+        return total[0] / total[1]
+
+
+class StageTimer(object):
+    """
+    Low-overhead per-stage timer for training and testing loops.
+
+    Device stages are timed with CUDA events that are only resolved by `summary`, so timing does not
+    synchronize the host inside the loop (on CPU, wall time is used). Host-side durations such as the
+    time spent waiting for the data loader are added with `record`. Switch it on and off at runtime
+    with the `enabled` attribute; when disabled every call is a no-op.
+
+    Usage:
+        timer.start_step()
+        with timer.stage('g_forward'):
+            ...
+        timer.end_step(batch_size)
+    """
+
+    def __init__(self, device, enabled=False):
+        self.device = device
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.steps = []
+        self.current = None
+        self.samples = 0
+        self.t_start = None
+        self.t_end = None
+
+    def start_step(self):
+        if not self.enabled:
+            return
+        if self.t_start is None:
+            self.t_start = timer()
+        self.current = OrderedDict()
+
+    def end_step(self, n_samples=1):
+        if not self.enabled or self.current is None:
+            return
+        self.steps.append(self.current)
+        self.current = None
+        self.samples += n_samples
+        self.t_end = timer()
+
+    def record(self, name, seconds):
+        if self.enabled and self.current is not None:
+            self.current.setdefault(name, []).append(seconds)
+
+    def stage(self, name, host=False):
+        """Context timing a stage of the current step; `host` stages (e.g. stitching) use wall time on every device."""
+        if not self.enabled or self.current is None:
+            return nullcontext()
+        return self._stage(name, host)
+
+    @contextmanager
+    def _stage(self, name, host):
+        if self.device.type == 'cuda' and not host:
+            start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            start.record()
+            yield
+            end.record()
+            self.current.setdefault(name, []).append((start, end))
+        else:
+            t_start = timer()
+            yield
+            self.current.setdefault(name, []).append(timer() - t_start)
+
+    def summary(self):
+        """
+        Returns:
+            dict: Mean, total and 50/90/99th percentiles (seconds per step) of every stage, and samples/sec.
+        """
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        durations = OrderedDict()
+        for step in self.steps:
+            for name, values in step.items():
+                total = sum(v if isinstance(v, float) else v[0].elapsed_time(v[1]) / 1e3 for v in values)
+                durations.setdefault(name, []).append(total)
+
+        stages = OrderedDict()
+        for name, values in durations.items():
+            values = np.asarray(values)
+            stages[name] = {'mean': float(values.mean()), 'total': float(values.sum()),
+                            'p50': float(np.percentile(values, 50)), 'p90': float(np.percentile(values, 90)),
+                            'p99': float(np.percentile(values, 99))}
+        elapsed = (self.t_end - self.t_start) if self.steps else 0.0
+        return {'steps': len(self.steps), 'samples': self.samples, 'elapsed': elapsed,
+                'samples_per_sec': self.samples / elapsed if elapsed > 0 else 0.0, 'stages': stages}
+
+    def export(self, filepath, **fields):
+        """Appends the summary (plus extra fields such as the epoch) as one JSON line, then resets the timer."""
+        if not self.enabled or not self.steps:
+            self.reset()
+            return None
+        summary = dict(fields, **self.summary())
+        with open(filepath, 'a') as file:
+            file.write(json.dumps(summary) + '\n')
+        self.reset()
+        return summary
+
+
 def get_logger(logpath=None):
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
@@ -48,26 +219,175 @@ def get_logger(logpath=None):
     return logger
 
 
-def save_checkpoint(model, optimizer, path):
-    if path.exists():
-        path.unlink()
-    model = model.module if isinstance(model, nn.DataParallel) else model
+def unwrap_model(model):
+    """Returns the module wrapped by nn.DataParallel or DistributedDataParallel."""
+    if isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        return model.module
+    return model
+
+
+def to_host(obj):
+    """
+    Copies the tensors of a (nested) state dict to host memory, so that it can be serialized while training
+    continues. Device tensors are copied asynchronously and synchronized once.
+    """
+    on_device = []
+
+    def copy(value):
+        if torch.is_tensor(value):
+            if value.is_cuda:
+                on_device.append(value.device)
+                return value.detach().to('cpu', non_blocking=True)
+            return value.detach().clone()
+        if isinstance(value, dict):
+            return type(value)((k, copy(v)) for k, v in value.items())
+        if isinstance(value, (list, tuple)):
+            return type(value)(copy(v) for v in value)
+        return value
+
+    obj = copy(obj)
+    for device in set(on_device):
+        torch.cuda.synchronize(device)
+    return obj
+
+
+def checkpoint_state(model, optimizer=None):
+    model = unwrap_model(model)
     state = {'state_dict': model.state_dict()}
     if optimizer:
         state = {'state_dict': model.state_dict(),
                  'optim_dict': optimizer.state_dict()}
-    if isinstance(path, Path):
-        torch.save(state, str(path.resolve()))
-    else:
-        torch.save(state, str(path.resolve()))
+    if hasattr(model, 'channels'):
+        state['channels'] = tuple(model.channels)  # widths of the generator, e.g. after pruning
+    return state
+
+
+def atomic_save(state, path):
+    """Serializes `state` to a temporary file next to `path` and renames it, so `path` is never left half written."""
+    path = Path(path).resolve()
+    tmp = path.with_name(f'.{path.name}.tmp')
+    torch.save(state, str(tmp))
+    os.replace(str(tmp), str(path))
+
+
+def link_file(source, target):
+    """Atomically makes `target` a hard link to `source`, or a copy where hard links are not supported."""
+    source, target = Path(source).resolve(), Path(target).resolve()
+    tmp = target.with_name(f'.{target.name}.tmp')
+    if tmp.exists():
+        tmp.unlink()
+    try:
+        os.link(str(source), str(tmp))
+    except OSError:
+        shutil.copyfile(str(source), str(tmp))
+    os.replace(str(tmp), str(target))
+
+
+def save_checkpoint(model, optimizer, path):
+    atomic_save(checkpoint_state(model, optimizer), path)
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints on a background thread.
+
+    `save` snapshots the model and optimizer state to host memory and returns; serialization, the atomic
+    rename and the cleanup of old checkpoints run on the worker thread, in submission order. With
+    `keep_last` > 0, every save is also kept as `<name>_epoch<N>.pth` (a hard link to the same file) and
+    only the `keep_last` most recent of them are retained. Errors of the worker are raised by the next call.
+
+    Usage:
+        writer = CheckpointWriter(keep_last=3)
+        writer.save(model, optimizer, path, epoch=n)
+        writer.link(path, best)  # best checkpoint without copying the file
+        writer.wait()
+    """
+
+    def __init__(self, keep_last=0):
+        self.keep_last = keep_last
+        self.queue = queue.Queue()
+        self.error = None
+        self.worker = threading.Thread(target=self.run, name='CheckpointWriter', daemon=True)
+        self.worker.start()
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                if self.error is None:
+                    job()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Writing a checkpoint failed') from error
+
+    def save(self, model, optimizer, path, epoch=None):
+        self.check()
+        state = to_host(checkpoint_state(model, optimizer))
+        path = Path(path)
+
+        def job():
+            atomic_save(state, path)
+            if self.keep_last > 0 and epoch is not None:
+                link_file(path, path.with_name(f'{path.stem}_epoch{epoch}{path.suffix}'))
+                self.prune(path)
+
+        self.queue.put(job)
+
+    def save_state(self, state, path):
+        """Writes an arbitrary (nested) state dict, snapshotted to host memory first."""
+        self.check()
+        state = to_host(state)
+        self.queue.put(lambda: atomic_save(state, path))
+
+    def link(self, source, target):
+        """Points `target` to the last checkpoint written to `source` (after the pending writes)."""
+        self.check()
+        self.queue.put(lambda: link_file(source, target))
+
+    def prune(self, path):
+        def epoch_of(p):
+            return int(p.stem.rsplit('_epoch', 1)[1])
+
+        kept = sorted(path.parent.glob(f'{path.stem}_epoch*{path.suffix}'), key=epoch_of)
+        for old in kept[:-self.keep_last]:
+            old.unlink()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until every submitted checkpoint is on disk, or for at most `timeout` seconds.
+
+        Returns:
+            bool: False if the timeout expired first.
+        """
+        deadline = None if timeout is None else timer() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - timer()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        self.check()
+        return True
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.worker.join()
 
 
 def load_checkpoint(checkpoint, model, optimizer=None, map_location=None):
     if not checkpoint.exists():
         raise FileNotFoundError(f"File doesn't exist {checkpoint}")
     state = torch.load(checkpoint, map_location=map_location)
-    if isinstance(model, nn.DataParallel):
-        model = model.module
+    model = unwrap_model(model)
     model.load_state_dict(state['state_dict'])
 
     if optimizer:
@@ -0,0 +1,79 @@
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+import sys
+import os
+sys.path.append(os.path.abspath('..'))  # go up to root directory
+
+from data_loader.data import load_image_and_mask_pair, derived_paths, SCALE_FACTOR
+
+
+class DerivedInputs:
+    """
+    Precomputes the layers that the training step derives from every (t1, t2) pair, once per pair:
+
+    - Landsat t1 (LST and indices) upsampled to the Sentinel grid, as done by CombinFeatureGenerator.
+    - MODIS t2 average-pooled to the Landsat grid, the reference of the discriminator and of the MODIS loss.
+
+    They are written as .npy files (with their masks) next to the pair images, and loaded by
+    PatchSet / load_scenes with `derived=True`.
+    """
+
+    def upsample_landsat(self, landsat, size):
+        """Bicubic upsampling of a (C, H, W) Landsat image to `size`, as in the generator."""
+        tensor = torch.from_numpy(landsat).unsqueeze(0)
+        upsampled = F.interpolate(tensor, size=size, mode='bicubic', align_corners=False)
+        return upsampled.squeeze(0).numpy()
+
+    def pool_modis(self, modis):
+        """Average pooling of a (C, H, W) MODIS image to the Landsat grid."""
+        tensor = torch.from_numpy(modis).unsqueeze(0)
+        pooled = F.avg_pool2d(tensor, kernel_size=SCALE_FACTOR, stride=SCALE_FACTOR)
+        return pooled.squeeze(0).numpy()
+
+    def prepare_pair(self, im_dir, overwrite=False):
+        """
+        Writes the derived layers of one pair directory.
+
+        Returns:
+            bool: True if the layers were (re)computed, False if they already existed.
+        """
+        paths = derived_paths(im_dir)
+        if not overwrite and all(path.exists() for path in paths.values()):
+            return False
+
+        images, masks = load_image_and_mask_pair(im_dir)
+        modis_t1, landsat_t1, sentinel_t1, modis_t2 = images[:4]
+        landsat_mask, modis_t2_mask = (mask if len(mask.shape) == 2 else mask[0] for mask in (masks[1], masks[3]))
+
+        landsat_up = self.upsample_landsat(landsat_t1, sentinel_t1.shape[-2:])
+        # Nearest-neighbour upsampling of the mask: a 10 m pixel is valid where its Landsat pixel is
+        landsat_up_mask = np.kron(landsat_mask, np.ones((SCALE_FACTOR, SCALE_FACTOR), dtype=np.float32))
+
+        modis_pooled = self.pool_modis(modis_t2)
+        # A pooled pixel is valid only if all the MODIS pixels it averages are
+        height, width = modis_pooled.shape[-2:]
+        modis_pooled_mask = modis_t2_mask[:height * SCALE_FACTOR, :width * SCALE_FACTOR].reshape(
+            height, SCALE_FACTOR, width, SCALE_FACTOR).min(axis=(1, 3))
+
+        np.save(paths['Landsat_t1'], landsat_up.astype(np.float32))
+        np.save(paths['Landsat_t1_mask'], landsat_up_mask.astype(np.float32))
+        np.save(paths['MODIS_t2'], modis_pooled.astype(np.float32))
+        np.save(paths['MODIS_t2_mask'], modis_pooled_mask.astype(np.float32))
+        return True
+
+    def prepare(self, image_dir, overwrite=False):
+        """
+        Writes the derived layers of every pair directory in `image_dir` (e.g. data/train).
+        Pairs that already have them are skipped unless `overwrite` is set.
+        """
+        im_dirs = sorted(p for p in Path(image_dir).glob('*') if p.is_dir())
+        count = 0
+        for im_dir in im_dirs:
+            if self.prepare_pair(im_dir, overwrite=overwrite):
+                count += 1
+                print(f"Derived inputs written for {im_dir.name}")
+        print(f"{count} of {len(im_dirs)} pairs prepared")
@@ -1,15 +1,34 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable
+from torch.utils.checkpoint import checkpoint
 import numpy as np
 import numpy as np
+import math
+from collections import OrderedDict
 
 
 NUM_BANDS = 1
 SCALE_FACTOR = 16
+CHANNELS = (16, 32, 64, 128, 256)  # Default channel widths of the encoder levels
+# Encoder streams of CombinFeatureGenerator and the FeatureExtract network computing each of them
+STREAMS = OrderedDict([('MODIS_t1', 'MODIS_SNet'), ('Landsat_LST', 'Landsat_SNet'), ('Landsat_indices', 'indices_SNet'),
+                       ('Sentinel', 'indices_SNet'), ('MODIS_t2', 'MODIS_SNet')])
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-            
+
+
+def run_stage(stage, x, ifCheckpoint=False):
+    """
+    Runs a network stage, optionally with activation checkpointing.
+
+    With checkpointing the stage's intermediate activations are not kept for the
+    backward pass; they are recomputed from the stage input during backward.
+    """
+    if ifCheckpoint and torch.is_grad_enabled():
+        return checkpoint(stage, x, use_reentrant=False)
+    return stage(x)
+
+
 class ConvBlock(torch.nn.Module):
     def __init__(self, input_size, output_size, kernel_size, stride, padding, bias=True):
         super(ConvBlock, self).__init__()
@@ -63,60 +82,41 @@ class ResBlock(nn.Module):
 
 
 class FeatureExtract(torch.nn.Module):
-    def __init__(self, in_channels=NUM_BANDS):  # Constructor with default input channels (NUM_BANDS)
+    def __init__(self, in_channels=NUM_BANDS, channels=CHANNELS, ifCheckpoint=False):  # Constructor with default input channels (NUM_BANDS)
         super(FeatureExtract, self).__init__()
-        channels = (16, 32, 64, 128, 256)  # Defining a tuple for the number of channels at each layer
-        
-        # First convolutional block (conv1)
+        self.ifCheckpoint = ifCheckpoint  # Recompute each stage's activations during backward
+        self.depth = len(channels)  # Number of levels (one per entry of channels)
+
+        # First convolutional block (conv1): 7x7 kernel, stride 1, padding 3, followed by a ResBlock
         self.conv1 = nn.Sequential(
-            nn.Conv2d(in_channels, channels[0], 7, 1, 3),  # 7x7 kernel, stride 1, padding 3
-            ResBlock(channels[0]),  # Apply ResBlock after convolution (with 16 output channels)
-        )
-        
-        # Second convolutional block (conv2)
-        self.conv2 = nn.Sequential(
-            nn.Conv2d(channels[0], channels[1], 3, 2, 1),  # 3x3 kernel, stride 2, padding 1
-            ResBlock(channels[1]),  # Apply ResBlock after convolution (with 32 output channels)
-        )
-        
-        # Third convolutional block (conv3)
-        self.conv3 = nn.Sequential(
-            nn.Conv2d(channels[1], channels[2], 3, 2, 1),  # 3x3 kernel, stride 2, padding 1
-            ResBlock(channels[2]),  # Apply ResBlock after convolution (with 64 output channels)
-        )
-        
-        # Fourth convolutional block (conv4)
-        self.conv4 = nn.Sequential(
-            nn.Conv2d(channels[2], channels[3], 3, 2, 1),  # 3x3 kernel, stride 2, padding 1
-            ResBlock(channels[3]),  # Apply ResBlock after convolution (with 128 output channels)
-        )
-        
-        # Fifth convolutional block (conv5)
-        self.conv5 = nn.Sequential(
-            nn.Conv2d(channels[3], channels[4], 3, 2, 1),  # 3x3 kernel, stride 2, padding 1
-            ResBlock(channels[4]),  # Apply ResBlock after convolution (with 256 output channels)
+            nn.Conv2d(in_channels, channels[0], 7, 1, 3),
+            ResBlock(channels[0]),
         )
 
+        # Following blocks (conv2, conv3, ...): 3x3 kernel, stride 2, padding 1, each halving the resolution
+        for n in range(1, self.depth):
+            setattr(self, 'conv' + str(n + 1), nn.Sequential(
+                nn.Conv2d(channels[n - 1], channels[n], 3, 2, 1),
+                ResBlock(channels[n]),
+            ))
+
     def forward(self, inputs):  # Define the forward pass of the model
-        # Pass input through each convolutional block
-        l1 = self.conv1(inputs)  # First layer output
-        l2 = self.conv2(l1)  # Second layer output
-        l3 = self.conv3(l2)  # Third layer output
-        l4 = self.conv4(l3)  # Fourth layer output
-        l5 = self.conv5(l4)  # Fifth layer output
-        
-        # Return the outputs from all layers as a list
-        return [l1, l2, l3, l4, l5]
+        # Pass input through each convolutional block and return the outputs from all levels as a list
+        features = [run_stage(self.conv1, inputs, self.ifCheckpoint)]
+        for n in range(1, self.depth):
+            features.append(run_stage(getattr(self, 'conv' + str(n + 1)), features[-1], self.ifCheckpoint))
+        return features
 
 
 class SignificanceExtraction(nn.Module):
-    def __init__(self, in_channels, ifattention=True, iftwoinput=False, outputM=False):
+    def __init__(self, in_channels, ifattention=True, iftwoinput=False, outputM=False, ifFused=False):
         super(SignificanceExtraction, self).__init__()
 
         # Flags to determine whether to use attention, two inputs, and whether to output M1
         self.attention = ifattention  
         self.twoinput = iftwoinput  
         self.outputM = outputM  
+        self.fused = ifFused  # Blend with a single torch.lerp instead of two products and a sum
 
         if self.attention:  # If attention mechanism is enabled
             # First 1x1 convolution layer with batch normalization
@@ -152,25 +152,40 @@ class SignificanceExtraction(nn.Module):
             M1 = self.conv(x)  # Generate attention mask
 
             # Weighted sum: Enhances important features while suppressing others
-            result = inputs[0] * M1 + inputs[2] * (1 - M1)
+            if self.fused:
+                result = fused_blend(inputs[0], inputs[2], M1)
+            else:
+                result = inputs[0] * M1 + inputs[2] * (1 - M1)
         else:
             # If no attention, take an equal-weighted average
-            result = 0.5 * inputs[0] + 0.5 * inputs[2]
+            if self.fused:
+                result = fused_blend(inputs[0], inputs[2], 0.5)
+            else:
+                result = 0.5 * inputs[0] + 0.5 * inputs[2]
 
         # Return the result and optionally the attention mask
         return (result, M1) if self.outputM else result
 
 
+def upcast_half(x):
+    """Casts float16/bfloat16 tensors to float32, other dtypes (e.g. float64) are left as they are."""
+    return x.float() if x.dtype in (torch.float16, torch.bfloat16) else x
+
+
 def calc_mean_std(feat, eps=1e-5):
     size = feat.size()
     assert (len(size) == 4)  # Ensure input has 4 dimensions (N, C, H, W)
     N, C = size[:2]  # Extract batch size (N) and channels (C)
-    
-    # Compute variance across spatial dimensions (H, W), adding small epsilon for numerical stability
-    feat_var = feat.view(N, C, -1).var(dim=2) + eps  
-    feat_std = feat_var.sqrt().view(N, C, 1, 1)  # Compute standard deviation and reshape for broadcasting
-    feat_mean = feat.view(N, C, -1).mean(dim=2).view(N, C, 1, 1)  # Compute mean and reshape for broadcasting
-    
+
+    # Statistics are computed in at least float32, even under mixed-precision autocast
+    with torch.autocast(device_type=feat.device.type, enabled=False):
+        feat = upcast_half(feat)
+
+        # Compute variance across spatial dimensions (H, W), adding small epsilon for numerical stability
+        feat_var = feat.reshape(N, C, -1).var(dim=2) + eps
+        feat_std = feat_var.sqrt().view(N, C, 1, 1)  # Compute standard deviation and reshape for broadcasting
+        feat_mean = feat.reshape(N, C, -1).mean(dim=2).view(N, C, 1, 1)  # Compute mean and reshape for broadcasting
+
     return feat_mean, feat_std  # Return mean and std per channel
 
 
@@ -182,22 +197,103 @@ def adaptive_instance_normalization(content_feat, style_feat):
     style_mean, style_std = calc_mean_std(style_feat)
     content_mean, content_std = calc_mean_std(content_feat)
 
-    # Normalize content features and re-scale using style statistics
-    normalized_feat = (content_feat - content_mean.expand(size)) / content_std.expand(size)
-    return normalized_feat * style_std.expand(size) + style_mean.expand(size)  # Apply style statistics
+    # Normalize content features and re-scale using style statistics (in at least float32)
+    with torch.autocast(device_type=content_feat.device.type, enabled=False):
+        normalized_feat = (upcast_half(content_feat) - content_mean.expand(size)) / content_std.expand(size)
+        stylized = normalized_feat * style_std.expand(size) + style_mean.expand(size)  # Apply style statistics
+    return stylized.to(content_feat.dtype)
+
+
+
+def fused_blend(feat1, feat2, weight):
+    """
+    Computes feat1 * weight + feat2 * (1 - weight) in a single torch.lerp kernel.
+    """
+    dtype = feat1.dtype
+    if torch.is_tensor(weight):
+        weight = weight.to(dtype)
+    return torch.lerp(feat2.to(dtype), feat1, weight)
+
+
+def fused_calc_mean_std(feat, eps=1e-5):
+    """
+    Same as calc_mean_std, with the mean and variance computed in one pass by torch.var_mean.
+    """
+    N, C = feat.size()[:2]
+    with torch.autocast(device_type=feat.device.type, enabled=False):
+        feat_var, feat_mean = torch.var_mean(upcast_half(feat).reshape(N, C, -1), dim=2)
+        feat_std = (feat_var + eps).sqrt().view(N, C, 1, 1)
+    return feat_mean.view(N, C, 1, 1), feat_std
+
+
+def fused_adaptive_instance_normalization(content_feat, style_feat):
+    """
+    Same as adaptive_instance_normalization. The normalization and re-styling are folded into a
+    per-channel scale and shift, so the full-size tensor is touched by a single torch.addcmul.
+    """
+    assert (content_feat.size()[:2] == style_feat.size()[:2])  # Ensure same batch size and channels
+
+    style_mean, style_std = fused_calc_mean_std(style_feat)
+    content_mean, content_std = fused_calc_mean_std(content_feat)
+
+    with torch.autocast(device_type=content_feat.device.type, enabled=False):
+        scale = style_std / content_std  # (N, C, 1, 1)
+        shift = style_mean - content_mean * scale  # (N, C, 1, 1)
+        stylized = torch.addcmul(shift, upcast_half(content_feat), scale)
+    return stylized.to(content_feat.dtype)
+
+
+class FusedCosineRefine(torch.autograd.Function):
+    """
+    Cosine similarity refinement, feat * cos(a, b) along the channel dimension, with a hand-written backward.
 
+    Unlike the F.normalize based implementation, it does not store the two normalized copies of the
+    features for the backward pass, only the per-pixel similarity and norms.
+    """
+
+    @staticmethod
+    def forward(ctx, feat, a, b, eps=1e-12):
+        norm_a = torch.linalg.vector_norm(a, dim=1, keepdim=True).clamp_min(eps)  # (B, 1, H, W)
+        norm_b = torch.linalg.vector_norm(b, dim=1, keepdim=True).clamp_min(eps)
+        similarity = (a * b).sum(dim=1, keepdim=True) / (norm_a * norm_b)
+        ctx.eps = eps
+        ctx.save_for_backward(feat, a, b, similarity, norm_a, norm_b)
+        return feat * similarity.to(feat.dtype)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        feat, a, b, similarity, norm_a, norm_b = ctx.saved_tensors
+        grad_feat = grad_a = grad_b = None
+
+        if ctx.needs_input_grad[0]:
+            grad_feat = grad_output * similarity.to(grad_output.dtype)
+
+        if ctx.needs_input_grad[1] or ctx.needs_input_grad[2]:
+            grad_similarity = (grad_output.to(a.dtype) * feat.to(a.dtype)).sum(dim=1, keepdim=True)
+            common = grad_similarity / (norm_a * norm_b)
+            # d sim / d a = b / (|a| |b|) - sim * a / |a|^2, the second term vanishes where the norm is clamped
+            if ctx.needs_input_grad[1]:
+                coef = grad_similarity * similarity / norm_a ** 2 * (norm_a > ctx.eps)
+                grad_a = torch.addcmul(common * b, coef, a, value=-1)
+            if ctx.needs_input_grad[2]:
+                coef = grad_similarity * similarity / norm_b ** 2 * (norm_b > ctx.eps)
+                grad_b = torch.addcmul(common * a, coef, b, value=-1)
+
+        return grad_feat, grad_a, grad_b, None
 
 
 class SimilarityFeatureRefiner(nn.Module):
-    def __init__(self, method='cosine'):
+    def __init__(self, method='cosine', ifFused=False):
         """
         Refines Landsat LST features using similarity with Sentinel index features.
         Args:
             method (str): 'cosine' or 'corr' similarity.
+            ifFused (bool): Use FusedCosineRefine for the 'cosine' method.
         """
         super(SimilarityFeatureRefiner, self).__init__()
         assert method in ['cosine', 'corr']
         self.method = method
+        self.fused = ifFused
 
     def forward(self, HS_feat, HS_indices_feat, SS_feat):
         """
@@ -209,99 +305,138 @@ class SimilarityFeatureRefiner(nn.Module):
         Returns:
             refined_HS_feat: (B, C, H, W) - Refined Landsat LST features.
         """
-        if self.method == 'cosine':
-            norm_HS = F.normalize(HS_indices_feat, p=2, dim=1)
-            norm_SS = F.normalize(SS_feat, p=2, dim=1)
-            similarity = (norm_HS * norm_SS).sum(dim=1, keepdim=True)  # (B, 1, H, W)
+        # The similarity normalization is computed in at least float32, even under mixed-precision autocast
+        with torch.autocast(device_type=HS_feat.device.type, enabled=False):
+            HS_indices_feat = upcast_half(HS_indices_feat)
+            SS_feat = upcast_half(SS_feat)
 
-        elif self.method == 'corr':
-            HS_centered = HS_indices_feat - HS_indices_feat.mean(dim=1, keepdim=True)
-            SS_centered = SS_feat - SS_feat.mean(dim=1, keepdim=True)
+            if self.method == 'cosine' and self.fused:
+                return FusedCosineRefine.apply(HS_feat, HS_indices_feat, SS_feat)
 
-            numerator = (HS_centered * SS_centered).sum(dim=1, keepdim=True)
-            denominator = torch.sqrt((HS_centered**2).sum(dim=1, keepdim=True) * (SS_centered**2).sum(dim=1, keepdim=True) + 1e-6)
-            similarity = numerator / denominator
+            if self.method == 'cosine':
+                norm_HS = F.normalize(HS_indices_feat, p=2, dim=1)
+                norm_SS = F.normalize(SS_feat, p=2, dim=1)
+                similarity = (norm_HS * norm_SS).sum(dim=1, keepdim=True)  # (B, 1, H, W)
+
+            elif self.method == 'corr':
+                HS_centered = HS_indices_feat - HS_indices_feat.mean(dim=1, keepdim=True)
+                SS_centered = SS_feat - SS_feat.mean(dim=1, keepdim=True)
+
+                numerator = (HS_centered * SS_centered).sum(dim=1, keepdim=True)
+                denominator = torch.sqrt((HS_centered**2).sum(dim=1, keepdim=True) * (SS_centered**2).sum(dim=1, keepdim=True) + 1e-6)
+                similarity = numerator / denominator
 
         #similarity = similarity.clamp(min=0.0, max=1.0)
 
         # Refine Landsat LST features
-        refined = HS_feat * similarity
+        refined = HS_feat * similarity.to(HS_feat.dtype)
         return refined
 
 
 class CombinFeatureGenerator(nn.Module):
-    def __init__(self, NUM_BANDS=NUM_BANDS, ifAdaIN=True, ifAttention=True, ifTwoInput=False, outputM=False):
+    def __init__(self, NUM_BANDS=NUM_BANDS, ifAdaIN=True, ifAttention=True, ifTwoInput=False, outputM=False,
+                 ifCheckpoint=False, channels=CHANNELS, ifFused=False):
         super(CombinFeatureGenerator, self).__init__()
+        assert len(channels) >= 2  # At least one downsampling level is needed by the decoder
 
         # Initialize module parameters
         self.ifAdaIN = ifAdaIN  # Use Adaptive Instance Normalization
         self.ifAttention = ifAttention  # Use Attention Mechanism
         self.ifTwoInput = ifTwoInput  # Use two input sources
         self.outputM = outputM  # Output attention map M
+        self.ifCheckpoint = ifCheckpoint  # Activation checkpointing of the encoder and decoder stages
+        self.ifFused = ifFused  # Fused AdaIN, similarity refinement and attention blending
 
         # Feature extraction networks for Landsat and Hyperspectral inputs
-        self.indices_SNet = FeatureExtract(in_channels = 3)
-        self.MODIS_SNet = FeatureExtract(in_channels = 1)
-        self.Landsat_SNet = FeatureExtract(in_channels = 1)
+        self.indices_SNet = FeatureExtract(in_channels = 3, channels=channels, ifCheckpoint=ifCheckpoint)
+        self.MODIS_SNet = FeatureExtract(in_channels = 1, channels=channels, ifCheckpoint=ifCheckpoint)
+        self.Landsat_SNet = FeatureExtract(in_channels = 1, channels=channels, ifCheckpoint=ifCheckpoint)
 
-        # Define channels at different levels
-        channels = (16, 32, 64, 128, 256)
+        # Channels at the different levels
+        self.channels = tuple(channels)
+        self.depth = len(channels)
 
         # Create a list of significance extraction modules for different feature levels
         self.SignE_List = nn.ModuleList([
             SignificanceExtraction(in_channels=ch, ifattention=self.ifAttention,
-                                   iftwoinput=self.ifTwoInput, outputM=self.outputM).cuda()
+                                   iftwoinput=self.ifTwoInput, outputM=self.outputM, ifFused=self.ifFused)
             for ch in channels
         ])
 
-        self.similarity_refiner = SimilarityFeatureRefiner(method='cosine')
-
-        # Define decoder with deconvolution and residual blocks
-        self.conv1 = nn.Sequential(
-            DeconvBlock(channels[4] * 2, channels[3], 4, 2, 1, bias=True),
-            ResBlock(channels[3]),
-        )
-        self.conv2 = nn.Sequential(
-            DeconvBlock(channels[3] * 2, channels[2], 4, 2, 1, bias=True),
-            ResBlock(channels[2]),
-        )
-        self.conv3 = nn.Sequential(
-            DeconvBlock(channels[2] * 2, channels[1], 4, 2, 1, bias=True),
-            ResBlock(channels[1]),
-        )
-        self.conv4 = nn.Sequential(
-            DeconvBlock(channels[1] * 2, channels[0], 4, 2, 1, bias=True),
-            #nn.MaxPool2d(kernel_size=2, stride=1),  # Spatial pooling
-            ResBlock(channels[0]),
-        )
-        self.conv5 = nn.Sequential(
+        self.similarity_refiner = SimilarityFeatureRefiner(method='cosine', ifFused=self.ifFused)
+        self.adain = fused_adaptive_instance_normalization if self.ifFused else adaptive_instance_normalization
+
+        # Define decoder with deconvolution and residual blocks (conv1 ... conv{depth-1}), from the deepest level up
+        for n in range(1, self.depth):
+            level = self.depth - n
+            setattr(self, 'conv' + str(n), nn.Sequential(
+                DeconvBlock(channels[level] * 2, channels[level - 1], 4, 2, 1, bias=True),
+                ResBlock(channels[level - 1]),
+            ))
+        # Output block (conv{depth})
+        setattr(self, 'conv' + str(self.depth), nn.Sequential(
             ResBlock(channels[0] * 2),
             nn.Conv2d(channels[0] * 2, channels[0], 1, 1, 0),  # 1x1 conv to reduce channels
             ResBlock(channels[0]),
             nn.Conv2d(channels[0], NUM_BANDS, 1, 1, 0),  # Final output layer
-        )
+        ))
 
-    def forward(self, inputs):
-        # Split Landsat input into LST (first channel) and spectral indices (remaining 3 channels)
-        landsat_LST = inputs[1][:, 0:1, :, :]        # (B, 1, h, w)
-        landsat_indices = inputs[1][:, 1:, :, :]     # (B, 3, h, w)
+    def encode(self, inputs, streams=STREAMS):
+        """
+        Multi-level features of the encoder streams.
 
-        # Get Sentinel spatial size
-        target_H, target_W = inputs[2].shape[-2:]
+        Args:
+            inputs (list of torch.Tensor): MODIS t1, Landsat t1 (on the Landsat or the Sentinel grid), Sentinel t1
+                and MODIS t2; further inputs are ignored.
+            streams: Names of the streams to compute (see STREAMS), all of them by default.
 
-        # Upsample Landsat LST and indices to match Sentinel resolution
-        landsat_LST = F.interpolate(landsat_LST, size=(target_H, target_W), mode='bicubic', align_corners=False)
-        landsat_indices = F.interpolate(landsat_indices, size=(target_H, target_W), mode='bicubic', align_corners=False)
+        Returns:
+            dict: Stream name -> list of features, one per level.
+        """
+        features = {}
+        if 'Landsat_LST' in streams or 'Landsat_indices' in streams:
+            # Split Landsat input into LST (first channel) and spectral indices (remaining 3 channels)
+            landsat_LST = inputs[1][:, 0:1, :, :]        # (B, 1, h, w)
+            landsat_indices = inputs[1][:, 1:, :, :]     # (B, 3, h, w)
 
+            # Get Sentinel spatial size
+            target_H, target_W = inputs[2].shape[-2:]
 
-        # Extract features from each input using the corresponding sub-networks
+            # Upsample Landsat LST and indices to match Sentinel resolution (unless already upsampled, see DerivedInputs)
+            if landsat_LST.shape[-2:] != (target_H, target_W):
+                landsat_LST = F.interpolate(landsat_LST, size=(target_H, target_W), mode='bicubic', align_corners=False)
+                landsat_indices = F.interpolate(landsat_indices, size=(target_H, target_W), mode='bicubic', align_corners=False)
 
-        LS2_List = self.MODIS_SNet(inputs[0])  # Modis image 1
-        HS_List = self.Landsat_SNet(landsat_LST)  # Landsat image
-        HS_indices_LIST =  self.indices_SNet(landsat_indices)  # Landsat image
-        SS1_List = self.indices_SNet(inputs[2])  # Sentinel image
+        # Extract features from each input using the corresponding sub-networks
+        if 'MODIS_t1' in streams:
+            features['MODIS_t1'] = self.MODIS_SNet(inputs[0])  # Modis image 1
+        if 'Landsat_LST' in streams:
+            features['Landsat_LST'] = self.Landsat_SNet(landsat_LST)  # Landsat image
+        if 'Landsat_indices' in streams:
+            features['Landsat_indices'] = self.indices_SNet(landsat_indices)  # Landsat image
+        if 'Sentinel' in streams:
+            features['Sentinel'] = self.indices_SNet(inputs[2])  # Sentinel image
+        if 'MODIS_t2' in streams:
+            features['MODIS_t2'] = self.MODIS_SNet(inputs[3])  # Modis image 2
+        return features
+
+    def forward(self, inputs, features=None):
+        """
+        Args:
+            inputs (list of torch.Tensor): MODIS t1, Landsat t1, Sentinel t1 and MODIS t2.
+            features (dict): Precomputed features of some encoder streams (see encode), e.g. cached
+                features of frozen encoders; the other streams are computed from `inputs`.
+        """
+        features = dict(features or {})
+        missing = [stream for stream in STREAMS if stream not in features]
+        if missing:
+            features.update(self.encode(inputs, missing))
 
-        LS1_List = self.MODIS_SNet(inputs[3])  # Modis image 2
+        LS2_List = features['MODIS_t1']
+        HS_List = features['Landsat_LST']
+        HS_indices_LIST = features['Landsat_indices']
+        SS1_List = features['Sentinel']
+        LS1_List = features['MODIS_t2']
 
         # Prepare to construct fused output
         new_10mHS_list = [] 
@@ -316,7 +451,7 @@ class CombinFeatureGenerator(nn.Module):
 
         # Apply Adaptive Instance Normalization (AdaIN)
         SpecFeature_List = [
-            adaptive_instance_normalization(HS, LS1) if self.ifAdaIN else HS
+            self.adain(HS, LS1) if self.ifAdaIN else HS
             for LS1, HS in zip(LS1_List, new_10mHS_list)
         ]
 
@@ -332,11 +467,10 @@ class CombinFeatureGenerator(nn.Module):
                 M.append(SignE_output1)
 
         # Decoder: progressively reconstruct output image
-        l5 = self.conv1(torch.cat((FusionFeature_List[4], LS1_List[4]), dim=1))
-        l4 = self.conv2(torch.cat((FusionFeature_List[3], l5), dim=1))
-        l3 = self.conv3(torch.cat((FusionFeature_List[2], l4), dim=1))
-        l2 = self.conv4(torch.cat((FusionFeature_List[1], l3), dim=1))
-        l1 = self.conv5(torch.cat((FusionFeature_List[0], l2), dim=1))
+        l = run_stage(self.conv1, torch.cat((FusionFeature_List[-1], LS1_List[-1]), dim=1), self.ifCheckpoint)
+        for n in range(2, self.depth):
+            l = run_stage(getattr(self, 'conv' + str(n)), torch.cat((FusionFeature_List[self.depth - n], l), dim=1), self.ifCheckpoint)
+        l1 = run_stage(getattr(self, 'conv' + str(self.depth)), torch.cat((FusionFeature_List[0], l), dim=1), self.ifCheckpoint)
         
         if self.outputM == False:
             return l1
@@ -344,37 +478,104 @@ class CombinFeatureGenerator(nn.Module):
             return l1,M
 
 
+class BufferRegistry(nn.Module):
+    """
+    Device- and dtype-keyed registry of constant tensors (filters, windows, labels).
+
+    Each constant is built once per (name, device, dtype) and kept as a non-persistent module
+    buffer, so that hot loops only perform a dictionary lookup instead of building tensors on the host.
+    """
+
+    def __init__(self):
+        super(BufferRegistry, self).__init__()
+
+    def get(self, name, builder, device, dtype=torch.float32):
+        """
+        Args:
+            name (str): Name of the constant (including the parameters it depends on, e.g. its size).
+            builder (callable): Returns the constant as a tensor, only called on the first request.
+            device (torch.device): Device of the requested tensor.
+            dtype (torch.dtype): Data type of the requested tensor.
+        """
+        device = torch.device(device)
+        key = f'{name}_{device.type}{device.index or 0}_{str(dtype).split(".")[-1]}'.replace('.', '_')
+        buffer = self._buffers.get(key)
+        if buffer is None or buffer.device != device:
+            buffer = builder().to(device=device, dtype=dtype)
+            self.register_buffer(key, buffer, persistent=False)
+        return buffer
+
+
+def gaussian_1d(sigma=1.0):
+    """
+    Normalized 1D Gaussian of size 2 * ceil(3*sigma) + 1. Its outer product with itself is the
+    normalized 2D kernel used by Experiment.gaussian_kernel.
+    """
+    radius = int(math.ceil(3 * sigma))
+    ax = torch.arange(-radius, radius + 1, dtype=torch.float64)
+    gauss = torch.exp(-ax ** 2 / (2.0 * sigma ** 2))
+    return gauss / gauss.sum()
+
+
+class Degradation(nn.Module):
+    """
+    Degrades 10 m predictions to the 30 m Landsat grid: Gaussian blur with replicate padding followed
+    by scale x scale average pooling with stride scale.
+
+    Both operators are separable, and a box filter applied with stride `scale` after the Gaussian is
+    the same as a single stride-`scale` filter (the Gaussian convolved with the box). The degradation
+    therefore runs as two strided 1D convolutions (vertical, then horizontal) on the padded input,
+    instead of a full 2D Gaussian followed by pooling.
+    """
+
+    def __init__(self, sigma=1.0, scale=3):
+        super(Degradation, self).__init__()
+        self.scale = scale
+
+        gauss = gaussian_1d(sigma)
+        box = torch.full((scale,), 1.0 / scale, dtype=torch.float64)
+        combined = torch.from_numpy(np.convolve(gauss.numpy(), box.numpy()))  # Gaussian followed by the box
+
+        self.radius = len(gauss) // 2
+        self.register_buffer('blur_kernel', gauss.float())
+        self.register_buffer('degrade_kernel', combined.float())
+
+    def separable_conv(self, x, kernel, stride=1):
+        C = x.shape[1]
+        kernel = kernel.to(x.dtype)
+        x = F.conv2d(x, kernel.view(1, 1, -1, 1).expand(C, 1, -1, 1), stride=(stride, 1), groups=C)  # vertical pass
+        return F.conv2d(x, kernel.view(1, 1, 1, -1).expand(C, 1, 1, -1), stride=(1, stride), groups=C)  # horizontal pass
+
+    def blur(self, x):
+        """Gaussian blur only, same output size as the input."""
+        x = F.pad(x, [self.radius] * 4, mode='replicate')
+        return self.separable_conv(x, self.blur_kernel)
+
+    def forward(self, x):
+        """Gaussian blur and average pooling: [B, C, H, W] -> [B, C, H // scale, W // scale]."""
+        x = F.pad(x, [self.radius] * 4, mode='replicate')
+        return self.separable_conv(x, self.degrade_kernel, stride=self.scale)
+
+
 class GANLoss(nn.Module):
     def __init__(self, use_lsgan=True, target_real_label=1.0, target_fake_label=0.0,
-                 tensor=torch.cuda.FloatTensor):
+                 tensor=None):
         super(GANLoss, self).__init__()
         self.real_label = target_real_label
         self.fake_label = target_fake_label
-        self.real_label_var = None
-        self.fake_label_var = None
-        self.Tensor = tensor
+        self.registry = BufferRegistry()  # Scalar labels, broadcast to the prediction shape
         if use_lsgan:
             self.loss = nn.MSELoss()
         else:
             self.loss = nn.BCELoss()
 
     def get_target_tensor(self, input, target_is_real):
-        target_tensor = None
         if target_is_real:
-            create_label = ((self.real_label_var is None) or
-                            (self.real_label_var.numel() != input.numel()))
-            if create_label:
-                real_tensor = self.Tensor(input.size()).fill_(self.real_label)
-                self.real_label_var = Variable(real_tensor, requires_grad=False)
-            target_tensor = self.real_label_var
+            label = self.registry.get('real_label', lambda: torch.tensor(self.real_label), input.device, input.dtype)
         else:
-            create_label = ((self.fake_label_var is None) or
-                            (self.fake_label_var.numel() != input.numel()))
-            if create_label:
-                fake_tensor = self.Tensor(input.size()).fill_(self.fake_label)
-                self.fake_label_var = Variable(fake_tensor, requires_grad=False)
-            target_tensor = self.fake_label_var
-        return target_tensor
+            label = self.registry.get('fake_label', lambda: torch.tensor(self.fake_label), input.device, input.dtype)
+        # Expanded view of the scalar label: no allocation whatever the input shape
+        return label.expand_as(input)
 
     def __call__(self, input, target_is_real):
         if isinstance(input[0], list):
@@ -0,0 +1,123 @@
+import copy
+import json
+import math
+import os
+
+import torch
+
+import sys
+sys.path.append(os.path.abspath('..'))  # go up to root directory
+
+from runner.experiment import Experiment
+from runner.benchmark import measure_train_step
+from data_loader.utils import make_tuple, get_logger
+
+
+def device_memory_bytes(device):
+    """Total memory of the device (host RAM on CPU)."""
+    if device.type == 'cuda':
+        return torch.cuda.get_device_properties(device).total_memory
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def static_memory_bytes(experiment):
+    """Weights, gradients and the two Adam moments of the generator and the discriminator."""
+    n_bytes = 0
+    for model in (experiment.generator, experiment.nlayerdiscriminator):
+        n_bytes += sum(p.numel() * p.element_size() for p in model.parameters()) * 4
+    return n_bytes
+
+
+def is_out_of_memory(error):
+    """CUDA out-of-memory errors, and failed host allocations of the CPU allocator."""
+    message = str(error)
+    return isinstance(error, RuntimeError) and ('out of memory' in message or "can't allocate memory" in message)
+
+
+def probe(experiment, batch_size, patch_size, steps=3, warmup=1):
+    """
+    Measures one training configuration.
+
+    Returns:
+        dict: batch and patch size, step time, memory (peak allocation on CUDA, saved activations plus
+        parameter and optimizer state on CPU) and throughput in Landsat pixels/sec; None on out-of-memory.
+    """
+    try:
+        result = measure_train_step(experiment, batch_size, patch_size, steps=steps, warmup=warmup)
+    except RuntimeError as e:
+        if not is_out_of_memory(e):
+            raise
+        experiment.g_optimizer.zero_grad(set_to_none=True)
+        experiment.pd_optimizer.zero_grad(set_to_none=True)
+        if experiment.device.type == 'cuda':
+            torch.cuda.empty_cache()
+        return None
+
+    memory = result['peak_memory']
+    if memory is None:
+        memory = result['activation_bytes'] + static_memory_bytes(experiment)
+    patch_size = make_tuple(patch_size)
+    return {'batch_size': batch_size, 'patch_size': list(patch_size), 'step_time': result['step_time'],
+            'memory': memory, 'pixels_per_sec': batch_size * patch_size[0] * patch_size[1] / result['step_time']}
+
+
+def autotune(option, memory_budget=None, patch_sizes=None, max_batch_size=None, steps=3):
+    """
+    Picks the micro-batch size and patch size with the highest training throughput within a memory budget.
+
+    For every candidate patch size, the batch size is doubled from 1 until the training step exceeds the
+    budget (or runs out of memory). Candidates are compared by Landsat pixels/sec, so patch sizes of
+    different areas are comparable. If the best micro-batch is smaller than option.batch_size, the requested
+    (effective) batch size is kept with gradient accumulation.
+
+    Args:
+        option: Experiment options (see tutorials/04.py).
+        memory_budget (int): Budget in bytes (default 90% of the device memory).
+        patch_sizes (list): Candidate patch sizes on the Landsat grid, multiples of 16 (default [option.patch_size]).
+        max_batch_size (int): Largest micro-batch probed (default option.batch_size).
+        steps (int): Timed steps per probe.
+
+    Returns:
+        Options: A copy of `option` with the chosen patch_size, batch_size and accumulation_steps.
+        The probes and the choice are written to `autotune.json` in save_dir.
+    """
+    logger = get_logger()
+    opt = copy.copy(option)
+    opt.accumulation_steps = 1
+    experiment = Experiment(opt)
+    device = experiment.device
+
+    memory_budget = memory_budget or int(0.9 * device_memory_bytes(device))
+    patch_sizes = [make_tuple(p) for p in (patch_sizes or [option.patch_size])]
+    max_batch_size = max_batch_size or option.batch_size
+
+    probes = []
+    for patch_size in patch_sizes:
+        batch_size = 1
+        while batch_size <= max_batch_size:
+            result = probe(experiment, batch_size, patch_size, steps=steps)
+            if result is None or result['memory'] > memory_budget:
+                logger.info(f'Batch {batch_size} x patch {patch_size}: over the memory budget')
+                break
+            logger.info(f"Batch {batch_size} x patch {patch_size}: {result['step_time']:.4f}s/step, "
+                        f"{result['memory'] / 2**20:.0f} MB, {result['pixels_per_sec']:.0f} pixels/s")
+            probes.append(result)
+            batch_size *= 2
+
+    if not probes:
+        raise RuntimeError(f'No configuration fits in a memory budget of {memory_budget / 2**20:.0f} MB')
+    best = max(probes, key=lambda r: r['pixels_per_sec'])
+
+    tuned = copy.copy(option)
+    tuned.patch_size = list(best['patch_size'])
+    tuned.accumulation_steps = math.ceil(option.batch_size / best['batch_size'])
+    tuned.batch_size = best['batch_size'] * tuned.accumulation_steps
+    logger.info(f"Chosen: micro-batch {best['batch_size']} x {tuned.accumulation_steps} accumulation steps "
+                f"(effective batch {tuned.batch_size}), patch {tuned.patch_size}")
+
+    summary = {'device': str(device), 'memory_budget': memory_budget, 'probes': probes,
+               'patch_size': list(tuned.patch_size), 'micro_batch_size': best['batch_size'],
+               'accumulation_steps': tuned.accumulation_steps, 'batch_size': tuned.batch_size}
+    with open(experiment.save_dir / 'autotune.json', 'w') as file:
+        json.dump(summary, file, indent=2)
+    return tuned
@@ -0,0 +1,352 @@
+import copy
+from timeit import default_timer as timer
+
+import torch
+
+import sys
+import os
+sys.path.append(os.path.abspath('..'))  # go up to root directory
+
+from runner.experiment import Experiment
+from data_loader.utils import make_tuple, get_logger
+
+
+def synthetic_batch(batch_size, patch_size, device):
+    """
+    Creates a random batch with the shapes produced by PatchSet.
+
+    Args:
+        batch_size (int): Number of patches in the batch.
+        patch_size (int or tuple): Patch size on the Landsat grid.
+        device (torch.device): Device on which the tensors are created.
+
+    Returns:
+        tuple: (inputs, target) as expected by Experiment.train_step.
+    """
+    patch_size = make_tuple(patch_size)
+    fine_size = tuple(i * 3 for i in patch_size)  # MODIS and Sentinel are stored on the 10 m grid
+
+    inputs = [
+        torch.rand(batch_size, 1, *fine_size, device=device),   # MODIS t1
+        torch.rand(batch_size, 4, *patch_size, device=device),  # Landsat t1 (LST + 3 indices)
+        torch.rand(batch_size, 3, *fine_size, device=device),   # Sentinel t1
+        torch.rand(batch_size, 1, *fine_size, device=device),   # MODIS t2
+    ]
+    target = [torch.rand(batch_size, 4, *patch_size, device=device)]  # Landsat t2
+    return inputs, target
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def reset_peak_memory(device):
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory_bytes(device):
+    """
+    Peak memory allocated by PyTorch on the device since the last reset.
+    Only available on CUDA; on CPU the activation footprint is measured with `saved_activation_bytes`.
+    """
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)
+    return None
+
+
+class saved_activation_bytes(torch.autograd.graph.saved_tensors_hooks):
+    """
+    Context manager that sums the bytes of every tensor autograd saves for the backward pass.
+    This is the activation memory of a training step and works on any device.
+    """
+
+    def __init__(self):
+        self.nbytes = 0
+
+        def pack(tensor):
+            self.nbytes += tensor.numel() * tensor.element_size()
+            return tensor
+
+        def unpack(tensor):
+            return tensor
+
+        super(saved_activation_bytes, self).__init__(pack, unpack)
+
+    def __enter__(self):
+        # saved_tensors_hooks.__enter__ returns None, `with ... as saved` needs the counter
+        super(saved_activation_bytes, self).__enter__()
+        return self
+
+
+def measure_train_step(experiment, batch_size, patch_size, steps=10, warmup=2):
+    """
+    Times Experiment.train_step on synthetic batches.
+
+    Returns:
+        dict: mean step time (s), peak memory (bytes) and saved activation bytes per step.
+    """
+    inputs, target = synthetic_batch(batch_size, patch_size, experiment.device)
+    experiment.generator.train()
+    experiment.nlayerdiscriminator.train()
+
+    for _ in range(warmup):
+        experiment.train_step(inputs, target)
+
+    reset_peak_memory(experiment.device)
+    with saved_activation_bytes() as saved:
+        synchronize(experiment.device)
+        t_start = timer()
+        for _ in range(steps):
+            experiment.train_step(inputs, target)
+        synchronize(experiment.device)
+        t_end = timer()
+
+    return {'step_time': (t_end - t_start) / steps,
+            'peak_memory': peak_memory_bytes(experiment.device),
+            'activation_bytes': saved.nbytes // steps}
+
+
+def benchmark_precision(option, batch_size, patch_size, steps=10, precisions=('fp32', 'bf16', 'fp16')):
+    """
+    Compares the training step time and memory of the mixed-precision modes against the float32 baseline.
+
+    Args:
+        option: Experiment options (see tutorials/04.py).
+        batch_size (int): Batch size of the synthetic batches.
+        patch_size (int or tuple): Patch size on the Landsat grid.
+        steps (int): Number of timed steps per precision.
+        precisions (tuple): Precisions to compare, the first one is the baseline.
+
+    Returns:
+        list of dict: One row per precision.
+    """
+    logger = get_logger()
+    rows = []
+    for precision in precisions:
+        opt = copy.copy(option)
+        opt.precision = precision
+        experiment = Experiment(opt)
+        result = measure_train_step(experiment, batch_size, patch_size, steps=steps)
+        result['precision'] = f'{precision} ({experiment.amp_dtype})' if experiment.use_amp else precision
+        rows.append(result)
+        del experiment
+
+    baseline = rows[0]
+    logger.info(f"{'precision':<24}{'step time (s)':>15}{'speedup':>10}{'peak mem (MB)':>16}{'activations (MB)':>18}")
+    for row in rows:
+        row['speedup'] = baseline['step_time'] / row['step_time']
+        peak = '-' if row['peak_memory'] is None else f"{row['peak_memory'] / 2**20:.1f}"
+        logger.info(f"{row['precision']:<24}{row['step_time']:>15.4f}{row['speedup']:>10.2f}"
+                    f"{peak:>16}{row['activation_bytes'] / 2**20:>18.1f}")
+    return rows
+
+
+def benchmark_checkpointing(option, batch_size, patch_sizes, steps=10):
+    """
+    Peak memory versus step time trade-off of activation checkpointing.
+
+    Args:
+        option: Experiment options (see tutorials/04.py).
+        batch_size (int): Batch size of the synthetic batches.
+        patch_sizes (list): Patch sizes on the Landsat grid to compare.
+        steps (int): Number of timed steps per configuration.
+
+    Returns:
+        list of dict: One row per (patch size, checkpointing) configuration.
+    """
+    logger = get_logger()
+    rows = []
+    for patch_size in patch_sizes:
+        for ifCheckpoint in (False, True):
+            opt = copy.copy(option)
+            opt.ifCheckpoint = ifCheckpoint
+            experiment = Experiment(opt)
+            result = measure_train_step(experiment, batch_size, patch_size, steps=steps)
+            result.update({'patch_size': patch_size, 'checkpoint': ifCheckpoint})
+            rows.append(result)
+            del experiment
+
+    logger.info(f"{'patch':>6}{'checkpoint':>12}{'step time (s)':>15}{'peak mem (MB)':>16}{'activations (MB)':>18}")
+    for row in rows:
+        peak = '-' if row['peak_memory'] is None else f"{row['peak_memory'] / 2**20:.1f}"
+        logger.info(f"{str(row['patch_size']):>6}{str(row['checkpoint']):>12}{row['step_time']:>15.4f}"
+                    f"{peak:>16}{row['activation_bytes'] / 2**20:>18.1f}")
+    return rows
+
+
+def check_fused_ops(seed=0):
+    """
+    Gradient-correctness checks of the fused AdaIN, similarity refinement and blending against the
+    reference implementations (float64, torch.autograd.gradcheck for the hand-written backward).
+
+    Returns:
+        dict: Maximum absolute deviation of the outputs and gradients of each op.
+    """
+    from model.WGAST import (adaptive_instance_normalization, fused_adaptive_instance_normalization,
+                             SimilarityFeatureRefiner, FusedCosineRefine, fused_blend)
+    torch.manual_seed(seed)
+
+    def compare(reference, fused, *shapes):
+        tensors = [torch.randn(*shape, dtype=torch.float64, requires_grad=True) for shape in shapes]
+        out_ref = reference(*tensors)
+        grads_ref = torch.autograd.grad(out_ref.sum(), tensors)
+        out_fused = fused(*tensors)
+        grads_fused = torch.autograd.grad(out_fused.sum(), tensors)
+        deviation = (out_ref - out_fused).abs().max().item()
+        for g_ref, g_fused in zip(grads_ref, grads_fused):
+            deviation = max(deviation, (g_ref - g_fused).abs().max().item())
+        return deviation, tensors
+
+    shape = (2, 8, 6, 6)
+    results = {}
+
+    results['adain'], _ = compare(adaptive_instance_normalization, fused_adaptive_instance_normalization, shape, shape)
+
+    refiner = SimilarityFeatureRefiner(method='cosine')
+    results['similarity'], tensors = compare(refiner, FusedCosineRefine.apply, shape, shape, shape)
+    assert torch.autograd.gradcheck(FusedCosineRefine.apply, tensors), 'FusedCosineRefine backward is incorrect'
+
+    results['blend'], _ = compare(lambda a, b, m: a * m + b * (1 - m), fused_blend, shape, shape, (2, 1, 6, 6))
+
+    for name, deviation in results.items():
+        assert deviation < 1e-8, f'{name}: fused op deviates from the reference by {deviation}'
+    return results
+
+
+def benchmark_fused_ops(batch_size, patch_size, channels=None, steps=20, device=None):
+    """
+    Microbenchmark of the reference and fused AdaIN, similarity refinement and blending at every
+    pyramid level (forward + backward).
+
+    Args:
+        batch_size (int): Batch size.
+        patch_size (int or tuple): Patch size on the Landsat grid.
+        channels (tuple): Channel widths of the levels (default CHANNELS).
+        steps (int): Number of timed iterations.
+
+    Returns:
+        list of dict: One row per (level, op).
+    """
+    from model.WGAST import (CHANNELS, adaptive_instance_normalization, fused_adaptive_instance_normalization,
+                             SimilarityFeatureRefiner, FusedCosineRefine, fused_blend)
+    logger = get_logger()
+    device = device or torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    channels = channels or CHANNELS
+    size = tuple(i * 3 for i in make_tuple(patch_size))
+    refiner = SimilarityFeatureRefiner(method='cosine')
+
+    ops = {
+        'adain': (adaptive_instance_normalization, fused_adaptive_instance_normalization, 2),
+        'similarity': (refiner, FusedCosineRefine.apply, 3),
+        'blend': (lambda a, b, m: a * m + b * (1 - m), fused_blend, 3),
+    }
+
+    def run(fn, tensors):
+        for _ in range(2):
+            fn(*tensors).sum().backward()
+        synchronize(device)
+        t_start = timer()
+        for _ in range(steps):
+            fn(*tensors).sum().backward()
+        synchronize(device)
+        return (timer() - t_start) / steps
+
+    rows = []
+    for level, ch in enumerate(channels):
+        shape = (batch_size, ch, size[0] >> level, size[1] >> level)
+        for name, (reference, fused, n_inputs) in ops.items():
+            tensors = [torch.randn(*shape, device=device, requires_grad=True) for _ in range(n_inputs)]
+            if name == 'blend':
+                tensors[2] = torch.rand(shape[0], 1, *shape[2:], device=device, requires_grad=True)
+            t_ref, t_fused = run(reference, tensors), run(fused, tensors)
+            rows.append({'level': level, 'op': name, 'shape': shape,
+                         'reference': t_ref, 'fused': t_fused, 'speedup': t_ref / t_fused})
+
+    logger.info(f"{'level':>6}{'op':>12}{'reference (ms)':>16}{'fused (ms)':>12}{'speedup':>10}")
+    for row in rows:
+        logger.info(f"{row['level']:>6}{row['op']:>12}{row['reference'] * 1e3:>16.3f}"
+                    f"{row['fused'] * 1e3:>12.3f}{row['speedup']:>10.2f}")
+    return rows
+
+
+def check_degradation(experiment, batch_size=2, patch_size=32, seed=0):
+    """
+    Compares the separable Degradation operator with the reference 2D Gaussian blur
+    (Experiment.apply_gaussian_blur) followed by 3x3 average pooling.
+
+    Returns:
+        dict: Maximum absolute deviation of the blur and of the degradation, and their timings.
+    """
+    torch.manual_seed(seed)
+    fine_size = tuple(i * 3 for i in make_tuple(patch_size))
+    x = torch.rand(batch_size, 1, *fine_size, device=experiment.device)
+
+    def reference_blur():
+        return experiment.apply_gaussian_blur(x, sigma=1.0)
+
+    def reference_degrade():
+        return torch.nn.functional.avg_pool2d(experiment.apply_gaussian_blur(x, sigma=1.0), kernel_size=3, stride=3)
+
+    def timed(fn, steps=20):
+        fn()
+        synchronize(experiment.device)
+        t_start = timer()
+        for _ in range(steps):
+            fn()
+        synchronize(experiment.device)
+        return (timer() - t_start) / steps
+
+    results = {
+        'blur_deviation': (experiment.degradation.blur(x) - reference_blur()).abs().max().item(),
+        'degrade_deviation': (experiment.degradation(x) - reference_degrade()).abs().max().item(),
+        'reference_time': timed(reference_degrade),
+        'separable_time': timed(lambda: experiment.degradation(x)),
+    }
+    assert results['blur_deviation'] < 1e-5 and results['degrade_deviation'] < 1e-5, results
+    return results
+
+
+def check_msssim(batch_size=4, patch_size=32, device=None, seed=0):
+    """
+    Compares the batched MSSSIM module with the reference `msssim` (values and gradients) and times both.
+
+    The comparison runs in float64: on LST values (~300 K) the variances E[x^2] - mu^2 cancel about
+    four digits, so in float32 the two implementations differ by the ~1e-5 rounding of their
+    different convolutions. Both are timed in float32, with the same (inferred) dynamic range.
+
+    Returns:
+        dict: Absolute deviations of the value and of the gradient, and the timings of both implementations.
+    """
+    from runner.experiment import MSSSIM, msssim
+    device = device or torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(seed)
+    size = make_tuple(patch_size)
+    img1 = (torch.rand(batch_size, 1, *size, device=device) * 40 + 280).requires_grad_()
+    img2 = torch.rand(batch_size, 1, *size, device=device) * 40 + 280
+
+    batched = MSSSIM(window_size=11, normalize=True).to(device)
+    img1_64, img2_64 = img1.detach().double().requires_grad_(), img2.double()
+    reference = msssim(img1_64, img2_64, normalize=True)
+    grad_ref, = torch.autograd.grad(reference, img1_64)
+    value = batched(img1_64, img2_64)
+    grad, = torch.autograd.grad(value, img1_64)
+
+    def timed(fn, steps=20):
+        fn().backward()
+        synchronize(device)
+        t_start = timer()
+        for _ in range(steps):
+            fn().backward()
+        synchronize(device)
+        return (timer() - t_start) / steps
+
+    results = {
+        'value_deviation': (value - reference).abs().item(),
+        'grad_deviation': (grad - grad_ref).abs().max().item(),
+        'reference_time': timed(lambda: msssim(img1, img2, normalize=True)),
+        'batched_time': timed(lambda: batched(img1, img2)),
+    }
+    assert results['value_deviation'] < 1e-10 and results['grad_deviation'] < 1e-10, results
+    return results
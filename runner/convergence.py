@@ -0,0 +1,159 @@
+import json
+import math
+from timeit import default_timer as timer
+
+
+SCHEDULES = ('constant', 'cosine', 'one_cycle')
+
+
+def cosine_factor(progress, min_factor=0.0):
+    """Cosine annealing from 1 to `min_factor` as `progress` goes from 0 to 1."""
+    return min_factor + (1.0 - min_factor) * 0.5 * (1.0 + math.cos(math.pi * min(progress, 1.0)))
+
+
+def make_lr_lambda(schedule, epochs, warmup_epochs=0, min_factor=0.0, div_factor=25.0, final_div_factor=1e4):
+    """
+    Learning rate factor of a LambdaLR, relative to option.lr.
+
+    Experiment steps its schedulers at the start of every epoch, so the LambdaLR step count is the
+    epoch + 1; the returned function takes that count.
+
+    Args:
+        schedule (str): 'constant', 'cosine' (linear warmup from 0, then cosine annealing to `min_factor`)
+            or 'one_cycle' (warmup from 1/div_factor to 1, then cosine annealing to 1/(div_factor * final_div_factor),
+            as torch.optim.lr_scheduler.OneCycleLR with option.lr as the maximum).
+        epochs (int): Length of the schedule; the factor stays at its final value afterwards.
+        warmup_epochs (int): Epochs of increasing learning rate (one-cycle: 30% of `epochs` if 0).
+    """
+    if schedule not in SCHEDULES:
+        raise ValueError(f'Unknown learning rate schedule {schedule!r}, expected one of {SCHEDULES}')
+
+    if schedule == 'one_cycle' and not warmup_epochs:
+        warmup_epochs = max(1, int(0.3 * epochs))
+
+    def lr_lambda(count):
+        epoch = max(count - 1, 0)
+        if schedule == 'constant':
+            return 1.0
+
+        if schedule == 'cosine':
+            if epoch < warmup_epochs:
+                return (epoch + 1) / (warmup_epochs + 1)
+            return cosine_factor((epoch - warmup_epochs) / max(1, epochs - warmup_epochs), min_factor)
+
+        initial = 1.0 / div_factor
+        if epoch < warmup_epochs:
+            return initial + (1.0 - initial) * epoch / warmup_epochs
+        return cosine_factor((epoch - warmup_epochs) / max(1, epochs - warmup_epochs - 1), initial / final_div_factor)
+
+    return lr_lambda
+
+
+class ConvergenceMonitor(object):
+    """
+    Tracks the train error of Experiment.train over wall-clock time.
+
+    It stops training once the error has not improved by a relative `min_delta` for `patience` epochs
+    (ignoring the first `min_epochs`, e.g. the learning rate warmup), and records the time and the epoch
+    at which the error first reaches `target_error`, so that configurations can be compared on
+    time-to-quality. The training time accumulates over resumed runs (see load_state_dict).
+    Epochs may be tagged with a curriculum stage: the plateau detection restarts when the stage changes,
+    the time-to-target bookkeeping does not.
+
+    Args:
+        patience (int): Epochs without improvement before stopping (None: never stop on a plateau).
+        min_delta (float): Relative improvement of the error counted as progress.
+        target_error (float): Error whose time-to-target is reported (None: not tracked).
+        stop_at_target (bool): Also stop once `target_error` is reached.
+        min_epochs (int): Epochs before the plateau detection starts.
+    """
+
+    def __init__(self, patience=None, min_delta=0.0, target_error=None, stop_at_target=False, min_epochs=0):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.target_error = target_error
+        self.stop_at_target = stop_at_target
+        self.min_epochs = min_epochs
+
+        self.best = math.inf
+        self.best_epoch = None
+        self.bad_epochs = 0
+        self.time_to_target = None
+        self.epoch_to_target = None
+        self.stopped_epoch = None
+        self.epochs = []  # (epoch, error, elapsed seconds, learning rate) of every epoch
+        self.elapsed = 0.0  # Training time of previous runs
+        self.t_start = None
+
+    def start(self):
+        self.t_start = timer()
+
+    def time(self):
+        """Training time so far, in seconds."""
+        return self.elapsed + (timer() - self.t_start if self.t_start is not None else 0.0)
+
+    def step(self, epoch, error, lr=None, stage=None):
+        """
+        Records the train error of an epoch, trained in curriculum `stage` (if any).
+
+        Returns:
+            bool: True if training should stop.
+        """
+        return self.record({'epoch': epoch, 'error': error, 'elapsed': self.time(), 'lr': lr, 'stage': stage})
+
+    def reset_plateau(self):
+        """Forgets the best error so far, e.g. when the patch size changes the error scale."""
+        self.best, self.best_epoch, self.bad_epochs = math.inf, None, 0
+
+    def record(self, record):
+        if self.epochs and record.get('stage') != self.epochs[-1].get('stage'):
+            self.reset_plateau()
+        self.epochs.append(record)
+        epoch, error = record['epoch'], record['error']
+
+        reached = self.target_error is not None and error <= self.target_error
+        if reached and self.time_to_target is None:
+            self.time_to_target = record['elapsed']
+            self.epoch_to_target = epoch
+
+        if error < self.best * (1.0 - self.min_delta):
+            self.best = error
+            self.best_epoch = epoch
+            self.bad_epochs = 0
+        elif len(self.epochs) > self.min_epochs:
+            self.bad_epochs += 1
+
+        plateau = self.patience is not None and self.bad_epochs >= self.patience
+        if plateau or (reached and self.stop_at_target):
+            self.stopped_epoch = epoch
+            return True
+        return False
+
+    def state_dict(self):
+        return {'patience': self.patience, 'min_delta': self.min_delta, 'target_error': self.target_error,
+                'best_error': None if math.isinf(self.best) else self.best, 'best_epoch': self.best_epoch,
+                'bad_epochs': self.bad_epochs, 'time_to_target': self.time_to_target,
+                'epoch_to_target': self.epoch_to_target, 'stopped_epoch': self.stopped_epoch,
+                'elapsed': self.time(), 'epochs': self.epochs}
+
+    def load_state_dict(self, state, last_epoch=None):
+        """
+        Continues a previous run up to `last_epoch` (e.g. the last epoch of history.csv): its epochs are
+        replayed with the current settings, and its training time is carried over.
+        """
+        records = [record for record in state['epochs'] if last_epoch is None or record['epoch'] <= last_epoch]
+        self.reset_plateau()
+        self.time_to_target, self.epoch_to_target, self.stopped_epoch = None, None, None
+        self.epochs = []
+        for record in records:
+            self.record(record)
+        self.stopped_epoch = None
+        self.elapsed = records[-1]['elapsed'] if records else 0.0
+
+    def save(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.state_dict(), file, indent=2)
+
+    def load(self, path, last_epoch=None):
+        with open(path) as file:
+            self.load_state_dict(json.load(file), last_epoch=last_epoch)
@@ -0,0 +1,67 @@
+import math
+
+
+class CurriculumScheduler(object):
+    """
+    Progressive patch-size curriculum for Experiment.train.
+
+    Training goes through `stages`, typically from small patches with large batches to the full patch
+    size. A stage ends after its number of epochs, or earlier once the train error has not improved by
+    a relative `min_delta` for `patience` epochs. The last stage runs until the end of training.
+
+    Args:
+        stages (list of dict): 'patch_size' and optionally 'batch_size', 'patch_stride' and 'epochs'
+            per stage, e.g. [{'patch_size': [16, 16], 'batch_size': 128, 'epochs': 10},
+                             {'patch_size': [32, 32], 'batch_size': 32}].
+        patience (int): Epochs without improvement before moving to the next stage (None: epochs only).
+        min_delta (float): Relative improvement of the train error counted as progress.
+    """
+
+    def __init__(self, stages, patience=None, min_delta=0.0):
+        if not stages:
+            raise ValueError('The curriculum needs at least one stage')
+        self.stages = list(stages)
+        self.patience = patience
+        self.min_delta = min_delta
+
+        self.stage = 0
+        self.epochs_in_stage = 0
+        self.best = math.inf
+        self.bad_epochs = 0
+
+    @property
+    def current(self):
+        return self.stages[self.stage]
+
+    def settings(self, patch_size, patch_stride, batch_size):
+        """Patch size, stride and batch size of the current stage, defaulting to the given ones."""
+        stage = self.current
+        return (stage.get('patch_size', patch_size), stage.get('patch_stride', patch_stride),
+                stage.get('batch_size', batch_size))
+
+    def step(self, error):
+        """
+        Records the train error of an epoch.
+
+        Returns:
+            bool: True if the next epoch starts a new stage.
+        """
+        self.epochs_in_stage += 1
+        if error < self.best * (1.0 - self.min_delta):
+            self.best = error
+            self.bad_epochs = 0
+        else:
+            self.bad_epochs += 1
+
+        if self.stage == len(self.stages) - 1:
+            return False
+        epochs = self.current.get('epochs')
+        finished = epochs is not None and self.epochs_in_stage >= epochs
+        plateau = self.patience is not None and self.bad_epochs >= self.patience
+        if finished or plateau:
+            self.stage += 1
+            self.epochs_in_stage = 0
+            self.best = math.inf
+            self.bad_epochs = 0
+            return True
+        return False
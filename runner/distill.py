@@ -0,0 +1,198 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.optim as optim
+from torch.utils.data import DataLoader
+
+import sys
+import os
+sys.path.append(os.path.abspath('..'))  # go up to root directory
+
+from model.WGAST import *
+from runner.experiment import Experiment
+from data_loader.data import PatchSet
+from data_loader.utils import *
+
+from pathlib import Path
+from timeit import default_timer as timer
+
+
+class DistillExperiment(Experiment):
+    """
+    Trains a slim WGAST student (option.channels) from a frozen teacher checkpoint.
+
+    The student is supervised by the teacher's 10 m prediction (output loss), by the teacher's
+    fused features at every pyramid level (feature loss, through 1x1 adapters when the widths
+    differ) and by the weakly supervised Landsat loss used in Experiment (task loss).
+    The discriminator is not used. The adapters are checkpointed (adapters.pth) and snapshotted with the student.
+
+    Extra options:
+        teacher_checkpoint (Path): Teacher generator checkpoint, e.g. the teacher run's best.pth.
+        teacher_channels (tuple): Channel widths of the teacher (default CHANNELS).
+        kd_output, kd_feature, kd_task (float): Weights of the output, feature and task losses.
+    """
+
+    def __init__(self, option):
+        super(DistillExperiment, self).__init__(option)
+
+        self.kd_output = getattr(option, 'kd_output', 1.0)
+        self.kd_feature = getattr(option, 'kd_feature', 1.0)
+        self.kd_task = getattr(option, 'kd_task', 1.0)
+
+        # Frozen teacher
+        self.teacher_channels = tuple(getattr(option, 'teacher_channels', CHANNELS))
+        self.teacher = CombinFeatureGenerator(ifAdaIN=self.ifAdaIN, ifAttention=self.ifAttention, ifTwoInput=self.ifTwoInput,
+                                              channels=self.teacher_channels, ifFused=self.ifFused).to(self.device)
+        load_checkpoint(Path(option.teacher_checkpoint), self.teacher, map_location=self.device)
+        self.teacher.eval()
+        for param in self.teacher.parameters():
+            param.requires_grad = False
+
+        # Capture the fused features of every level with forward hooks on the significance modules
+        student = self.generator.module if isinstance(self.generator, nn.DataParallel) else self.generator
+        self.student_features, self.teacher_features = {}, {}
+        for n, SignE in enumerate(student.SignE_List):
+            SignE.register_forward_hook(self.feature_hook(self.student_features, n))
+        for n, SignE in enumerate(self.teacher.SignE_List):
+            SignE.register_forward_hook(self.feature_hook(self.teacher_features, n))
+
+        # 1x1 adapters projecting the student features to the teacher widths (levels shared by both)
+        n_levels = min(len(self.channels), len(self.teacher_channels))
+        self.adapters = nn.ModuleList([
+            nn.Conv2d(s_ch, t_ch, 1, 1, 0) if s_ch != t_ch else nn.Identity()
+            for s_ch, t_ch in zip(self.channels[:n_levels], self.teacher_channels[:n_levels])
+        ]).to(self.device)
+        self.adapter_optimizer = optim.Adam(self.adapters.parameters(), lr=option.lr)
+        self.last_adapters = self.train_dir / 'adapters.pth'  # checkpointed next to the student
+
+        n_params = sum(p.numel() for p in self.teacher.parameters())
+        self.logger.info(f'Distilling a teacher with {n_params} parameters (channels {self.teacher_channels}) '
+                         f'into a student with channels {self.channels}.')
+
+    def save_checkpoints(self, n_epoch):
+        super(DistillExperiment, self).save_checkpoints(n_epoch)
+        self.checkpoint_writer.save(self.adapters, self.adapter_optimizer, self.last_adapters, epoch=n_epoch)
+
+    def load_checkpoints(self):
+        super(DistillExperiment, self).load_checkpoints()
+        load_checkpoint(self.last_adapters, self.adapters, optimizer=self.adapter_optimizer)
+
+    def training_state(self, n_epoch, step, meters):
+        state = super(DistillExperiment, self).training_state(n_epoch, step, meters)
+        state['adapters'] = self.adapters.state_dict()
+        state['adapter_optimizer'] = self.adapter_optimizer.state_dict()
+        return state
+
+    def load_snapshot(self, state):
+        super(DistillExperiment, self).load_snapshot(state)
+        self.adapters.load_state_dict(state['adapters'])
+        self.adapter_optimizer.load_state_dict(state['adapter_optimizer'])
+
+    @staticmethod
+    def feature_hook(store, level):
+        def hook(module, inputs, output):
+            store[level] = output[0] if isinstance(output, tuple) else output
+        return hook
+
+    def train_step(self, inputs, target):
+        """
+        Runs one student update on a batch.
+
+        Returns:
+            tuple: total distillation loss, 0 (no discriminator) and MSE of the degraded prediction (device tensors).
+        """
+        LST_landsat_t2 = target[0][:, :1, :, :]
+
+        # Teacher prediction and features
+        with torch.no_grad(), self.autocast():
+            teacher_prediction = self.teacher(inputs)
+        teacher_prediction = teacher_prediction.float()
+
+        # Student prediction and features
+        with self.autocast():
+            prediction = self.generator(inputs)
+        prediction = prediction.float()
+
+        with torch.autocast(device_type=self.device.type, enabled=False):
+            # Output and feature distillation losses
+            output_loss = F.l1_loss(prediction, teacher_prediction)
+            feature_loss = sum(
+                F.mse_loss(adapter(self.student_features[n].float()), self.teacher_features[n].float())
+                for n, adapter in enumerate(self.adapters)
+            ) / len(self.adapters)
+
+            # Weakly supervised loss against the Landsat LST, as in Experiment
+            prediction_interpolated = self.degrade(prediction, LST_landsat_t2.shape[-2:])
+            task_loss = (F.l1_loss(prediction_interpolated, LST_landsat_t2) * self.b +
+                         (1.0 - self.msssim(prediction_interpolated, LST_landsat_t2, val_range=self.ssim_val_range)) * self.d +
+                         (1.0 - torch.mean(F.cosine_similarity(prediction_interpolated, LST_landsat_t2, 1))) * self.c)
+
+            loss = output_loss * self.kd_output + feature_loss * self.kd_feature + task_loss * self.kd_task
+
+        self.g_optimizer.zero_grad()
+        self.adapter_optimizer.zero_grad()
+        self.g_scaler.scale(loss).backward()
+        self.g_scaler.step(self.g_optimizer)
+        self.g_scaler.step(self.adapter_optimizer)
+        self.g_scaler.update()
+
+        mse = F.mse_loss(prediction_interpolated.detach(), LST_landsat_t2)
+        return loss.detach(), loss.new_zeros(()), mse
+
+    @torch.no_grad()
+    def compare_with_teacher(self, data_dir, patch_size, patch_stride=None, batch_size=32, num_workers=0):
+        """
+        Compares the speed and the error of the student with the teacher's on PatchSet data.
+        The report is logged and written to `distill_report.csv` in save_dir.
+
+        Returns:
+            list of dict: One row for the teacher and one for the student.
+        """
+        self.generator.eval()
+        data_set = PatchSet(data_dir, self.image_size, patch_size, patch_stride)
+        data_loader = DataLoader(data_set, batch_size=batch_size, num_workers=num_workers)
+
+        models = {'teacher': (self.teacher, self.teacher_channels), 'student': (self.generator, self.channels)}
+        times = {name: 0.0 for name in models}
+        errors = {name: AverageMeter() for name in models}
+        gap = AverageMeter()  # MSE between the student and teacher 10 m predictions
+
+        for images, _ in data_loader:
+            images = [im.to(self.device) for im in images]
+            inputs, target = images[:-1], images[-1:]
+            LST_landsat_t2 = target[0][:, :1, :, :]
+
+            predictions = {}
+            for name, (model, _) in models.items():
+                if self.device.type == 'cuda':
+                    torch.cuda.synchronize(self.device)
+                t_start = timer()
+                with self.autocast():
+                    predictions[name] = model(inputs).float()
+                if self.device.type == 'cuda':
+                    torch.cuda.synchronize(self.device)
+                times[name] += timer() - t_start
+
+                prediction_interpolated = self.degrade(predictions[name], LST_landsat_t2.shape[-2:])
+                errors[name].update(F.mse_loss(prediction_interpolated, LST_landsat_t2).item(), n=len(LST_landsat_t2))
+            gap.update(F.mse_loss(predictions['student'], predictions['teacher']).item(), n=len(LST_landsat_t2))
+
+        rows = []
+        for name, (model, channels) in models.items():
+            rows.append({'model': name,
+                         'channels': channels,
+                         'parameters': sum(p.numel() for p in model.parameters()),
+                         'samples_per_sec': len(data_set) / times[name],
+                         'mse': errors[name].avg})
+        speedup = rows[1]['samples_per_sec'] / rows[0]['samples_per_sec']
+
+        for row in rows:
+            self.logger.info(f"{row['model']}: channels {row['channels']}, {row['parameters']} parameters, "
+                             f"{row['samples_per_sec']:.1f} samples/s, MSE {row['mse']:.4f}")
+        self.logger.info(f'Student speedup: {speedup:.2f}x, student-teacher MSE: {gap.avg:.4f}')
+
+        report = self.save_dir / 'distill_report.csv'
+        csv_header = ['model', 'channels', 'parameters', 'samples_per_sec', 'mse']
+        for row in rows:
+            log_csv(report, [row[key] for key in csv_header], header=csv_header)
+        return rows
@@ -0,0 +1,232 @@
+import copy
+import csv
+import os
+import types
+from timeit import default_timer as timer
+
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.distributed.nn
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader
+
+import sys
+sys.path.append(os.path.abspath('..'))  # go up to root directory
+
+from runner.experiment import Experiment
+from data_loader.data import ResumableSampler
+from runner.benchmark import synthetic_batch, synchronize
+from data_loader.utils import get_logger, unwrap_model
+
+
+class DistributedBatchNorm2d(nn.BatchNorm2d):
+    """
+    BatchNorm2d whose training statistics are computed over the batches of all distributed ranks.
+
+    nn.SyncBatchNorm only runs on GPUs; this version reduces the per-channel sums with the
+    differentiable torch.distributed.nn.all_reduce, so it also works with the gloo backend on CPU.
+    Outside of a process group (or in eval mode) it behaves as nn.BatchNorm2d.
+    """
+
+    def forward(self, input):
+        if not (self.training and dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1):
+            return super(DistributedBatchNorm2d, self).forward(input)
+
+        channels = input.size(1)
+        dims = [0, 2, 3]
+        count = input.new_full((1,), input.numel() / channels)
+        stats = torch.cat((input.sum(dims), (input * input).sum(dims), count))
+        stats = torch.distributed.nn.all_reduce(stats)
+
+        total = stats[-1]
+        mean = stats[:channels] / total
+        var = stats[channels:2 * channels] / total - mean * mean
+
+        if self.track_running_stats:
+            with torch.no_grad():
+                self.num_batches_tracked += 1
+                momentum = self.momentum if self.momentum is not None else 1.0 / float(self.num_batches_tracked)
+                self.running_mean.lerp_(mean.detach(), momentum)
+                self.running_var.lerp_(var.detach() * total / (total - 1), momentum)
+
+        shape = (1, channels, 1, 1)
+        output = (input - mean.view(shape)) * torch.rsqrt(var.view(shape) + self.eps)
+        if self.affine:
+            output = output * self.weight.view(shape) + self.bias.view(shape)
+        return output
+
+    @classmethod
+    def convert(cls, module):
+        """
+        Replaces the BatchNorm2d layers of `module` (recursively). Parameters and buffers are reused, not copied,
+        so optimizers built on the original module keep updating the same tensors.
+        """
+        output = module
+        if type(module) is nn.BatchNorm2d:
+            output = cls(module.num_features, module.eps, module.momentum, module.affine, module.track_running_stats)
+            if module.affine:
+                output.weight = module.weight
+                output.bias = module.bias
+            output.running_mean = module.running_mean
+            output.running_var = module.running_var
+            output.num_batches_tracked = module.num_batches_tracked
+            output.train(module.training)
+        for name, child in module.named_children():
+            output.add_module(name, cls.convert(child))
+        return output
+
+
+class DistributedExperiment(Experiment):
+    """
+    Experiment trained with DistributedDataParallel, one process per rank.
+
+    Every rank trains on its own shard of the PatchSet (ResumableSampler), the BatchNorm layers of the
+    SignificanceExtraction modules are synchronized across ranks, and only rank 0 writes the history,
+    timings, traces and checkpoints. Uses NCCL with one GPU per rank when CUDA is available, gloo on CPU.
+    `batch_size` is the per-rank batch size. Start it with `launch`.
+    """
+
+    def __init__(self, option):
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        self.local_rank = int(os.environ.get('LOCAL_RANK', self.rank))
+        if torch.cuda.is_available():
+            torch.cuda.set_device(self.local_rank)
+
+        option = copy.copy(option)
+        option.ngpu = 1  # one device per process, DataParallel is not used
+        super(DistributedExperiment, self).__init__(option)
+        self.is_main = self.rank == 0
+
+        # Synchronized BatchNorm in the significance modules (the parameters are shared with the optimizer)
+        generator = unwrap_model(self.generator)
+        if self.device.type == 'cuda':
+            generator.SignE_List = nn.SyncBatchNorm.convert_sync_batchnorm(generator.SignE_List)
+        else:
+            generator.SignE_List = DistributedBatchNorm2d.convert(generator.SignE_List)
+
+        device_ids = [self.local_rank] if self.device.type == 'cuda' else None
+        self.generator = DistributedDataParallel(self.generator, device_ids=device_ids)
+        # The discriminator runs on the real and the fake pairs before each backward: broadcasting its
+        # BatchNorm buffers at every forward would modify in place tensors saved for that backward
+        self.nlayerdiscriminator = DistributedDataParallel(self.nlayerdiscriminator, device_ids=device_ids,
+                                                           broadcast_buffers=False)
+
+        if self.is_main:
+            self.logger.info(f'Distributed training on {self.world_size} processes ({dist.get_backend()} backend).')
+
+    def make_loader(self, train_set, batch_size):
+        # The same seeded order on every rank, sharded; Experiment.train_on_epoch sets its epoch
+        sampler = ResumableSampler(train_set, seed=self.seed, num_replicas=self.world_size, rank=self.rank)
+        return DataLoader(train_set, batch_size=batch_size, sampler=sampler,
+                          num_workers=1, drop_last=True, pin_memory=self.device.type == 'cuda')
+
+    def train(self, *args, **kwargs):
+        super(DistributedExperiment, self).train(*args, **kwargs)
+        dist.barrier()  # the checkpoints of rank 0 are on disk when every rank returns
+
+
+def init_process(rank, world_size):
+    """Joins the process group, from the torchrun environment or from the rank given by `launch`."""
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29500')
+    backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+
+
+def train_worker(rank, world_size, option, kwargs):
+    init_process(rank, world_size)
+    try:
+        experiment = DistributedExperiment(option)
+        experiment.train(option.train_dir, option.patch_size, option.patch_stride, option.batch_size, **kwargs)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(option, world_size=None, **kwargs):
+    """
+    Trains a DistributedExperiment.
+
+    Under torchrun (RANK and WORLD_SIZE in the environment, single or multiple nodes) the current process
+    becomes its rank. Otherwise `world_size` processes are spawned on this host (default: one per GPU,
+    or 2 on CPU).
+
+    Args:
+        option: Experiment options (see tutorials/04.py); option.batch_size is the per-rank batch size.
+        kwargs: Arguments of Experiment.train (epochs, resume, profile).
+    """
+    # Plain attributes, so that options defined in a script can be pickled to the spawned processes
+    option = types.SimpleNamespace(**vars(option))
+    if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
+        train_worker(int(os.environ['RANK']), int(os.environ['WORLD_SIZE']), option, kwargs)
+        return
+    world_size = world_size or (torch.cuda.device_count() if torch.cuda.is_available() else 2)
+    mp.spawn(train_worker, args=(world_size, option, kwargs), nprocs=world_size, join=True)
+
+
+def scaling_worker(rank, world_size, option, batch_size, patch_size, steps, warmup, results):
+    init_process(rank, world_size)
+    try:
+        if not torch.cuda.is_available():
+            # Share the host cores between the ranks instead of oversubscribing them
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+        experiment = DistributedExperiment(option)
+        inputs, target = synthetic_batch(batch_size, patch_size, experiment.device)
+        experiment.generator.train()
+        experiment.nlayerdiscriminator.train()
+
+        for _ in range(warmup):
+            experiment.train_step(inputs, target)
+        synchronize(experiment.device)
+        dist.barrier()
+        t_start = timer()
+        for _ in range(steps):
+            experiment.train_step(inputs, target)
+        synchronize(experiment.device)
+        dist.barrier()
+        step_time = (timer() - t_start) / steps
+
+        if rank == 0:
+            results.put(step_time)
+    finally:
+        dist.destroy_process_group()
+
+
+def benchmark_scaling(option, max_processes, batch_size, patch_size, steps=10, warmup=2, out_path=None):
+    """
+    Weak-scaling benchmark of DDP training steps on one host, from 1 to `max_processes` processes.
+
+    Every rank trains on synthetic batches of `batch_size` patches, so the global batch grows with the
+    number of processes. Results are logged and written to `scaling.csv` in save_dir.
+
+    Returns:
+        list of dict: Step time, global samples/sec, speedup and efficiency per number of processes.
+    """
+    logger = get_logger()
+    option = types.SimpleNamespace(**vars(option))
+    context = mp.get_context('spawn')
+    rows = []
+    for world_size in range(1, max_processes + 1):
+        results = context.SimpleQueue()
+        os.environ['MASTER_PORT'] = str(29500 + world_size)
+        mp.spawn(scaling_worker, args=(world_size, option, batch_size, patch_size, steps, warmup, results),
+                 nprocs=world_size, join=True)
+        step_time = results.get()
+        rows.append({'processes': world_size, 'step_time': step_time,
+                     'samples_per_sec': world_size * batch_size / step_time})
+
+    for row in rows:
+        row['speedup'] = row['samples_per_sec'] / rows[0]['samples_per_sec']
+        row['efficiency'] = row['speedup'] / row['processes']
+        logger.info(f"{row['processes']} processes: {row['step_time']:.4f}s/step, "
+                    f"{row['samples_per_sec']:.1f} samples/s, speedup {row['speedup']:.2f}x, "
+                    f"efficiency {row['efficiency']:.0%}")
+
+    out_path = out_path or option.save_dir / 'scaling.csv'
+    with open(out_path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    return rows
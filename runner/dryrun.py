@@ -0,0 +1,266 @@
+import argparse
+import json
+import math
+import types
+from pathlib import Path
+from timeit import default_timer as timer
+
+import numpy as np
+import torch
+
+import sys
+import os
+sys.path.append(os.path.abspath('..'))  # go up to root directory
+
+from runner.experiment import Experiment
+from runner.autotune import static_memory_bytes
+from runner.benchmark import measure_train_step, synthetic_batch, synchronize
+from runner.profiler import LayerProfiler
+from data_loader.data import PatchSet
+from data_loader.utils import make_tuple, get_logger
+
+
+def count_pairs(image_dir):
+    """Number of image pair directories in `image_dir`, None if it does not exist."""
+    if image_dir is None or not Path(image_dir).is_dir():
+        return None
+    return len([p for p in Path(image_dir).glob('*') if p.is_dir()])
+
+
+def epoch_samples(option, num_pairs, patch_size, patch_stride):
+    """Samples of a training epoch, as counted by PatchSet (or TileSet with option.tile_size)."""
+    tile_size = getattr(option, 'tile_size', None)
+    image_size = option.image_size
+    if tile_size:
+        tile_size = make_tuple(tile_size)
+        coverage = getattr(option, 'coverage', 1.0)
+        return num_pairs * math.ceil(coverage * image_size[0] * image_size[1] / (tile_size[0] * tile_size[1]))
+    patch_size = make_tuple(patch_size)
+    patch_stride = make_tuple(patch_stride)
+    num_patches_x, num_patches_y = PatchSet.grid(image_size, patch_size, patch_stride)
+    return num_pairs * num_patches_x * num_patches_y
+
+
+@torch.no_grad()
+def model_flops(experiment, patch_size):
+    """
+    Forward FLOPs per sample of the generator and of the discriminator (see LayerProfiler).
+
+    Returns:
+        dict: 'generator' and 'discriminator' FLOPs for one patch of `patch_size`.
+    """
+    inputs, target = synthetic_batch(1, patch_size, experiment.device)
+    experiment.generator.eval()
+    experiment.nlayerdiscriminator.eval()
+    flops = {}
+
+    profiler = LayerProfiler(experiment.generator, experiment.device)
+    with profiler:
+        experiment.generator(inputs)
+    flops['generator'] = profiler.rows()[0]['flops']
+
+    fake = torch.cat((target[0][:, :1], target[0][:, :1]), dim=1)
+    profiler = LayerProfiler(experiment.nlayerdiscriminator, experiment.device)
+    with profiler:
+        experiment.nlayerdiscriminator(fake)
+    flops['discriminator'] = profiler.rows()[0]['flops']
+    return flops
+
+
+def train_step_flops(experiment, flops):
+    """
+    Approximate FLOPs of a training step per sample, counting a backward pass as twice its forward:
+    one generator forward without gradients (unless single_forward) and one with backward, two
+    discriminator forwards with backward in the discriminator update and one in the generator update.
+    """
+    g_forwards = 3 if experiment.single_forward else 4
+    return g_forwards * flops['generator'] + 9 * flops['discriminator']
+
+
+def time_data_loading(experiment, train_dir, patch_size, patch_stride, batch_size, batches=5):
+    """Seconds to load a training batch with the DataLoader of Experiment.train, None without training data."""
+    if count_pairs(train_dir) is None:
+        return None
+    train_set = experiment.make_dataset(train_dir, patch_size, patch_stride)
+    if len(train_set) < 2 * batch_size:
+        return None
+    loader = iter(experiment.make_loader(train_set, batch_size))
+    next(loader)  # worker start-up
+    n = 0
+    t_start = timer()
+    for _ in range(batches):
+        try:
+            next(loader)
+        except StopIteration:
+            break
+        n += 1
+    return (timer() - t_start) / n if n else None
+
+
+@torch.no_grad()
+def time_test_patch(experiment, patch_size, steps=5, warmup=2):
+    """Seconds per patch of the test loop: generator forward, blur and copy to the host (batch of 1)."""
+    inputs, _ = synthetic_batch(1, patch_size, experiment.device)
+    experiment.generator.eval()
+    for _ in range(warmup):
+        experiment.degradation.blur(experiment.generator(inputs)).cpu()
+    synchronize(experiment.device)
+    t_start = timer()
+    for _ in range(steps):
+        experiment.degradation.blur(experiment.generator(inputs)).cpu().numpy()
+    return (timer() - t_start) / steps
+
+
+def time_stitching(image_size, patch_size, patch_stride):
+    """Seconds to accumulate the overlapping 10 m patches of one test image, as in Experiment.test."""
+    rows = int((image_size[1] - patch_size[1]) / patch_stride[1]) + 1
+    cols = int((image_size[0] - patch_size[0]) / patch_stride[0]) + 1
+    scaled_patch_size = tuple(i * 3 for i in patch_size)
+    scaled_image_size = tuple(i * 3 for i in image_size)
+    patch = np.random.rand(1, *scaled_patch_size).astype(np.float32)
+
+    t_start = timer()
+    sum_buffer = np.zeros((1, *scaled_image_size), dtype=np.float32)
+    weight_buffer = np.zeros((1, *scaled_image_size), dtype=np.float32)
+    for i in range(rows):
+        row_start = i * patch_stride[1] * 3
+        for j in range(cols):
+            col_start = j * patch_stride[0] * 3
+            sum_buffer[:, col_start:col_start + scaled_patch_size[0], row_start:row_start + scaled_patch_size[1]] += patch
+            weight_buffer[:, col_start:col_start + scaled_patch_size[0], row_start:row_start + scaled_patch_size[1]] += 1
+    np.divide(sum_buffer, weight_buffer)
+    return timer() - t_start
+
+
+def dry_run(option, num_pairs=None, num_test_pairs=None, epochs=None, steps=5, warmup=2):
+    """
+    Estimates the cost of a training and test run of `option` on this machine without training.
+
+    The sample count of an epoch is computed exactly as PatchSet (or TileSet) does, the FLOPs per sample
+    are counted with LayerProfiler, and a few training steps on synthetic batches are timed. Data loading
+    is timed on option.train_dir when it exists and overlaps with the steps (one DataLoader worker).
+    The test estimate covers the overlapped patches of Experiment.test (stride 8) and their stitching,
+    not the writing of the GeoTIFFs.
+
+    Args:
+        option: Experiment options (see tutorials/04.py).
+        num_pairs (int): Training pairs (default: counted in option.train_dir).
+        num_test_pairs (int): Test pairs (default: counted in option.test_dir, or 1).
+        epochs (int): Training epochs (default option.epochs).
+        steps (int): Timed training steps.
+
+    Returns:
+        dict: The estimates, also logged and written to `dryrun.json` in save_dir.
+    """
+    logger = get_logger()
+    experiment = Experiment(option)
+    device = experiment.device
+
+    patch_size = make_tuple(getattr(option, 'tile_size', None) or option.patch_size)
+    patch_stride = make_tuple(getattr(option, 'patch_stride', None) or patch_size)  # PatchSet needs an explicit stride
+    batch_size = option.batch_size
+    epochs = epochs or getattr(option, 'epochs', 1)
+    num_pairs = num_pairs or count_pairs(getattr(option, 'train_dir', None))
+    if num_pairs is None:
+        raise ValueError('num_pairs is needed when option.train_dir does not exist')
+    num_test_pairs = num_test_pairs or count_pairs(getattr(option, 'test_dir', None)) or 1
+
+    samples = epoch_samples(option, num_pairs, patch_size, patch_stride)
+    steps_per_epoch = samples // batch_size
+
+    flops = model_flops(experiment, patch_size)
+    step_flops = train_step_flops(experiment, flops) * batch_size
+
+    result = measure_train_step(experiment, batch_size, patch_size, steps=steps, warmup=warmup)
+    step_time = result['step_time']
+    peak_memory = result['peak_memory']
+    if peak_memory is None:
+        peak_memory = result['activation_bytes'] + static_memory_bytes(experiment)
+
+    data_time = time_data_loading(experiment, getattr(option, 'train_dir', None), patch_size, patch_stride, batch_size)
+    epoch_time = steps_per_epoch * max(step_time, data_time or 0.0)
+
+    test_patch = make_tuple(getattr(option, 'test_patch', 32))
+    test_stride = (8, 8)  # fixed in Experiment.test
+    rows = int((option.image_size[1] - test_patch[1]) / test_stride[1]) + 1
+    cols = int((option.image_size[0] - test_patch[0]) / test_stride[0]) + 1
+    patch_time = time_test_patch(experiment, test_patch)
+    stitch_time = time_stitching(option.image_size, test_patch, test_stride)
+    test_image_time = rows * cols * patch_time + stitch_time
+
+    estimate = {
+        'device': str(device),
+        'num_pairs': num_pairs,
+        'samples_per_epoch': samples,
+        'steps_per_epoch': steps_per_epoch,
+        'batch_size': batch_size,
+        'patch_size': list(patch_size),
+        'generator_flops_per_sample': flops['generator'],
+        'discriminator_flops_per_sample': flops['discriminator'],
+        'train_flops_per_step': step_flops,
+        'step_time': step_time,
+        'data_time': data_time,
+        'achieved_flops_per_sec': step_flops / step_time,
+        'peak_memory': peak_memory,
+        'epoch_time': epoch_time,
+        'epochs': epochs,
+        'total_time': epochs * epoch_time,
+        'test_patches_per_image': rows * cols,
+        'test_redundancy': rows * cols * test_patch[0] * test_patch[1] / (option.image_size[0] * option.image_size[1]),
+        'test_patch_time': patch_time,
+        'test_stitch_time': stitch_time,
+        'test_image_time': test_image_time,
+        'test_pairs': num_test_pairs,
+        'test_time': num_test_pairs * test_image_time,
+    }
+
+    logger.info(f"Dry run on {device}: {samples} samples per epoch ({num_pairs} pairs, patch {list(patch_size)}), "
+                f"{steps_per_epoch} steps of batch {batch_size}")
+    logger.info(f"Generator {flops['generator'] / 1e9:.3f} GFLOPs and discriminator "
+                f"{flops['discriminator'] / 1e9:.3f} GFLOPs per sample (forward), "
+                f"{step_flops / step_time / 1e12:.2f} TFLOP/s achieved")
+    logger.info(f"Step {step_time:.4f}s" + (f", data {data_time:.4f}s per batch" if data_time is not None else '') +
+                f", peak memory {peak_memory / 2**20:.0f} MB")
+    logger.info(f"Epoch {epoch_time / 60:.1f} min, {epochs} epochs {epochs * epoch_time / 3600:.2f} h")
+    logger.info(f"Test: {rows * cols} patches per image (each pixel computed {estimate['test_redundancy']:.1f} times), "
+                f"{test_image_time:.1f}s per image of which {stitch_time:.2f}s stitching, "
+                f"{num_test_pairs * test_image_time / 60:.1f} min for {num_test_pairs} pairs")
+
+    with open(experiment.save_dir / 'dryrun.json', 'w') as file:
+        json.dump(estimate, file, indent=2)
+    return estimate
+
+
+def parse_options(argv=None):
+    """Command-line options, with the defaults of tutorials/04.py."""
+    parser = argparse.ArgumentParser(description='Estimates the time and memory of a WGAST training and test run.')
+    parser.add_argument('--save_dir', type=Path, default=Path('./data/Tdivision'))
+    parser.add_argument('--train_dir', type=Path, default=None, help='default: <save_dir>/train')
+    parser.add_argument('--test_dir', type=Path, default=None, help='default: <save_dir>/test')
+    parser.add_argument('--image_size', type=int, nargs=2, default=[400, 400])
+    parser.add_argument('--patch_size', type=int, nargs=2, default=[32, 32])
+    parser.add_argument('--patch_stride', type=int, default=8)
+    parser.add_argument('--tile_size', type=int, nargs=2, default=None)
+    parser.add_argument('--test_patch', type=int, default=32)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--accumulation_steps', type=int, default=1)
+    parser.add_argument('--epochs', type=int, default=110)
+    parser.add_argument('--num_pairs', type=int, default=None, help='default: counted in train_dir')
+    parser.add_argument('--num_test_pairs', type=int, default=None, help='default: counted in test_dir')
+    parser.add_argument('--steps', type=int, default=5, help='timed training steps')
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument('--cpu', action='store_true')
+    args = parser.parse_args(argv)
+
+    option = types.SimpleNamespace(
+        lr=2e-4, cuda=not args.cpu, ngpu=1, a=1e-2, b=1, c=1, d=1,
+        ifAdaIN=True, ifAttention=True, ifTwoInput=False, **{key: value for key, value in vars(args).items()
+                                                            if key not in ('cpu', 'num_pairs', 'num_test_pairs', 'steps')})
+    option.train_dir = option.train_dir or option.save_dir / 'train'
+    option.test_dir = option.test_dir or option.save_dir / 'test'
+    return option, args
+
+
+if __name__ == '__main__':
+    option, args = parse_options()
+    dry_run(option, num_pairs=args.num_pairs, num_test_pairs=args.num_test_pairs, epochs=args.epochs, steps=args.steps)
@@ -3,17 +3,22 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from torch.utils.data import DataLoader
+import torch.profiler
+from torch.profiler import record_function
 
 import sys
 import os
 sys.path.append(os.path.abspath('..'))  # go up to root directory (work on this)
 
 from model.WGAST import *
-from data_loader.data import PatchSet, get_pair_path_with_masks
+from data_loader.data import PatchSet, TileSet, ResumableSampler, get_pair_path_with_masks, load_scenes
 from data_loader.utils import *
+from runner.curriculum import CurriculumScheduler
+from runner.convergence import ConvergenceMonitor, make_lr_lambda
 
 
-import shutil
+import signal
+import threading
 from timeit import default_timer as timer
 from datetime import datetime
 import numpy as np
@@ -54,7 +59,7 @@ def ssim(img1, img2, window_size=11, window=None, size_average=True, full=False,
     (_, channel, height, width) = img1.size()
     if window is None:
         real_size = min(window_size, height, width)
-        window = create_window(real_size, channel=channel).to(img1.device)
+        window = create_window(real_size, channel=channel).to(img1.device, img1.dtype)
 
     mu1 = F.conv2d(img1, window, padding=padd, groups=channel)
     mu2 = F.conv2d(img2, window, padding=padd, groups=channel)
@@ -85,14 +90,27 @@ def ssim(img1, img2, window_size=11, window=None, size_average=True, full=False,
         return ret, cs
     return ret
 
-def msssim(img1, img2, window_size=11, size_average=True, val_range=None, normalize=False):
+MSSSIM_WEIGHTS = [0.0448, 0.2856, 0.3001, 0.2363, 0.1333]
+
+
+def msssim(img1, img2, window_size=11, size_average=True, val_range=None, normalize=False, buffers=None):
+    # With a BufferRegistry, the weights and the window of every level are only built once
     device = img1.device
-    weights = torch.FloatTensor([0.0448, 0.2856, 0.3001, 0.2363, 0.1333]).to(device)
+    if buffers is None:
+        weights = torch.FloatTensor(MSSSIM_WEIGHTS).to(device)
+    else:
+        weights = buffers.get('msssim_weights', lambda: torch.FloatTensor(MSSSIM_WEIGHTS), device)
     levels = weights.size()[0]
     mssim = []
     mcs = []
     for _ in range(levels):
-        sim, cs = ssim(img1, img2, window_size=window_size, size_average=size_average,
+        window = None
+        if buffers is not None:
+            (_, channel, height, width) = img1.size()
+            real_size = min(window_size, height, width)
+            window = buffers.get(f'ssim_window_{real_size}_{channel}', lambda: create_window(real_size, channel=channel),
+                                 device, img1.dtype)
+        sim, cs = ssim(img1, img2, window_size=window_size, window=window, size_average=size_average,
                        full=True, val_range=val_range)
         mssim.append(sim)
         mcs.append(cs)
@@ -114,6 +132,109 @@ def msssim(img1, img2, window_size=11, size_average=True, val_range=None, normal
     output = torch.prod(pow1[:-1] * pow2[-1])
     return output
 
+class MSSSIM(nn.Module):
+    """
+    Batched multi-scale SSIM, equivalent to `msssim` (with size_average=True) up to rounding (see check_msssim).
+
+    At every level the five moment maps (mu1, mu2, E[x^2], E[y^2], E[xy]) come from a single grouped
+    convolution of the stacked [x, y, x*x, y*y, x*y] tensor, and the dynamic range is either given
+    (`val_range`) or inferred on the device, so that no host synchronization is needed. The average-pooling
+    pyramid of the second image can be computed once with `pyramid` and passed to several calls.
+    """
+
+    def __init__(self, window_size=11, normalize=False):
+        super(MSSSIM, self).__init__()
+        self.window_size = window_size
+        self.normalize = normalize
+        self.levels = len(MSSSIM_WEIGHTS)
+        self.register_buffer('weights', torch.tensor(MSSSIM_WEIGHTS))
+        self.registry = BufferRegistry()  # One stacked window per (level size, channels)
+
+    def pyramid(self, img):
+        """Average pooling pyramid of an image, one entry per level."""
+        levels = [img]
+        for _ in range(self.levels - 1):
+            levels.append(F.avg_pool2d(levels[-1], (2, 2)))
+        return levels
+
+    @staticmethod
+    def dynamic_range(img):
+        """Same rule as `ssim` (255 or 1 for the maximum, -1 or 0 for the minimum), evaluated on the device."""
+        max_val = torch.where(img.max() > 128, 255.0, 1.0)
+        min_val = torch.where(img.min() < -0.5, -1.0, 0.0)
+        return (max_val - min_val).to(img.dtype)
+
+    def ssim(self, img1, img2, val_range=None):
+        (_, channel, height, width) = img1.size()
+        real_size = min(self.window_size, height, width)
+        window = self.registry.get(f'ssim_window_{real_size}_{channel * 5}',
+                                   lambda: create_window(real_size, channel=channel * 5), img1.device, img1.dtype)
+
+        L = self.dynamic_range(img1) if val_range is None else val_range
+
+        stacked = torch.cat((img1, img2, img1 * img1, img2 * img2, img1 * img2), dim=1)
+        moments = F.conv2d(stacked, window, groups=channel * 5)
+        mu1, mu2, e11, e22, e12 = moments.split(channel, dim=1)
+
+        mu1_sq = mu1.pow(2)
+        mu2_sq = mu2.pow(2)
+        mu1_mu2 = mu1 * mu2
+        sigma1_sq = e11 - mu1_sq
+        sigma2_sq = e22 - mu2_sq
+        sigma12 = e12 - mu1_mu2
+
+        C1 = (0.01 * L) ** 2
+        C2 = (0.03 * L) ** 2
+
+        v1 = 2.0 * sigma12 + C2
+        v2 = sigma1_sq + sigma2_sq + C2
+        cs = torch.mean(v1 / v2)  # contrast sensitivity
+
+        ssim_map = ((2 * mu1_mu2 + C1) * v1) / ((mu1_sq + mu2_sq + C1) * v2)
+        return ssim_map.mean(), cs
+
+    def forward(self, img1, img2, val_range=None, pyramid2=None):
+        """
+        Args:
+            img1, img2 (torch.Tensor): Images of shape [B, C, H, W].
+            val_range (float or torch.Tensor): Dynamic range, inferred from img1 at every level if None.
+            pyramid2 (list of torch.Tensor): Precomputed `pyramid(img2)`.
+        """
+        pyramid2 = pyramid2 or self.pyramid(img2)
+        mssim = []
+        mcs = []
+        for level in range(self.levels):
+            sim, cs = self.ssim(img1, pyramid2[level], val_range=val_range)
+            mssim.append(sim)
+            mcs.append(cs)
+            if level < self.levels - 1:
+                img1 = F.avg_pool2d(img1, (2, 2))
+
+        mssim = torch.stack(mssim)
+        mcs = torch.stack(mcs)
+
+        # Normalize (to avoid NaNs during training unstable models,
+        # not compliant with original definition)
+        if self.normalize:
+            mssim = (mssim + 1) / 2
+            mcs = (mcs + 1) / 2
+
+        pow1 = mcs ** self.weights
+        pow2 = mssim ** self.weights
+        return torch.prod(pow1[:-1] * pow2[-1])
+
+
+def numpy_rng_state():
+    """NumPy RNG state with its key array as a tensor, so that snapshots only hold tensors and plain values."""
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian)
+
+
+def set_numpy_rng_state(state):
+    name, keys, pos, has_gauss, cached_gaussian = state
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+
+
 class Experiment(object):
     def __init__(self, option):
         # Set device to GPU if available, otherwise use CPU
@@ -122,6 +243,9 @@ class Experiment(object):
         # Set image size from options
         self.image_size = option.image_size
 
+        # Only the main process writes history, checkpoints and traces (see runner/distributed.py)
+        self.is_main = True
+
         # Create and manage directories for saving models and logs
         self.save_dir = option.save_dir
         self.save_dir.mkdir(parents=True, exist_ok=True)
@@ -134,10 +258,71 @@ class Experiment(object):
         self.last_g = self.train_dir / 'generator.pth'
         self.last_pd = self.train_dir / 'nlayerdiscriminator.pth'
 
+        # Numerical precision: 'fp32', or mixed precision with 'bf16' / 'fp16' autocast
+        self.precision = getattr(option, 'precision', 'fp32')
+        if self.precision not in ('fp32', 'bf16', 'fp16'):
+            raise ValueError(f"Unknown precision '{self.precision}', expected 'fp32', 'bf16' or 'fp16'")
+        self.use_amp = self.precision != 'fp32'
+        # CPU autocast only supports bfloat16; accelerators can use float16 or bfloat16
+        if self.precision == 'fp16' and self.device.type != 'cpu':
+            self.amp_dtype = torch.float16
+        else:
+            self.amp_dtype = torch.bfloat16
+
         # Model configuration flags
         self.ifAdaIN = option.ifAdaIN  # Whether to use Adaptive Instance Normalization
         self.ifAttention = option.ifAttention  # Whether to use Attention Mechanism
         self.ifTwoInput = option.ifTwoInput  # Whether to use two input channels
+        self.ifCheckpoint = getattr(option, 'ifCheckpoint', False)  # Whether to checkpoint encoder/decoder activations
+        self.channels = tuple(getattr(option, 'channels', CHANNELS))  # Channel widths (and depth) of the encoder levels
+        self.ifFused = getattr(option, 'ifFused', False)  # Whether to use the fused AdaIN/similarity/blending ops
+        self.single_forward = getattr(option, 'single_forward', False)  # Reuse one generator forward per training step
+        self.log_interval = getattr(option, 'log_interval', 50)  # Steps between (lagged) progress bar updates
+        self.accumulation_steps = getattr(option, 'accumulation_steps', 1)  # Micro-batches per update (see runner/autotune.py)
+        self.tile_size = getattr(option, 'tile_size', None)  # Large-tile training mode (TileSet) instead of PatchSet patches
+        self.coverage = getattr(option, 'coverage', 1.0)  # Times each training pixel is covered per epoch in large-tile mode
+
+        # Progressive patch-size curriculum (list of stages, see runner/curriculum.py), disabled when None
+        self.curriculum = getattr(option, 'curriculum', None)
+        self.curriculum_patience = getattr(option, 'curriculum_patience', None)
+        self.curriculum_min_delta = getattr(option, 'curriculum_min_delta', 0.0)
+
+        # Per-stage timing of the training and test loops, written to timing.jsonl next to history.csv.
+        # It can be switched on and off at runtime with `experiment.stage_timer.enabled`
+        self.stage_timer = StageTimer(self.device, enabled=getattr(option, 'timing', False))
+        self.timing = self.train_dir / 'timing.jsonl'
+        self.trace = None  # torch.profiler window of the running train/test loop (see trace_window)
+
+        # Checkpoints are serialized on a background thread, keeping the last `keep_checkpoints` epochs (0: only the latest)
+        self.checkpoint_writer = CheckpointWriter(keep_last=getattr(option, 'keep_checkpoints', 0))
+
+        # Step-level snapshots to resume an interrupted epoch at the next batch (every `snapshot_interval`
+        # steps, 0 disables them) and to flush the training state on SIGTERM within `snapshot_deadline` seconds
+        self.snapshot = self.train_dir / 'snapshot.pth'
+        self.snapshot_interval = getattr(option, 'snapshot_interval', 0)
+        self.snapshot_deadline = getattr(option, 'snapshot_deadline', 30)
+        self.seed = getattr(option, 'seed', 2024)  # Seed of the shuffling order (see ResumableSampler)
+        self.preempted = None  # Time at which SIGTERM was received
+        self.resume_state = None
+
+        # Train on the derived layers precomputed per pair by data_preparation/DerivedInputs.py
+        # (upsampled Landsat t1, pooled MODIS t2) instead of recomputing them at every step
+        self.derived_inputs = getattr(option, 'derived_inputs', False)
+
+        # Learning rate schedule ('constant', 'cosine' or 'one_cycle', see runner/convergence.py) over
+        # `schedule_epochs` epochs (default: the epochs of the train call)
+        self.lr_schedule = getattr(option, 'lr_schedule', 'constant')
+        self.warmup_epochs = getattr(option, 'warmup_epochs', 0)
+        self.schedule_epochs = getattr(option, 'schedule_epochs', None)
+        self.min_lr_factor = getattr(option, 'min_lr_factor', 0.0)
+
+        # Early stop once train_g_error has not improved for `plateau_patience` epochs, and wall-clock time
+        # to reach `target_error`, written to convergence.json next to history.csv
+        self.plateau_patience = getattr(option, 'plateau_patience', None)
+        self.plateau_min_delta = getattr(option, 'plateau_min_delta', 0.0)
+        self.target_error = getattr(option, 'target_error', None)
+        self.stop_at_target = getattr(option, 'stop_at_target', False)
+        self.convergence = self.train_dir / 'convergence.json'
 
         self.a = option.a  # Custom parameter a
         self.b = option.b  # Custom parameter b
@@ -149,12 +334,24 @@ class Experiment(object):
         self.logger.info('Model initialization')
 
         # Initialize generator and discriminator models
-        self.generator = CombinFeatureGenerator(ifAdaIN=self.ifAdaIN, ifAttention=self.ifAttention, ifTwoInput=self.ifTwoInput).to(self.device)
+        self.generator = CombinFeatureGenerator(ifAdaIN=self.ifAdaIN, ifAttention=self.ifAttention, ifTwoInput=self.ifTwoInput,
+                                                ifCheckpoint=self.ifCheckpoint, channels=self.channels,
+                                                ifFused=self.ifFused).to(self.device)
         self.nlayerdiscriminator = NLayerDiscriminator(input_nc=2, getIntermFeat=True).to(self.device)
 
         # Define loss function for the discriminator
         self.pd_loss = GANLoss().to(self.device)
 
+        # Constant filters and windows of the loss path, built once per device and dtype
+        self.buffers = BufferRegistry().to(self.device)
+
+        # Blur + 3x3 average pooling from the 10 m prediction to the Landsat grid
+        self.degradation = Degradation(sigma=1.0, scale=3).to(self.device)
+
+        # Batched MS-SSIM loss, with an optional fixed dynamic range (inferred on the device otherwise)
+        self.msssim = MSSSIM(window_size=11, normalize=True).to(self.device)
+        self.ssim_val_range = getattr(option, 'ssim_val_range', None)
+
         # Handle multiple GPUs if available
         device_ids = [i for i in range(option.ngpu)]
         if option.cuda and option.ngpu > 1:
@@ -165,7 +362,12 @@ class Experiment(object):
         self.g_optimizer = optim.Adam(self.generator.parameters(), lr=option.lr)
         self.pd_optimizer = optim.Adam(self.nlayerdiscriminator.parameters(), lr=option.lr)
 
-        # Learning rate scheduler (currently fixed at 1.0)
+        # Gradient scalers for mixed precision on accelerators (no-ops when disabled)
+        use_scaler = self.use_amp and self.device.type == 'cuda'
+        self.g_scaler = torch.cuda.amp.GradScaler(enabled=use_scaler)
+        self.pd_scaler = torch.cuda.amp.GradScaler(enabled=use_scaler)
+
+        # Learning rate scheduler (fixed at 1.0 until train sets the schedule, see set_lr_schedule)
         def lambda_rule(epoch):
             lr_l = 1.0
             return lr_l
@@ -218,8 +420,9 @@ class Experiment(object):
             torch.Tensor: Blurred tensor of shape [B, C, H, W]
         """
         B, C, H, W = input_tensor.shape
-        kernel, kernel_size = self.gaussian_kernel(sigma=sigma, channels=C)
-        kernel = kernel.to(input_tensor.device)
+        kernel = self.buffers.get(f'gaussian_kernel_{sigma}_{C}', lambda: self.gaussian_kernel(sigma=sigma, channels=C)[0],
+                                  input_tensor.device, input_tensor.dtype)
+        kernel_size = kernel.shape[-1]
 
         padding = kernel_size // 2
         # Apply reflect padding manually (4 values: left, right, top, bottom)
@@ -229,151 +432,535 @@ class Experiment(object):
         output = F.conv2d(input_padded, kernel, groups=C, padding=0)
         return output
     
-    def train_on_epoch(self, n_epoch, data_loader):
-        # Adjust learning rates
-        self.g_scheduler.step()
-        self.pd_scheduler.step()
+    def degrade(self, prediction, size):
+        """
+        Degrades a 10 m prediction to the Landsat grid: Gaussian blur followed by 3x3 average pooling.
 
-        # Set models to training mode
-        self.generator.train()
-        self.nlayerdiscriminator.train()
+        Args:
+            prediction (torch.Tensor): Prediction of shape [B, C, 3h, 3w].
+            size (tuple): Spatial size (h, w) of the Landsat grid.
 
-        # Initialize loss trackers
-        epg_loss = AverageMeter()  # Tracks generator loss
-        eppd_loss = AverageMeter()  # Tracks discriminator loss
-        epg_error = AverageMeter()  # Tracks mean squared error (MSE)
-        # Log epoch start
-        self.logger.info(f'Epoch[{n_epoch}] - {datetime.now()}')
+        Returns:
+            torch.Tensor: Degraded prediction of shape [B, C, h, w].
+        """
+        prediction_interpolated = self.degradation(prediction)
+        if prediction_interpolated.shape[-2:] != size:
+            prediction_interpolated = F.interpolate(prediction_interpolated, size=size, mode='bicubic', align_corners=False)
+        return prediction_interpolated
 
-        # Iterate over the dataset
-        for idx, data in enumerate(tqdm(data_loader, desc="Processing")):            
+    def trace_window(self, window, phase):
+        """
+        Builds a torch.profiler recording a window of steps, with shapes, memory and stack traces.
+        The Chrome trace is written to `<phase>_trace.json` and the TensorBoard trace to `profile/<phase>` in save_dir.
 
-            # Load and move input data to device (GPU/CPU)
-            images, masks = data
-            images = [im.to(self.device) for im in images]
-            masks = [im.to(self.device) for im in masks]
+        Args:
+            window (tuple): (skip, warmup, active) numbers of steps, e.g. (20, 5, 10).
+            phase (str): 'train' or 'test'.
 
-            # Separate inputs and target
-            inputs, target = images[:-1], images[-1:]
-            
-            # ----------------------
-            # (1) Generate prediction
-            # ----------------------
-            prediction = self.generator(inputs)
+        Returns:
+            torch.profiler.profile: Profiler to start before the loop and step after every batch (None without a window).
+        """
+        if window is None or not self.is_main:
+            return None
+        skip, warmup, active = window
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.device.type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        tensorboard = torch.profiler.tensorboard_trace_handler(str(self.save_dir / 'profile' / phase))
+
+        def on_trace_ready(prof):
+            tensorboard(prof)
+            prof.export_chrome_trace(str(self.save_dir / f'{phase}_trace.json'))
+            self.logger.info(f'Wrote the {phase} profiler traces to {self.save_dir}')
+
+        return torch.profiler.profile(activities=activities,
+                                      schedule=torch.profiler.schedule(skip_first=skip, wait=0, warmup=warmup, active=active, repeat=1),
+                                      on_trace_ready=on_trace_ready, record_shapes=True, profile_memory=True, with_stack=True)
+
+    def autocast(self):
+        """
+        Returns the autocast context used for the forward passes of the training step.
+        It is disabled when training in float32.
+        """
+        return torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.use_amp)
 
-            # ----------------------
-            # (2) Weakly supervised learning
-            # ----------------------
-            LST_landsat_t2 = target[0][:, :1, :, :]
+    def generate(self, inputs, size):
+        """
+        Generator forward pass followed by the degradation of the prediction to the Landsat grid.
 
-            smoothed = self.apply_gaussian_blur(prediction.clone(), sigma=1.0)
-            prediction_interpolated = F.avg_pool2d(smoothed, kernel_size=3, stride=3)
-            if prediction_interpolated.shape != LST_landsat_t2.shape:
-                prediction_interpolated = F.interpolate(prediction_interpolated, size=LST_landsat_t2.shape[-2:], mode='bicubic', align_corners=False)
+        Returns:
+            torch.Tensor: Degraded prediction of spatial size `size`.
+        """
+        with record_function('generator_forward'), self.stage_timer.stage('g_forward'):
+            with self.autocast():
+                prediction = self.generator(inputs)
+            prediction = prediction.float()  # the degradation and losses run in float32
+            return self.degrade(prediction, size)
 
+    def loss_targets(self, inputs, target):
+        """
+        Returns:
+            tuple: Landsat t2 LST and MODIS t2 LST pooled to the Landsat grid, the references of the losses.
+            The pooled MODIS is taken from the inputs when they include the derived layers.
+        """
+        LST_landsat_t2 = target[0][:, :1, :, :]
+        if len(inputs) > 4:
+            return LST_landsat_t2, inputs[4]
 
-            LST_MODIS_t2_interpolated =F.avg_pool2d(inputs[3], kernel_size=3, stride=3)
-            if LST_MODIS_t2_interpolated.shape != LST_landsat_t2.shape:
-                LST_MODIS_t2_interpolated = F.interpolate(LST_MODIS_t2_interpolated, size=LST_landsat_t2.shape[-2:], mode='bicubic', align_corners=False)
+        LST_MODIS_t2_interpolated =F.avg_pool2d(inputs[3], kernel_size=3, stride=3)
+        if LST_MODIS_t2_interpolated.shape != LST_landsat_t2.shape:
+            LST_MODIS_t2_interpolated = F.interpolate(LST_MODIS_t2_interpolated, size=LST_landsat_t2.shape[-2:], mode='bicubic', align_corners=False)
+        return LST_landsat_t2, LST_MODIS_t2_interpolated
 
+    def discriminator_loss(self, prediction_interpolated, LST_landsat_t2, LST_MODIS_t2_interpolated):
+        """
+        Returns:
+            torch.Tensor: Discriminator loss on a (detached) degraded prediction and the real Landsat LST.
+        """
+        with self.stage_timer.stage('d_forward'), self.autocast():
             # Get discriminator outputs for fake and real images
-            pred_fake = self.nlayerdiscriminator(torch.cat((prediction_interpolated, LST_MODIS_t2_interpolated), dim=1))
+            pred_fake = self.nlayerdiscriminator(torch.cat((prediction_interpolated.detach(), LST_MODIS_t2_interpolated), dim=1))
             pred_real1 = self.nlayerdiscriminator(torch.cat((LST_landsat_t2, LST_MODIS_t2_interpolated), dim=1))
 
-            # ----------------------
-            # (3) Update Discriminator
-            # ----------------------
             # Compute discriminator loss
             pd_loss = (self.pd_loss(pred_fake, False) + self.pd_loss(pred_real1, True)) * 0.5
+        return pd_loss
 
-            # Backpropagate and update discriminator
-            self.pd_optimizer.zero_grad()
-            pd_loss.backward()
-            self.pd_optimizer.step()
-            torch.cuda.empty_cache() 
-
-            # Update loss tracker
-            eppd_loss.update(pd_loss.item())
-
-            # ----------------------
-            # (4) Update Generator
-            # ----------------------
-            prediction = self.generator(inputs)
-
-            smoothed = self.apply_gaussian_blur(prediction.clone(), sigma=1.0)
-            prediction_interpolated = F.avg_pool2d(smoothed, kernel_size=3, stride=3)
-            if prediction_interpolated.shape != LST_landsat_t2.shape:
-                prediction_interpolated = F.interpolate(prediction_interpolated, size=LST_landsat_t2.shape[-2:], mode='bicubic', align_corners=False)
+    def discriminator_step(self, prediction_interpolated, LST_landsat_t2, LST_MODIS_t2_interpolated):
+        """
+        Updates the discriminator on a (detached) degraded prediction and the real Landsat LST.
 
+        Returns:
+            torch.Tensor: Discriminator loss.
+        """
+        pd_loss = self.discriminator_loss(prediction_interpolated, LST_landsat_t2, LST_MODIS_t2_interpolated)
+
+        # Backpropagate and update discriminator
+        self.pd_optimizer.zero_grad()
+        with self.stage_timer.stage('backward'):
+            self.pd_scaler.scale(pd_loss).backward()
+        with self.stage_timer.stage('optimizer'):
+            self.pd_scaler.step(self.pd_optimizer)
+            self.pd_scaler.update()
+        return pd_loss
+
+    def generator_loss(self, prediction_interpolated, LST_landsat_t2, LST_MODIS_t2_interpolated):
+        """
+        Returns:
+            torch.Tensor: Adversarial and weakly supervised losses of a degraded prediction.
+        """
+        with self.stage_timer.stage('d_forward'), self.autocast():
             # Get discriminator outputs for fake and real images
             pred_fake = self.nlayerdiscriminator(torch.cat((prediction_interpolated, LST_MODIS_t2_interpolated), dim=1))
 
             # Compute adversarial loss
             loss_G_GAN = self.pd_loss(pred_fake, True) * self.a
 
-            # Compute L1 loss with additional perceptual losses
+        # Compute L1 loss with additional perceptual losses (MS-SSIM is kept in float32)
+        with self.stage_timer.stage('loss'), torch.autocast(device_type=self.device.type, enabled=False):
             loss_G_l1 = (F.l1_loss(prediction_interpolated, LST_landsat_t2) * self.b +
-                        (1.0 - msssim(prediction_interpolated, LST_landsat_t2, normalize=True)) * self.d +
+                        (1.0 - self.msssim(prediction_interpolated, LST_landsat_t2, val_range=self.ssim_val_range)) * self.d +
                         (1.0 - torch.mean(F.cosine_similarity(prediction_interpolated, LST_landsat_t2, 1))) * self.c)
 
-            # Total generator loss
-            g_loss = loss_G_l1 + loss_G_GAN
+        # Total generator loss
+        return loss_G_l1 + loss_G_GAN
+
+    def generator_step(self, prediction_interpolated, LST_landsat_t2, LST_MODIS_t2_interpolated):
+        """
+        Updates the generator from the adversarial and weakly supervised losses of a degraded prediction.
+
+        Returns:
+            torch.Tensor: Generator loss.
+        """
+        g_loss = self.generator_loss(prediction_interpolated, LST_landsat_t2, LST_MODIS_t2_interpolated)
+
+        # Backpropagate and update generator
+        self.g_optimizer.zero_grad()
+        with self.stage_timer.stage('backward'):
+            self.g_scaler.scale(g_loss).backward()
+        with self.stage_timer.stage('optimizer'):
+            self.g_scaler.step(self.g_optimizer)
+            self.g_scaler.update()
+        return g_loss
+
+    def train_step(self, inputs, target):
+        """
+        Runs one discriminator and one generator update on a batch.
+
+        By default the generator runs twice, once for the discriminator update and once for the generator
+        update. With option.single_forward the prediction of the first forward pass is reused: the
+        discriminator is updated on its detached copy, then the generator loss backpropagates through the
+        same graph. The generator weights are the same in both cases (the discriminator update does not
+        touch them) and the generator's adversarial loss still uses the updated discriminator. The only
+        differences are that the generator update sees the dropout masks and SignificanceExtraction batch
+        statistics of the first pass, and BatchNorm running statistics are updated once per step instead of twice.
+
+        Args:
+            inputs (list of torch.Tensor): MODIS t1, Landsat t1, Sentinel t1 and MODIS t2 patches.
+            target (list of torch.Tensor): Landsat t2 patch.
+
+        Returns:
+            tuple: generator loss, discriminator loss and MSE of the degraded prediction, as detached
+            tensors left on the device (reading them would synchronize the host).
+        """
+        if self.accumulation_steps > 1:
+            return self.accumulated_train_step(inputs, target)
+
+        LST_landsat_t2, LST_MODIS_t2_interpolated = self.loss_targets(inputs, target)
+
+        # ----------------------
+        # (1) Generate prediction and degrade it to the Landsat grid (weakly supervised learning)
+        # ----------------------
+        # The discriminator only sees the detached prediction, so its graph is only kept when it is reused in (3)
+        with torch.set_grad_enabled(self.single_forward):
+            prediction_interpolated = self.generate(inputs, LST_landsat_t2.shape[-2:])
+
+        # ----------------------
+        # (2) Update Discriminator
+        # ----------------------
+        with record_function('discriminator_update'):
+            pd_loss = self.discriminator_step(prediction_interpolated, LST_landsat_t2, LST_MODIS_t2_interpolated)
+
+        # ----------------------
+        # (3) Update Generator
+        # ----------------------
+        if not self.single_forward:
+            prediction_interpolated = self.generate(inputs, LST_landsat_t2.shape[-2:])
+        with record_function('generator_update'):
+            g_loss = self.generator_step(prediction_interpolated, LST_landsat_t2, LST_MODIS_t2_interpolated)
+
+        # Compute mean squared error
+        mse = F.mse_loss(prediction_interpolated.detach(), LST_landsat_t2)
+
+        return g_loss.detach(), pd_loss.detach(), mse
+
+    def accumulated_train_step(self, inputs, target):
+        """
+        train_step for batches that do not fit in memory at once: the batch is split into
+        option.accumulation_steps micro-batches whose gradients are accumulated before each update.
+        The discriminator is updated first on every micro-batch, then the generator (the generator
+        forward always runs twice, as single_forward would keep every micro-batch graph alive).
+        BatchNorm layers see micro-batch statistics.
+
+        Returns:
+            tuple: generator loss, discriminator loss and MSE averaged over the micro-batches (device tensors).
+        """
+        chunks = [tensor.chunk(self.accumulation_steps) for tensor in inputs + target]
+        micro_batches = [([c[i] for c in chunks[:len(inputs)]], [c[i] for c in chunks[len(inputs):]])
+                         for i in range(len(chunks[0]))]
+        n = len(micro_batches)
+
+        # Discriminator update
+        pd_total = 0
+        self.pd_optimizer.zero_grad()
+        with record_function('discriminator_update'):
+            for micro_inputs, micro_target in micro_batches:
+                LST_landsat_t2, LST_MODIS_t2_interpolated = self.loss_targets(micro_inputs, micro_target)
+                with torch.no_grad():
+                    prediction_interpolated = self.generate(micro_inputs, LST_landsat_t2.shape[-2:])
+                pd_loss = self.discriminator_loss(prediction_interpolated, LST_landsat_t2, LST_MODIS_t2_interpolated) / n
+                with self.stage_timer.stage('backward'):
+                    self.pd_scaler.scale(pd_loss).backward()
+                pd_total = pd_total + pd_loss.detach()
+            with self.stage_timer.stage('optimizer'):
+                self.pd_scaler.step(self.pd_optimizer)
+                self.pd_scaler.update()
+
+        # Generator update
+        g_total, mse = 0, 0
+        self.g_optimizer.zero_grad()
+        with record_function('generator_update'):
+            for micro_inputs, micro_target in micro_batches:
+                LST_landsat_t2, LST_MODIS_t2_interpolated = self.loss_targets(micro_inputs, micro_target)
+                prediction_interpolated = self.generate(micro_inputs, LST_landsat_t2.shape[-2:])
+                g_loss = self.generator_loss(prediction_interpolated, LST_landsat_t2, LST_MODIS_t2_interpolated) / n
+                with self.stage_timer.stage('backward'):
+                    self.g_scaler.scale(g_loss).backward()
+                g_total = g_total + g_loss.detach()
+                mse = mse + F.mse_loss(prediction_interpolated.detach(), LST_landsat_t2) / n
+            with self.stage_timer.stage('optimizer'):
+                self.g_scaler.step(self.g_optimizer)
+                self.g_scaler.update()
+
+        return g_total, pd_total, mse
+
+    def split_batch(self, images):
+        """Separates the inputs and the target of a training batch (on the device)."""
+        return images[:-1], images[-1:]
+
+    def training_state(self, n_epoch, step, meters):
+        """Everything needed to continue epoch `n_epoch` after `step` batches."""
+        state = {'epoch': n_epoch, 'step': step,
+                 'generator': unwrap_model(self.generator).state_dict(),
+                 'nlayerdiscriminator': unwrap_model(self.nlayerdiscriminator).state_dict(),
+                 'g_optimizer': self.g_optimizer.state_dict(), 'pd_optimizer': self.pd_optimizer.state_dict(),
+                 'g_scheduler': self.g_scheduler.state_dict(), 'pd_scheduler': self.pd_scheduler.state_dict(),
+                 'g_scaler': self.g_scaler.state_dict(), 'pd_scaler': self.pd_scaler.state_dict(),
+                 'meters': [meter.state_dict() for meter in meters],
+                 'rng': {'python': random.getstate(), 'numpy': numpy_rng_state(), 'torch': torch.get_rng_state()}}
+        if torch.cuda.is_available():
+            state['rng']['cuda'] = torch.cuda.get_rng_state_all()
+        return state
+
+    def save_checkpoints(self, n_epoch):
+        """Queues the end-of-epoch checkpoints of the models and their optimizers."""
+        self.checkpoint_writer.save(self.generator, self.g_optimizer, self.last_g, epoch=n_epoch)
+        self.checkpoint_writer.save(self.nlayerdiscriminator, self.pd_optimizer, self.last_pd, epoch=n_epoch)
+
+    def load_checkpoints(self):
+        """Loads the checkpoints written by save_checkpoints, to resume training."""
+        load_checkpoint(self.last_g, self.generator, optimizer=self.g_optimizer)
+        load_checkpoint(self.last_pd, self.nlayerdiscriminator, optimizer=self.pd_optimizer)
+
+    def save_snapshot(self, n_epoch, step, meters):
+        if self.is_main:
+            self.checkpoint_writer.save_state(self.training_state(n_epoch, step, meters), self.snapshot)
+
+    def load_snapshot(self, state):
+        unwrap_model(self.generator).load_state_dict(state['generator'])
+        unwrap_model(self.nlayerdiscriminator).load_state_dict(state['nlayerdiscriminator'])
+        for name in ('g_optimizer', 'pd_optimizer', 'g_scheduler', 'pd_scheduler', 'g_scaler', 'pd_scaler'):
+            getattr(self, name).load_state_dict(state[name])
+        random.setstate(state['rng']['python'])
+        set_numpy_rng_state(state['rng']['numpy'])
+        torch.set_rng_state(state['rng']['torch'])
+        if 'cuda' in state['rng'] and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state['rng']['cuda'])
+        self.resume_state = state
+
+    def handle_sigterm(self, signum, frame):
+        # Only flag the preemption, the training loop snapshots at the end of the running step
+        self.preempted = timer()
+        self.logger.info('SIGTERM received, saving a snapshot after the current step.')
+
+    def preempt(self, n_epoch, step, meters):
+        """Flushes a snapshot within the deadline and exits."""
+        self.save_snapshot(n_epoch, step, meters)
+        remaining = self.snapshot_deadline - (timer() - self.preempted)
+        if self.checkpoint_writer.wait(timeout=max(remaining, 0)):
+            self.logger.info(f'Snapshot of epoch {n_epoch}, step {step} saved.')
+        else:
+            self.logger.info(f'The snapshot could not be saved within {self.snapshot_deadline}s.')
+        raise SystemExit(128 + signal.SIGTERM)
+
+    def train_on_epoch(self, n_epoch, data_loader):
+        # Continue an interrupted epoch at the next batch (only with the seeded ResumableSampler order)
+        start_step = 0
+        resume_state, self.resume_state = self.resume_state, None
+        if (resume_state is not None and resume_state['epoch'] == n_epoch
+                and isinstance(data_loader.sampler, ResumableSampler)):
+            start_step = resume_state['step']
+        if isinstance(data_loader.sampler, ResumableSampler):
+            data_loader.sampler.set_epoch(n_epoch, start=start_step * data_loader.batch_size)
+
+        # Adjust learning rates (already done for an epoch continued from a snapshot)
+        if start_step == 0:
+            self.g_scheduler.step()
+            self.pd_scheduler.step()
+
+        # Set models to training mode
+        self.generator.train()
+        self.nlayerdiscriminator.train()
+
+        # Initialize loss trackers (accumulated on the device, read at log intervals and at the end of the epoch)
+        epg_loss = DeviceAverageMeter()  # Tracks generator loss
+        eppd_loss = DeviceAverageMeter()  # Tracks discriminator loss
+        epg_error = DeviceAverageMeter()  # Tracks mean squared error (MSE)
+        meters = (epg_loss, eppd_loss, epg_error)
+        if start_step > 0:
+            for meter, state in zip(meters, resume_state['meters']):
+                meter.load_state_dict(state, device=self.device)
+            self.logger.info(f'Epoch[{n_epoch}] - continuing at step {start_step}')
+        # Log epoch start
+        self.logger.info(f'Epoch[{n_epoch}] - {datetime.now()}')
+
+        # Iterate over the dataset
+        progress = tqdm(data_loader, desc="Processing")
+        t_fetch = timer()
+        for idx, data in enumerate(progress, start=start_step):            
+            self.stage_timer.start_step()
+            self.stage_timer.record('data', timer() - t_fetch)  # Time spent waiting for the data loader
+
+            # Load and move input data to device (GPU/CPU)
+            images, masks = data
+            with record_function('data_load'), self.stage_timer.stage('transfer'):
+                images = [im.to(self.device, non_blocking=True) for im in images]
+                masks = [im.to(self.device, non_blocking=True) for im in masks]
 
-            # Backpropagate and update generator
-            self.g_optimizer.zero_grad()
-            g_loss.backward()
-            self.g_optimizer.step()
-            torch.cuda.empty_cache() 
+            # Separate inputs and target
+            inputs, target = self.split_batch(images)
 
-            # Update loss tracker
-            epg_loss.update(g_loss.item())
+            g_loss, pd_loss, mse = self.train_step(inputs, target)
+            self.stage_timer.end_step(len(target[0]))
 
-            # Compute mean squared error
-            mse = F.mse_loss(prediction_interpolated, LST_landsat_t2).item()
+            # Update loss trackers
+            eppd_loss.update(pd_loss)
+            epg_loss.update(g_loss)
             epg_error.update(mse)
 
+            # Show the values of the previous interval, whose copy to the host has already completed
+            if (idx + 1) % self.log_interval == 0:
+                lagged = [meter.lagged() for meter in (epg_loss, eppd_loss, epg_error)]
+                if lagged[0] is not None:
+                    progress.set_postfix(g_loss=f'{lagged[0]:.4f}', pd_loss=f'{lagged[1]:.4f}', mse=f'{lagged[2]:.4f}')
+            if self.trace is not None:
+                self.trace.step()
+
+            # Snapshot the training state when preempted or periodically
+            if self.preempted is not None:
+                self.preempt(n_epoch, idx + 1, meters)
+            elif self.snapshot_interval and (idx + 1) % self.snapshot_interval == 0:
+                self.save_snapshot(n_epoch, idx + 1, meters)
+            t_fetch = timer()
+
         # Log epoch completion time
         self.logger.info(f'Epoch[{n_epoch}] - {datetime.now()}')
+        if self.is_main:
+            timing = self.stage_timer.export(self.timing, phase='train', epoch=n_epoch)
+            if timing is not None:
+                self.logger.info(f"Epoch[{n_epoch}] - {timing['samples_per_sec']:.1f} samples/s")
 
-        # Save model checkpoints
-        save_checkpoint(self.generator, self.g_optimizer, self.last_g)
-        save_checkpoint(self.nlayerdiscriminator, self.pd_optimizer, self.last_pd)
+            # Save model checkpoints
+            with record_function('checkpoint'):
+                self.save_checkpoints(n_epoch)
+        else:
+            self.stage_timer.reset()
 
         # Return average losses
         return epg_loss.avg, eppd_loss.avg, epg_error.avg
 
 
 
+    def set_lr_schedule(self, epochs, last_epoch=-1):
+        """
+        Rebuilds the learning rate schedulers with option.lr_schedule over `epochs` epochs, continuing
+        after `last_epoch` (the schedulers are stepped at the start of each epoch).
+        """
+        lr_lambda = make_lr_lambda(self.lr_schedule, epochs, warmup_epochs=self.warmup_epochs, min_factor=self.min_lr_factor)
+        self.g_scheduler = torch.optim.lr_scheduler.LambdaLR(self.g_optimizer, lr_lambda=lr_lambda)
+        self.pd_scheduler = torch.optim.lr_scheduler.LambdaLR(self.pd_optimizer, lr_lambda=lr_lambda)
+        for scheduler in (self.g_scheduler, self.pd_scheduler):
+            scheduler.last_epoch = last_epoch + 1
+
+    def make_dataset(self, data_dir, patch_size, patch_stride, scenes=None):
+        """
+        Training dataset: overlapping PatchSet patches, or in large-tile mode (option.tile_size) random
+        TileSet tiles whose epoch covers every training pixel `option.coverage` times.
+        `scenes` are pairs already decoded by load_scenes. With option.derived_inputs, samples include the
+        precomputed derived layers.
+        """
+        if self.tile_size:
+            return TileSet(data_dir, self.image_size, self.tile_size, coverage=self.coverage, scenes=scenes,
+                           derived=self.derived_inputs)
+        return PatchSet(data_dir, self.image_size, patch_size, patch_stride, scenes=scenes, derived=self.derived_inputs)
+
+    def make_loader(self, train_set, batch_size):
+        """Training DataLoader over `train_set` (shuffled, incomplete last batch dropped)."""
+        return DataLoader(train_set, batch_size= batch_size, sampler=ResumableSampler(train_set, seed=self.seed),
+                          num_workers=1, drop_last=True, pin_memory=self.device.type == 'cuda')
+
+    def load_data(self, train_dir, patch_size, patch_stride, batch_size, scenes=None):
+        """Builds the training dataset and loader, and logs how many Landsat pixels an epoch processes."""
+        train_set = self.make_dataset(train_dir, patch_size, patch_stride, scenes=scenes)  # Training dataset
+        sample_size = make_tuple(self.tile_size or patch_size)
+        epoch_pixels = len(train_set) * sample_size[0] * sample_size[1]
+        self.logger.info(f'Each epoch processes {epoch_pixels} Landsat pixels, '
+                         f'{epoch_pixels / (train_set.num_im_pairs * self.image_size[0] * self.image_size[1]):.1f} '
+                         f'times the pixels of the training pairs.')
+
+        # Create data loaders for training and 
+        train_loader = self.make_loader(train_set, batch_size)
+        
+        print("There are", len(train_set), "samples for training.")  # Log dataset size
+        return train_loader
+
     def train(self, train_dir, patch_size, patch_stride, batch_size,
-            num_workers=0, epochs=50, resume=True):
+            num_workers=0, epochs=50, resume=True, profile=None):
+        """
+        Trains for `epochs` epochs, resuming from history.csv and the last checkpoints when `resume` is set.
+        `profile=(skip, warmup, active)` records a torch.profiler trace of that window of steps (see trace_window).
+        With option.curriculum, the patch and batch sizes follow the curriculum stages (recorded in history.csv)
+        and the arguments are the defaults of the stages.
+        Training stops early on a train_g_error plateau (option.plateau_patience, in the last curriculum stage)
+        and the time to reach option.target_error is reported in convergence.json. The plateau detection
+        restarts at every curriculum stage (the best error and the epochs without improvement are reset),
+        the time to target counts from the start of training.
+        """
         last_epoch = -1  # Initialize last epoch as -1
         least_error = float('inf')  # Set least validation error to infinity
+        curriculum = None
+        if self.curriculum:
+            curriculum = CurriculumScheduler(self.curriculum, patience=self.curriculum_patience,
+                                             min_delta=self.curriculum_min_delta)
 
         # Resume training if enabled and history file exists
         if resume and self.history.exists():
             df = pd.read_csv(self.history)  # Load training history
             last_epoch = int(df.iloc[-1]['epoch'])  # Get last completed epoch
             least_error = df['train_g_loss'].min()
+            if curriculum is not None and 'stage' in df.columns:
+                # Replay the recorded errors to recover the stage and its plateau state
+                for error in df['train_g_error'][df['stage'].notna()]:
+                    curriculum.step(error)
     
             # Load latest saved model checkpoints
-            load_checkpoint(self.last_g, self.generator, optimizer=self.g_optimizer)
-            load_checkpoint(self.last_pd, self.nlayerdiscriminator, optimizer=self.pd_optimizer)
+            self.load_checkpoints()
+
+        self.set_lr_schedule(self.schedule_epochs or last_epoch + 1 + epochs, last_epoch)
+        monitor = ConvergenceMonitor(patience=self.plateau_patience, min_delta=self.plateau_min_delta,
+                                     target_error=self.target_error, stop_at_target=self.stop_at_target,
+                                     min_epochs=self.warmup_epochs)
+        if resume and last_epoch >= 0 and self.convergence.exists():
+            monitor.load(self.convergence, last_epoch=last_epoch)
+
+        # Continue from a step-level snapshot taken after the last completed epoch
+        if resume and self.snapshot.exists():
+            snapshot = torch.load(self.snapshot, map_location='cpu')
+            if snapshot['epoch'] > last_epoch:
+                self.logger.info(f"Resuming epoch {snapshot['epoch']} at step {snapshot['step']} from {self.snapshot}")
+                self.load_snapshot(snapshot)
+                last_epoch = snapshot['epoch'] - 1
 
         start_epoch = last_epoch + 1  # Determine the starting epoch
 
         # Load trainin  data
-        self.logger.info('Loading data...')
-        train_set = PatchSet(train_dir, self.image_size, patch_size, patch_stride)  # Training dataset
+        # history.csv keeps the columns it was created with, plus those of this run
+        csv_header = ['epoch', 'train_g_loss', 'train_pd_loss', 'train_g_error']
+        if curriculum is not None:
+            csv_header += ['stage', 'patch_size', 'batch_size']
+        if self.is_main and self.history.exists():
+            history = pd.read_csv(self.history)
+            columns = list(history.columns)
+            if not set(csv_header) <= set(columns):
+                # Rewrite it with the new columns (empty for the previous epochs), rows stay aligned
+                columns += [column for column in csv_header if column not in columns]
+                history.reindex(columns=columns).to_csv(self.history, index=False)
+            csv_header = columns
 
-        # Create data loaders for training and 
-        train_loader = DataLoader(train_set, batch_size= batch_size, shuffle=True,
-                                num_workers=1, drop_last=True)
-        
-        print("There are", len(train_set), "samples for training.")  # Log dataset size
+        self.logger.info('Loading data...')
+        stage = None
+        if curriculum is None:
+            train_loader = self.load_data(train_dir, patch_size, patch_stride, batch_size)
+        else:
+            # Decode the pairs once, the datasets of every stage cut their patches from them
+            scenes = load_scenes(train_dir, derived=self.derived_inputs)
 
         # Start training process
         self.logger.info('Training...')
+        previous_handler = None
+        if threading.current_thread() is threading.main_thread():
+            previous_handler = signal.signal(signal.SIGTERM, self.handle_sigterm)
+        self.trace = self.trace_window(profile, 'train')
+        if self.trace is not None:
+            self.trace.start()
+        monitor.start()
         for epoch in range(start_epoch, epochs + start_epoch):
+            if curriculum is not None and curriculum.stage != stage:
+                stage = curriculum.stage
+                stage_patch_size, stage_patch_stride, stage_batch_size = curriculum.settings(patch_size, patch_stride, batch_size)
+                self.logger.info(f'Curriculum stage {stage}: patch size {stage_patch_size}, batch size {stage_batch_size}')
+                train_loader = self.load_data(train_dir, stage_patch_size, stage_patch_stride, stage_batch_size, scenes=scenes)
+
             # Log current learning rates
             self.logger.info(f"Learning rate for Generator: {self.g_optimizer.param_groups[0]['lr']}")
             self.logger.info(f"Learning rate for Discriminator: {self.pd_optimizer.param_groups[0]['lr']}")
@@ -382,20 +969,57 @@ class Experiment(object):
             train_g_loss, train_pd_loss, train_g_error = self.train_on_epoch(epoch, train_loader)
 
             # Save training results to history file
-            csv_header = ['epoch', 'train_g_loss', 'train_pd_loss', 'train_g_error']
-            csv_values = [epoch, train_g_loss, train_pd_loss, train_g_error]
-            log_csv(self.history, csv_values, header=csv_header)
+            row = {'epoch': epoch, 'train_g_loss': train_g_loss, 'train_pd_loss': train_pd_loss,
+                   'train_g_error': train_g_error}
+            if curriculum is not None:
+                row.update(stage=stage, patch_size='x'.join(str(i) for i in make_tuple(stage_patch_size)),
+                           batch_size=stage_batch_size)
+                curriculum.step(train_g_error)
+            if self.is_main:
+                log_csv(self.history, [row.get(column, '') for column in csv_header], header=csv_header)
+
+            stop = monitor.step(epoch, train_g_error, lr=self.g_optimizer.param_groups[0]['lr'], stage=stage)
+            if stop and curriculum is not None and stage < len(curriculum.stages) - 1:
+                # Plateaus before the last stage move the curriculum on instead (`stage` is the stage this
+                # epoch trained in, curriculum.step may already have advanced curriculum.stage)
+                stop, monitor.stopped_epoch = False, None
+            if self.is_main:
+                monitor.save(self.convergence)
             
             if  train_g_loss < least_error :
                 least_error = train_g_loss
-                shutil.copy(str(self.last_g), str(self.best))  # Save best generator model
+                if self.is_main:
+                    self.checkpoint_writer.link(self.last_g, self.best)  # Save best generator model
+
+            if stop:
+                self.logger.info(f'Stopping early at epoch {epoch} (best train error {monitor.best:.4f} '
+                                 f'at epoch {monitor.best_epoch})')
+                break
+
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
+        if previous_handler is not None:
+            signal.signal(signal.SIGTERM, previous_handler)
+        self.checkpoint_writer.wait()
+
+        if monitor.time_to_target is not None:
+            self.logger.info(f'Reached a train error of {self.target_error} at epoch {monitor.epoch_to_target} '
+                             f'after {monitor.time_to_target:.1f}s of training.')
+        elif self.target_error is not None:
+            self.logger.info(f'Train error {self.target_error} not reached (best {monitor.best:.4f}).')
 
 
 
     @torch.no_grad()
-    def test(self, test_dir, patch_size, num_workers=0):
+    def test(self, test_dir, patch_size, num_workers=0, profile=None):
+        """
+        Predicts every test image patch by patch and stitches the overlapping patches.
+        `profile=(skip, warmup, active)` records a torch.profiler trace of that window of patches (see trace_window).
+        """
         print("*****************")
         self.generator.eval()
+        self.checkpoint_writer.wait()
         load_checkpoint(self.best, model=self.generator)
         self.logger.info('Testing...')
 
@@ -424,7 +1048,14 @@ class Experiment(object):
 
         print_indice = 0
 
+        self.trace = self.trace_window(profile, 'test')
+        if self.trace is not None:
+            self.trace.start()
+
+        t_fetch = timer()
         for data in test_loader:
+            self.stage_timer.start_step()
+            self.stage_timer.record('data', timer() - t_fetch)
             name = image_paths[im_count][-1].name.replace("Landsat", "Sentinel")
             if (print_indice ==0):
                 print("Start test for image : ", name)
@@ -433,57 +1064,62 @@ class Experiment(object):
             t_start = timer()  # Track time per batch
 
             images, masks = data
-            images = [im.to(self.device) for im in images]
-            masks = [im.to(self.device) for im in masks]
+            with record_function('data_load'), self.stage_timer.stage('transfer'):
+                images = [im.to(self.device) for im in images]
+                masks = [im.to(self.device) for im in masks]
 
             inputs, target = images[:-1], images[-1:]
-            prediction = self.generator(inputs)
-            prediction = self.apply_gaussian_blur(prediction, sigma=1.0)
+            with record_function('generator_forward'), self.stage_timer.stage('g_forward'):
+                prediction = self.generator(inputs)
+                prediction = self.degradation.blur(prediction)
 
-            patches.append(prediction.cpu().numpy())
+            with self.stage_timer.stage('transfer'):
+                patches.append(prediction.cpu().numpy())
 
             # If all patches for one image are collected
             if len(patches) == n_blocks:
-                sum_buffer = np.zeros((NUM_BANDS, *scaled_image_size), dtype=np.float32)
-                weight_buffer = np.zeros((1, *scaled_image_size), dtype=np.float32)
+                with record_function('stitch'), self.stage_timer.stage('stitch', host=True):
+                    sum_buffer = np.zeros((NUM_BANDS, *scaled_image_size), dtype=np.float32)
+                    weight_buffer = np.zeros((1, *scaled_image_size), dtype=np.float32)
 
-                block_count = 0
-                for i in range(rows):
-                    row_start = i * (patch_stride[1] * 3)  # vertical stride scaled by 3
+                    block_count = 0
+                    for i in range(rows):
+                        row_start = i * (patch_stride[1] * 3)  # vertical stride scaled by 3
 
-                    for j in range(cols):
-                        col_start = j * (patch_stride[0] * 3)  # horizontal stride scaled by 3
+                        for j in range(cols):
+                            col_start = j * (patch_stride[0] * 3)  # horizontal stride scaled by 3
 
-                        # Determine row/col starts and ends with conditional border exclusion
-                        x1 = col_start if col_start == 0 else col_start + 1
-                        y1 = row_start if row_start == 0 else row_start + 1
+                            # Determine row/col starts and ends with conditional border exclusion
+                            x1 = col_start if col_start == 0 else col_start + 1
+                            y1 = row_start if row_start == 0 else row_start + 1
 
-                        col_end_raw = col_start + scaled_patch_size[0]
-                        row_end_raw = row_start + scaled_patch_size[1]
+                            col_end_raw = col_start + scaled_patch_size[0]
+                            row_end_raw = row_start + scaled_patch_size[1]
 
-                        x2 = col_end_raw if col_end_raw == scaled_image_size[0]  else col_end_raw - 1
-                        y2 = row_end_raw if row_end_raw == scaled_image_size[1]  else row_end_raw - 1
+                            x2 = col_end_raw if col_end_raw == scaled_image_size[0]  else col_end_raw - 1
+                            y2 = row_end_raw if row_end_raw == scaled_image_size[1]  else row_end_raw - 1
 
-                        # Crop the patch only if it's not touching the edges
-                        crop_left = 0 if col_start == 0 else 1
-                        crop_right = None if col_end_raw == scaled_image_size[0] else -1
-                        crop_top = 0 if row_start == 0 else 1
-                        crop_bottom = None if row_end_raw == scaled_image_size[1] else -1
+                            # Crop the patch only if it's not touching the edges
+                            crop_left = 0 if col_start == 0 else 1
+                            crop_right = None if col_end_raw == scaled_image_size[0] else -1
+                            crop_top = 0 if row_start == 0 else 1
+                            crop_bottom = None if row_end_raw == scaled_image_size[1] else -1
 
-                        patch = patches[block_count][0][:, crop_left:crop_right, crop_top:crop_bottom]
+                            patch = patches[block_count][0][:, crop_left:crop_right, crop_top:crop_bottom]
 
-                        # Update buffers
-                        sum_buffer[:, x1:x2, y1:y2] += patch
-                        weight_buffer[:, x1:x2, y1:y2] += 1
+                            # Update buffers
+                            sum_buffer[:, x1:x2, y1:y2] += patch
+                            weight_buffer[:, x1:x2, y1:y2] += 1
 
-                        block_count += 1
-                #patches.clear()
-                # Normalize overlapping regions
-                result = sum_buffer / (weight_buffer)
+                            block_count += 1
+                    #patches.clear()
+                    # Normalize overlapping regions
+                    result = sum_buffer / (weight_buffer)
 
                 # Save the full predicted image
-                prototype = str(image_paths[im_count][2])
-                save_array_as_tif(result, test_dir/ name, prototype=prototype)
+                with record_function('write'), self.stage_timer.stage('write', host=True):
+                    prototype = str(image_paths[im_count][2])
+                    save_array_as_tif(result, test_dir/ name, prototype=prototype)
 
                 im_count += 1
                 patches = []
@@ -493,3 +1129,16 @@ class Experiment(object):
 
                 print("End test for image : ", name)
                 print("*****************************************************")
+
+            self.stage_timer.end_step(len(target[0]))
+            if self.trace is not None:
+                self.trace.step()
+            t_fetch = timer()
+
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
+
+        timing = self.stage_timer.export(self.timing, phase='test', images=im_count)
+        if timing is not None:
+            self.logger.info(f"Test - {timing['samples_per_sec']:.1f} patches/s")
@@ -0,0 +1,203 @@
+import json
+
+import numpy as np
+import torch
+import torch.optim as optim
+from torch.profiler import record_function
+from torch.utils.data import DataLoader, Dataset
+
+import sys
+import os
+sys.path.append(os.path.abspath('..'))  # go up to root directory
+
+from model.WGAST import STREAMS
+from runner.experiment import Experiment
+from data_loader.data import TileSet
+from data_loader.utils import load_checkpoint, unwrap_model
+
+from pathlib import Path
+from tqdm import tqdm
+
+ENCODERS = ('MODIS_SNet', 'Landsat_SNet', 'indices_SNet')
+
+
+class FeatureCache(object):
+    """
+    Multi-level encoder features of every sample of a dataset, kept in RAM or in memory-mapped .npy files.
+
+    `layout` lists the cached (stream, level) pairs; `sample(index)` returns the features of a sample in
+    that order.
+    """
+
+    def __init__(self, arrays, layout):
+        self.arrays = arrays
+        self.layout = layout
+
+    def sample(self, index):
+        return [torch.from_numpy(np.array(self.arrays[key][index])) for key in self.layout]
+
+    @classmethod
+    def open(cls, directory):
+        """Opens a complete cache written by `build`, None if there is none."""
+        meta_path = Path(directory) / 'cache.json'
+        if not meta_path.exists():
+            return None
+        with open(meta_path) as file:
+            meta = json.load(file)
+        layout = [tuple(key) for key in meta['layout']]
+        arrays = {key: np.load(Path(directory) / f'{key[0]}_{key[1]}.npy', mmap_mode='r') for key in layout}
+        cache = cls(arrays, layout)
+        cache.meta = meta
+        return cache
+
+    @classmethod
+    def build(cls, generator, dataset, streams, device, directory=None, dtype=np.float16, batch_size=32, meta=None):
+        """
+        Computes the features of `streams` for every sample of `dataset` with the (frozen) encoders of `generator`.
+
+        Args:
+            directory (Path): Where to write the memory-mapped cache, in RAM if None.
+            dtype: Storage type of the features (float16 halves the size of the cache).
+            meta (dict): Extra information stored with the cache (e.g. the source checkpoint).
+        """
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=1)
+        layout, arrays, position = None, {}, 0
+        for images, _ in tqdm(loader, desc='Caching encoder features'):
+            inputs = [im.to(device) for im in images[:-1]]
+            with torch.no_grad():
+                features = generator.encode(inputs, streams)
+
+            if layout is None:
+                layout = [(stream, level) for stream in streams for level in range(len(features[stream]))]
+                for stream, level in layout:
+                    shape = (len(dataset),) + tuple(features[stream][level].shape[1:])
+                    if directory is None:
+                        arrays[(stream, level)] = np.zeros(shape, dtype=dtype)
+                    else:
+                        arrays[(stream, level)] = np.lib.format.open_memmap(
+                            Path(directory) / f'{stream}_{level}.npy', mode='w+', dtype=dtype, shape=shape)
+
+            n = len(images[0])
+            for stream, level in layout:
+                arrays[(stream, level)][position:position + n] = features[stream][level].float().cpu().numpy()
+            position += n
+
+        cache = cls(arrays, layout)
+        cache.meta = dict(meta or {}, layout=layout, num_samples=len(dataset))
+        if directory is not None:
+            for array in arrays.values():
+                array.flush()
+            # Written last: the cache is only reused once complete
+            with open(Path(directory) / 'cache.json', 'w') as file:
+                json.dump(cache.meta, file, indent=2)
+        return cache
+
+
+class CachedFeatureSet(Dataset):
+    """Appends the cached encoder features of each sample to the images of the wrapped dataset."""
+
+    def __init__(self, dataset, cache):
+        self.dataset = dataset
+        self.cache = cache
+        self.num_im_pairs = dataset.num_im_pairs
+
+    def __getitem__(self, index):
+        images, masks = self.dataset[index]
+        return images + self.cache.sample(index), masks
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+class FinetuneExperiment(Experiment):
+    """
+    Fine-tunes a trained CombinFeatureGenerator with some FeatureExtract encoders frozen.
+
+    The multi-level features of the frozen encoders are computed once for every training patch and
+    cached, on disk (option.feature_cache_dir, as memory-mapped arrays) or in RAM. Training then only runs
+    and updates the remaining encoders, the fusion (similarity, AdaIN, significance) and the decoder.
+    The frozen encoders are used in eval mode (no dropout).
+
+    Extra options:
+        finetune_checkpoint (Path): Generator checkpoint to start from, e.g. the best.pth of the region.
+        frozen_encoders (tuple): Encoders to freeze among 'MODIS_SNet', 'Landsat_SNet' and 'indices_SNet' (default all).
+        feature_cache_dir (Path): Directory of the feature cache (default: in RAM). A cache is reused when it
+            was built from the same checkpoint, patch size and stride.
+    """
+
+    def __init__(self, option):
+        super(FinetuneExperiment, self).__init__(option)
+        if self.accumulation_steps > 1:
+            raise ValueError('Gradient accumulation is not supported with cached features')
+
+        self.finetune_checkpoint = getattr(option, 'finetune_checkpoint', None)
+        if self.finetune_checkpoint:
+            load_checkpoint(Path(self.finetune_checkpoint), self.generator, map_location=self.device)
+
+        self.frozen_encoders = tuple(getattr(option, 'frozen_encoders', ENCODERS))
+        self.frozen_streams = [stream for stream, net in STREAMS.items() if net in self.frozen_encoders]
+        self.feature_cache_dir = getattr(option, 'feature_cache_dir', None)
+        self.cache_layout = []
+        self.batch_features = None
+
+        generator = unwrap_model(self.generator)
+        for name in self.frozen_encoders:
+            for param in getattr(generator, name).parameters():
+                param.requires_grad = False
+
+        # Only the trainable parameters are optimized (same learning rate schedule)
+        lr_lambda = self.g_scheduler.lr_lambdas[0]
+        self.g_optimizer = optim.Adam([p for p in self.generator.parameters() if p.requires_grad], lr=option.lr)
+        self.g_scheduler = torch.optim.lr_scheduler.LambdaLR(self.g_optimizer, lr_lambda=lr_lambda)
+
+        n_params = sum(p.numel() for p in self.generator.parameters() if p.requires_grad)
+        self.logger.info(f'Fine-tuning {n_params} generator parameters with {", ".join(self.frozen_encoders)} frozen.')
+
+    def feature_cache(self, dataset):
+        meta = {'checkpoint': str(self.finetune_checkpoint), 'streams': self.frozen_streams,
+                'patch_size': list(dataset.patch_size), 'patch_stride': list(dataset.patch_stride),
+                'derived_inputs': bool(self.derived_inputs)}
+        directory = None
+        if self.feature_cache_dir is not None:
+            # Derived inputs change the encoder inputs, so they get their own cache
+            name = '{}x{}_{}x{}'.format(*dataset.patch_size, *dataset.patch_stride)
+            directory = Path(self.feature_cache_dir) / (name + '_derived' if self.derived_inputs else name)
+            cache = FeatureCache.open(directory)
+            if cache is not None and all(cache.meta.get(key) == value for key, value in meta.items()):
+                self.logger.info(f'Using the cached encoder features in {directory}')
+                return cache
+            directory.mkdir(parents=True, exist_ok=True)
+
+        generator = unwrap_model(self.generator)
+        for name in self.frozen_encoders:
+            getattr(generator, name).eval()
+        return FeatureCache.build(generator, dataset, self.frozen_streams, self.device, directory=directory, meta=meta)
+
+    def make_dataset(self, data_dir, patch_size, patch_stride, scenes=None):
+        dataset = super(FinetuneExperiment, self).make_dataset(data_dir, patch_size, patch_stride, scenes=scenes)
+        if isinstance(dataset, TileSet):
+            raise ValueError('Cached features need a fixed set of patches, large-tile mode is not supported')
+        if not self.frozen_streams:
+            return dataset
+        cache = self.feature_cache(dataset)
+        self.cache_layout = cache.layout
+        return CachedFeatureSet(dataset, cache)
+
+    def split_batch(self, images):
+        n = len(self.cache_layout)
+        if n == 0:
+            self.batch_features = None
+            return images[:-1], images[-1:]
+
+        self.batch_features = {}
+        for (stream, level), feature in zip(self.cache_layout, images[-n:]):
+            self.batch_features.setdefault(stream, []).append(feature.float())
+        images = images[:-n]
+        return images[:-1], images[-1:]
+
+    def generate(self, inputs, size):
+        with record_function('generator_forward'), self.stage_timer.stage('g_forward'):
+            with self.autocast():
+                prediction = self.generator(inputs, features=self.batch_features)
+            prediction = prediction.float()  # the degradation and losses run in float32
+            return self.degrade(prediction, size)
@@ -0,0 +1,244 @@
+import csv
+import math
+from contextlib import nullcontext
+from pathlib import Path
+from timeit import default_timer as timer
+
+import numpy as np
+import rasterio
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import sys
+import os
+sys.path.append(os.path.abspath('..'))  # go up to root directory
+
+from model.WGAST import NUM_BANDS
+from runner.experiment import Experiment
+from data_loader.data import PAIR_SCALES, SCALE_FACTOR, get_pair_path_with_masks, load_image_and_mask_pair
+from data_loader.utils import get_logger, make_tuple, save_array_as_tif, unwrap_model
+
+
+def receptive_radius(generator):
+    """
+    Radius of the receptive field of a CombinFeatureGenerator on the 10 m grid, from its convolutions:
+    an encoder down to the deepest level, then the decoder back to full resolution.
+
+    AdaIN normalizes with statistics of the whole input, so outputs also depend (weakly) on pixels
+    beyond this radius.
+    """
+    generator = unwrap_model(generator)
+    radius, jump = 0, 1
+    encoder = generator.Landsat_SNet
+    for n in range(encoder.depth):
+        for module in getattr(encoder, 'conv' + str(n + 1)).modules():
+            if isinstance(module, nn.Conv2d):
+                radius += (module.kernel_size[0] - 1) // 2 * jump
+                jump *= module.stride[0]
+    for n in range(1, generator.depth + 1):
+        for module in getattr(generator, 'conv' + str(n)).modules():
+            if isinstance(module, nn.ConvTranspose2d):
+                radius += math.ceil((module.kernel_size[0] - 1) / 2 / module.stride[0]) * jump
+                jump //= module.stride[0]
+            elif isinstance(module, nn.Conv2d):
+                radius += (module.kernel_size[0] - 1) // 2 * jump
+    return radius
+
+
+def tile_alignment(generator):
+    """
+    Landsat pixels that tile sizes and positions must be multiples of: the encoder downsamples the
+    10 m grid by 2 ** (depth - 1), and 10 m tiles are SCALE_FACTOR times the Landsat tiles.
+    """
+    downsampling = 2 ** (unwrap_model(generator).depth - 1)
+    return downsampling // math.gcd(downsampling, SCALE_FACTOR)
+
+
+def default_halo(generator):
+    """Halo in Landsat pixels covering the receptive field, rounded up to the tile alignment."""
+    alignment = tile_alignment(generator)
+    return math.ceil(receptive_radius(generator) / SCALE_FACTOR / alignment) * alignment
+
+
+class TiledInference(object):
+    """
+    Whole-scene inference with the fully convolutional generator on large tiles.
+
+    The Landsat grid of a scene is divided into cores of `tile_size` pixels. Each core is predicted from
+    a tile that extends it by `halo` pixels on every side (clamped at the scene border, where the
+    generator's reflection padding applies as for whole images), and only the 10 m prediction of the
+    core is written out, so every output pixel is computed once. Tile sizes and positions are multiples
+    of the encoder downsampling (see tile_alignment), scenes are reflection-padded to a multiple of it.
+
+    Args:
+        generator (CombinFeatureGenerator): Trained generator.
+        tile_size (int or tuple): Core size on the Landsat grid.
+        halo (int): Halo on the Landsat grid (default: the receptive field, see default_halo).
+        blur (callable): Applied to the 10 m prediction before cropping, e.g. Degradation.blur as in Experiment.test.
+        autocast (callable): Returns the autocast context of the forward passes (default: float32).
+    """
+
+    def __init__(self, generator, device, tile_size=128, halo=None, blur=None, autocast=None):
+        self.generator = generator
+        self.device = device
+        self.alignment = tile_alignment(generator)
+        self.tile_size = make_tuple(tile_size)
+        self.halo = default_halo(generator) if halo is None else halo
+        self.blur = blur
+        self.autocast = autocast or nullcontext
+        if any(size % self.alignment for size in self.tile_size) or self.halo % self.alignment:
+            raise ValueError(f'Tile size {self.tile_size} and halo {self.halo} must be multiples of {self.alignment}')
+        self.computed_pixels = 0  # Landsat pixels fed to the generator since the last reset
+
+    def windows(self, size, axis):
+        """(core start, core end, tile start, tile end) along an axis of `size` (padded) Landsat pixels."""
+        core = self.tile_size[axis]
+        return [(start, min(start + core, size), max(0, start - self.halo), min(size, start + core + self.halo))
+                for start in range(0, size, core)]
+
+    @torch.no_grad()
+    def predict(self, images):
+        """
+        Predicts a whole scene.
+
+        Args:
+            images (list of np.ndarray): MODIS t1, Landsat t1, Sentinel t1 and MODIS t2 of a pair
+                (as read by load_image_and_mask_pair); further images are ignored.
+
+        Returns:
+            np.ndarray: 10 m prediction, (NUM_BANDS, SCALE_FACTOR * H, SCALE_FACTOR * W) for a Landsat grid of H x W.
+        """
+        self.generator.eval()
+        height, width = images[1].shape[-2:]
+        padded_height = math.ceil(height / self.alignment) * self.alignment
+        padded_width = math.ceil(width / self.alignment) * self.alignment
+
+        scene = []
+        for image, scale in zip(images[:4], PAIR_SCALES):
+            pad = ((0, 0), (0, (padded_height - height) * scale), (0, (padded_width - width) * scale))
+            scene.append(torch.from_numpy(np.pad(image, pad, mode='reflect')))
+
+        output = np.zeros((NUM_BANDS, padded_height * SCALE_FACTOR, padded_width * SCALE_FACTOR), dtype=np.float32)
+        for core_y, core_y_end, tile_y, tile_y_end in self.windows(padded_height, 0):
+            for core_x, core_x_end, tile_x, tile_x_end in self.windows(padded_width, 1):
+                inputs = [image[:, tile_y * scale:tile_y_end * scale, tile_x * scale:tile_x_end * scale]
+                          .unsqueeze(0).to(self.device) for image, scale in zip(scene, PAIR_SCALES)]
+                with self.autocast():
+                    prediction = self.generator(inputs)
+                prediction = prediction.float()
+                if self.blur is not None:
+                    prediction = self.blur(prediction)
+                self.computed_pixels += (tile_y_end - tile_y) * (tile_x_end - tile_x)
+
+                # Only the core is kept
+                top, left = (core_y - tile_y) * SCALE_FACTOR, (core_x - tile_x) * SCALE_FACTOR
+                core = prediction[0, :, top:top + (core_y_end - core_y) * SCALE_FACTOR,
+                                  left:left + (core_x_end - core_x) * SCALE_FACTOR]
+                output[:, core_y * SCALE_FACTOR:core_y_end * SCALE_FACTOR,
+                       core_x * SCALE_FACTOR:core_x_end * SCALE_FACTOR] = core.cpu().numpy()
+
+        return output[:, :height * SCALE_FACTOR, :width * SCALE_FACTOR]
+
+    def predict_dir(self, image_dir, out_dir):
+        """
+        Predicts every pair of a PatchSet directory and writes the predictions to `out_dir`, named as by
+        Experiment.test.
+
+        Returns:
+            list of dict: Name, output path, Landsat t2 (image, mask) paths, seconds and Landsat pixels
+            computed per output pixel, per pair.
+        """
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        results = []
+        for im_dir in sorted(p for p in Path(image_dir).glob('*') if p.is_dir()):
+            pairs = get_pair_path_with_masks(im_dir)
+            name = pairs[-1][0].name.replace("Landsat", "Sentinel")
+            images, _ = load_image_and_mask_pair(im_dir)
+
+            self.computed_pixels = 0
+            t_start = timer()
+            prediction = self.predict(images)
+            seconds = timer() - t_start
+            height, width = images[1].shape[-2:]
+
+            save_array_as_tif(prediction, out_dir / name, prototype=str(pairs[2][0]))
+            results.append({'name': name, 'path': out_dir / name, 'target': pairs[-1], 'seconds': seconds,
+                            'computed_per_output': self.computed_pixels / (height * width)})
+        return results
+
+
+def read_array(path):
+    with rasterio.open(str(path)) as src:
+        return src.read().astype(np.float32)
+
+
+def landsat_rmse(prediction, landsat, mask=None):
+    """RMSE of a 10 m prediction average-pooled to the Landsat grid against the Landsat LST (valid pixels only)."""
+    pooled = F.avg_pool2d(torch.from_numpy(prediction[:1]).unsqueeze(0), SCALE_FACTOR, SCALE_FACTOR)[0, 0].numpy()
+    reference = landsat[0, :pooled.shape[0], :pooled.shape[1]]
+    valid = np.ones(reference.shape, dtype=bool)
+    if mask is not None:
+        valid = mask.reshape(mask.shape[-2:])[:pooled.shape[0], :pooled.shape[1]] > 0
+    return float(np.sqrt(np.mean((pooled[valid] - reference[valid]) ** 2)))
+
+
+def compare_with_patches(option, tile_size=128, halo=None, test_dir=None, out_dir=None):
+    """
+    Compares tiled inference with the overlapped-patch output of Experiment.test (option.test_patch, stride 8).
+
+    Both run the best checkpoint on every test pair. The report gives, per pair, the time of each method,
+    the Landsat pixels computed per output pixel, the difference between the two 10 m predictions
+    (RMSE and maximum) and the RMSE of each against the Landsat t2 LST after pooling to the Landsat grid.
+    It is logged and written to `tiled_report.csv` in save_dir.
+
+    Returns:
+        list of dict: One row per test pair.
+    """
+    logger = get_logger()
+    experiment = Experiment(option)
+    test_dir = test_dir or option.test_dir
+    out_dir = out_dir or experiment.save_dir / 'tiled'
+    test_patch = make_tuple(getattr(option, 'test_patch', 32))
+
+    t_start = timer()
+    experiment.test(test_dir, test_patch)  # loads the best checkpoint, writes next to the test pairs
+    patch_seconds = timer() - t_start
+    rows = int((experiment.image_size[1] - test_patch[1]) / 8) + 1
+    cols = int((experiment.image_size[0] - test_patch[0]) / 8) + 1
+    patch_computed = rows * cols * test_patch[0] * test_patch[1] / (experiment.image_size[0] * experiment.image_size[1])
+
+    engine = TiledInference(experiment.generator, experiment.device, tile_size=tile_size, halo=halo,
+                            blur=experiment.degradation.blur, autocast=experiment.autocast)
+    results = engine.predict_dir(test_dir, out_dir)
+    logger.info(f'Tiled inference with {list(engine.tile_size)} cores and a halo of {engine.halo} pixels '
+                f'(receptive field radius {receptive_radius(experiment.generator) / SCALE_FACTOR:.0f} Landsat pixels)')
+
+    report = []
+    for result in results:
+        tiled = read_array(result['path'])
+        patches = read_array(Path(test_dir) / result['name'])
+        landsat_path, mask_path = result['target']
+        landsat, mask = read_array(landsat_path), np.load(mask_path).astype(np.float32)
+
+        row = {'name': result['name'],
+               'patch_seconds': patch_seconds / len(results),
+               'tiled_seconds': result['seconds'],
+               'patch_computed_per_output': patch_computed,
+               'tiled_computed_per_output': result['computed_per_output'],
+               'difference_rmse': float(np.sqrt(np.mean((tiled - patches) ** 2))),
+               'difference_max': float(np.abs(tiled - patches).max()),
+               'patch_landsat_rmse': landsat_rmse(patches, landsat, mask),
+               'tiled_landsat_rmse': landsat_rmse(tiled, landsat, mask)}
+        report.append(row)
+        logger.info(f"{row['name']}: tiled {row['tiled_seconds']:.1f}s vs patches {row['patch_seconds']:.1f}s "
+                    f"({row['tiled_computed_per_output']:.2f} vs {row['patch_computed_per_output']:.2f} pixels computed "
+                    f"per output pixel), difference RMSE {row['difference_rmse']:.4f} (max {row['difference_max']:.4f}), "
+                    f"Landsat RMSE {row['tiled_landsat_rmse']:.4f} vs {row['patch_landsat_rmse']:.4f}")
+
+    with open(experiment.save_dir / 'tiled_report.csv', 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=list(report[0].keys()))
+        writer.writeheader()
+        writer.writerows(report)
+    return report
@@ -0,0 +1,240 @@
+import csv
+import json
+from collections import OrderedDict
+from timeit import default_timer as timer
+
+import torch
+import torch.nn as nn
+
+import sys
+import os
+sys.path.append(os.path.abspath('..'))  # go up to root directory
+
+from runner.experiment import Experiment
+from runner.benchmark import synthetic_batch
+from data_loader.utils import get_logger
+
+
+def tensors_of(value):
+    """Flattens module inputs/outputs (tensors, lists and tuples) into a list of tensors."""
+    if torch.is_tensor(value):
+        return [value]
+    if isinstance(value, (list, tuple)):
+        return [t for v in value for t in tensors_of(v)]
+    return []
+
+
+def leaf_flops(module, inputs, outputs):
+    """
+    Floating point operations of a leaf module (a multiply-add counts as 2).
+    Modules without a rule (e.g. padding) count as 0.
+    """
+    out = outputs[0] if outputs else None
+    if out is None:
+        return 0
+    if isinstance(module, nn.Conv2d):
+        kh, kw = module.kernel_size
+        return 2 * out.numel() * (module.in_channels // module.groups) * kh * kw
+    if isinstance(module, nn.ConvTranspose2d):
+        kh, kw = module.kernel_size
+        return 2 * inputs[0].numel() * (module.out_channels // module.groups) * kh * kw
+    if isinstance(module, nn.Linear):
+        return 2 * out.numel() * module.in_features
+    if isinstance(module, (nn.modules.batchnorm._BatchNorm, nn.modules.instancenorm._InstanceNorm)):
+        return 2 * out.numel()
+    if isinstance(module, (nn.LeakyReLU, nn.ReLU, nn.Sigmoid, nn.Tanh, nn.Dropout,
+                           nn.AvgPool2d, nn.MaxPool2d)):
+        return out.numel()
+    return 0
+
+
+class LayerProfiler(object):
+    """
+    Per-submodule profiler based on forward and backward hooks.
+
+    For every submodule it records the number of calls, the forward and backward wall time, the
+    FLOPs (of its leaf modules), the parameter count, the bytes of its outputs (activations) and
+    its share of the total time. Times of container modules include their children; work done by
+    functional ops (interpolation, AdaIN, torch.cat) is only visible in the enclosing module.
+
+    The backward pass of a module runs from the arrival of the gradient of its outputs to the gradient of
+    its inputs; modules whose inputs need no gradient (the model itself, the first layers) end with the
+    whole backward, which `backward` times. Every call of a module is timed separately, so modules
+    called several times per step are not mixed up. The total time is the forward of the model plus
+    the timed backward.
+
+    Usage:
+        profiler = LayerProfiler(model, device)
+        with profiler:
+            loss = model(inputs).mean()
+            profiler.backward(loss)
+        profiler.export_csv(path)
+    """
+
+    def __init__(self, model, device):
+        self.model = model.module if isinstance(model, nn.DataParallel) else model
+        self.device = device
+        self.handles = []
+        self.stats = OrderedDict()
+        self.forward_start = {}  # module name -> stack of (call token, start time)
+        self.backward_start = {}  # call token -> (module name, start time)
+        self.backward_total_ms = 0.0
+        self.backward_steps = 0
+
+        for name, module in self.model.named_modules():
+            name = name or type(self.model).__name__
+            self.stats[name] = {'name': name, 'type': type(module).__name__, 'calls': 0,
+                                'forward_ms': 0.0, 'backward_ms': 0.0, 'flops': 0,
+                                'params': sum(p.numel() for p in module.parameters()),
+                                'activation_bytes': 0, 'leaf': len(list(module.children())) == 0}
+
+    def now(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        return timer()
+
+    def __enter__(self):
+        for name, module in self.model.named_modules():
+            name = name or type(self.model).__name__
+            self.handles.append(module.register_forward_pre_hook(self.pre_hook(name)))
+            self.handles.append(module.register_forward_hook(self.post_hook(name)))
+        return self
+
+    def __exit__(self, *args):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def pre_hook(self, name):
+        def hook(module, inputs):
+            call = object()  # identifies this call in the backward hooks
+            # Backward ends when the gradient w.r.t. the module inputs is available
+            for t in tensors_of(inputs):
+                if t.requires_grad:
+                    t.register_hook(self.backward_end(call))
+            self.forward_start.setdefault(name, []).append((call, self.now()))
+        return hook
+
+    def post_hook(self, name):
+        def hook(module, inputs, outputs):
+            stats = self.stats[name]
+            call, start = self.forward_start[name].pop()
+            stats['forward_ms'] += (self.now() - start) * 1e3
+            stats['calls'] += 1
+            outputs = tensors_of(outputs)
+            stats['activation_bytes'] += sum(t.numel() * t.element_size() for t in outputs)
+            if stats['leaf']:
+                stats['flops'] += leaf_flops(module, tensors_of(inputs), outputs)
+            # Backward starts when the gradient w.r.t. the module outputs arrives
+            for t in outputs:
+                if t.requires_grad:
+                    t.register_hook(self.backward_begin(name, call))
+        return hook
+
+    def backward_begin(self, name, call):
+        def hook(grad):
+            self.backward_start.setdefault(call, (name, self.now()))
+        return hook
+
+    def backward_end(self, call):
+        def hook(grad):
+            name, start = self.backward_start.pop(call, (None, None))
+            if start is not None:
+                self.stats[name]['backward_ms'] += (self.now() - start) * 1e3
+        return hook
+
+    def backward(self, loss):
+        """Runs and times `loss.backward()`; calls still in their backward end with it."""
+        start = self.now()
+        loss.backward()
+        end = self.now()
+        self.backward_total_ms += (end - start) * 1e3
+        self.backward_steps += 1
+        for name, begin in self.backward_start.values():
+            self.stats[name]['backward_ms'] += (end - begin) * 1e3
+        self.backward_start.clear()
+
+    def rows(self):
+        """Profiling table, one row per submodule, with FLOPs of containers summed over their leaves."""
+        rows = [dict(stats) for stats in self.stats.values()]
+        root = rows[0]['name']
+        for row in rows:
+            if not row['leaf']:
+                prefix = '' if row['name'] == root else row['name'] + '.'
+                row['flops'] = sum(other['flops'] for other in rows
+                                   if other['leaf'] and other['name'].startswith(prefix))
+        total = rows[0]['forward_ms'] + (self.backward_total_ms if self.backward_steps else rows[0]['backward_ms'])
+        for row in rows:
+            row['total_ms'] = row['forward_ms'] + row['backward_ms']
+            row['share'] = row['total_ms'] / total if total > 0 else 0.0
+            row['depth'] = 0 if row['name'] == root else row['name'].count('.') + 1
+        return rows
+
+    def table(self, max_depth=2):
+        rows = [row for row in self.rows() if row['depth'] <= max_depth]
+        lines = [f"{'module':<40}{'type':>22}{'calls':>7}{'fwd ms':>10}{'bwd ms':>10}{'share':>8}"
+                 f"{'GFLOPs':>10}{'params':>11}{'act MB':>10}"]
+        for row in rows:
+            name = '  ' * row['depth'] + row['name'].split('.')[-1]
+            lines.append(f"{name:<40}{row['type']:>22}{row['calls']:>7}{row['forward_ms']:>10.2f}"
+                         f"{row['backward_ms']:>10.2f}{row['share']:>8.1%}{row['flops'] / 1e9:>10.3f}"
+                         f"{row['params']:>11}{row['activation_bytes'] / 2**20:>10.2f}")
+        return '\n'.join(lines)
+
+    def export_csv(self, path):
+        rows = self.rows()
+        with open(path, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def export_json(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.rows(), file, indent=2)
+
+
+def profile_models(option, batch_size, patch_size, out_dir=None, max_depth=2):
+    """
+    Profiles one forward and backward pass of the generator and of the discriminator.
+
+    Args:
+        option: Experiment options (see tutorials/04.py).
+        batch_size (int): Batch size of the synthetic batch.
+        patch_size (int or tuple): Patch size on the Landsat grid.
+        out_dir (Path): Where to write `profile_<model>.csv` and `.json` (default save_dir).
+        max_depth (int): Depth of the module tree shown in the logged tables.
+
+    Returns:
+        dict: Profiling rows of 'generator' and 'discriminator'.
+    """
+    logger = get_logger()
+    experiment = Experiment(option)
+    device = experiment.device
+    out_dir = out_dir or experiment.save_dir
+    inputs, target = synthetic_batch(batch_size, patch_size, device)
+
+    # Warm-up pass so that one-off allocations and kernel selection are not profiled
+    experiment.generator.train()
+    experiment.nlayerdiscriminator.train()
+    experiment.generator(inputs).mean().backward()
+
+    profilers = OrderedDict()
+    profilers['generator'] = LayerProfiler(experiment.generator, device)
+    with profilers['generator']:
+        prediction = experiment.generator(inputs)
+        profilers['generator'].backward(prediction.mean())
+
+    fake = torch.cat((target[0][:, :1], target[0][:, :1]), dim=1)
+    sum(o.mean() for o in experiment.nlayerdiscriminator(fake)).backward()
+    profilers['discriminator'] = LayerProfiler(experiment.nlayerdiscriminator, device)
+    with profilers['discriminator']:
+        outputs = experiment.nlayerdiscriminator(fake)
+        profilers['discriminator'].backward(sum(o.mean() for o in outputs))
+
+    results = {}
+    for name, profiler in profilers.items():
+        logger.info(f'Profile of the {name} (batch {batch_size}, patch {patch_size}):\n' + profiler.table(max_depth))
+        profiler.export_csv(out_dir / f'profile_{name}.csv')
+        profiler.export_json(out_dir / f'profile_{name}.json')
+        results[name] = profiler.rows()
+    return results
@@ -0,0 +1,248 @@
+import copy
+import json
+from pathlib import Path
+from timeit import default_timer as timer
+
+import torch
+import torch.nn as nn
+
+import sys
+import os
+sys.path.append(os.path.abspath('..'))  # go up to root directory
+
+from model.WGAST import *
+from runner.experiment import Experiment
+from runner.benchmark import synthetic_batch, synchronize
+from data_loader.utils import *
+
+ENCODERS = ('MODIS_SNet', 'Landsat_SNet', 'indices_SNet')
+
+
+def l1_importance(weight, dim=0):
+    """L1 norm of the filters of a convolution weight along `dim` (0 for Conv2d, 1 for ConvTranspose2d)."""
+    dims = [d for d in range(weight.dim()) if d != dim]
+    return weight.detach().abs().sum(dim=dims)
+
+
+def channel_importance(generator):
+    """
+    Ranks the channels of a CombinFeatureGenerator.
+
+    The width of each encoder level is shared by the three FeatureExtract streams, the
+    significance modules and the decoder skip connections, so a level is scored by the
+    summed L1 norms of every convolution writing to it (level convolutions and ResBlock
+    outputs of all encoders). Decoder levels are scored by their DeconvBlock and ResBlock
+    filters, and the middle width of the output block by its 1x1 convolution and ResBlock.
+
+    Returns:
+        tuple: (encoder scores, decoder scores, output block scores), one tensor per level.
+    """
+    sd = generator.state_dict()
+    n = generator.depth
+
+    encoder = []
+    for k in range(n):
+        score = 0
+        for net in ENCODERS:
+            score = score + l1_importance(sd[f'{net}.conv{k + 1}.0.weight'])
+            score = score + l1_importance(sd[f'{net}.conv{k + 1}.1.residual.5.weight'])
+        encoder.append(score)
+
+    # Decoder block j produces level n - 1 - j
+    decoder = [None] * (n - 1)
+    for j in range(1, n):
+        level = n - 1 - j
+        decoder[level] = (l1_importance(sd[f'conv{j}.0.deconv.weight'], dim=1) +
+                          l1_importance(sd[f'conv{j}.1.residual.5.weight']))
+
+    output = (l1_importance(sd[f'conv{n}.1.weight']) +
+              l1_importance(sd[f'conv{n}.2.residual.5.weight']))
+    return encoder, decoder, output
+
+
+def keep_indices(score, ratio):
+    """Indices (in their original order) of the highest scoring channels after pruning `ratio` of them."""
+    n_keep = max(1, int(round(len(score) * (1.0 - ratio))))
+    return torch.topk(score, n_keep).indices.sort().values
+
+
+def index_plan(generator, encoder, decoder, output):
+    """
+    Maps every parameter and buffer of the generator to the kept indices of each of its dimensions,
+    so that skip connections, torch.cat concatenations and SignificanceExtraction widths stay consistent.
+    """
+    n = generator.depth
+    old = generator.channels
+    plan = {}
+
+    def resblock(prefix, idx):
+        for conv in ('1', '5'):
+            plan[f'{prefix}.residual.{conv}.weight'] = (idx, idx)
+            plan[f'{prefix}.residual.{conv}.bias'] = (idx,)
+
+    def cat(first, second, offset):
+        return torch.cat((first, second + offset))
+
+    # Encoders
+    for net in ENCODERS:
+        for k in range(n):
+            prefix = f'{net}.conv{k + 1}'
+            plan[f'{prefix}.0.weight'] = (encoder[k], encoder[k - 1] if k > 0 else None)
+            plan[f'{prefix}.0.bias'] = (encoder[k],)
+            resblock(f'{prefix}.1', encoder[k])
+
+    # Significance extraction (only has parameters when attention is enabled)
+    for k in range(n):
+        prefix = f'SignE_List.{k}'
+        for conv in ('conv1', 'conv2'):
+            plan[f'{prefix}.{conv}.0.weight'] = (encoder[k], encoder[k])
+            plan[f'{prefix}.{conv}.0.bias'] = (encoder[k],)
+            for name in ('weight', 'bias', 'running_mean', 'running_var'):
+                plan[f'{prefix}.{conv}.1.{name}'] = (encoder[k],)
+        plan[f'{prefix}.conv.0.weight'] = (None, encoder[k])
+
+    # Decoder: block j takes cat(fusion features, previous decoder output) and produces level n - 1 - j
+    for j in range(1, n):
+        level = n - 1 - j
+        if j == 1:
+            in_idx = cat(encoder[n - 1], encoder[n - 1], old[n - 1])
+        else:
+            in_idx = cat(encoder[level + 1], decoder[level + 1], old[level + 1])
+        plan[f'conv{j}.0.deconv.weight'] = (in_idx, decoder[level])
+        plan[f'conv{j}.0.deconv.bias'] = (decoder[level],)
+        resblock(f'conv{j}.1', decoder[level])
+
+    # Output block
+    in_idx = cat(encoder[0], decoder[0], old[0])
+    resblock(f'conv{n}.0', in_idx)
+    plan[f'conv{n}.1.weight'] = (output, in_idx)
+    plan[f'conv{n}.1.bias'] = (output,)
+    resblock(f'conv{n}.2', output)
+    plan[f'conv{n}.3.weight'] = (None, output)
+    return plan
+
+
+def prune_generator(generator, ratio=0.5):
+    """
+    Physically removes the `ratio` least important channels of every level of a trained generator.
+
+    The decoder and output block keep the same number of channels per level as the encoder, so the
+    result is a regular, dense CombinFeatureGenerator(channels=new_channels).
+
+    Args:
+        generator (CombinFeatureGenerator): Trained generator (not modified).
+        ratio (float): Fraction of channels to remove at each level.
+
+    Returns:
+        tuple: (pruned generator, new channel widths)
+    """
+    if isinstance(generator, nn.DataParallel):
+        generator = generator.module
+
+    encoder, decoder, output = channel_importance(generator)
+    encoder = [keep_indices(score, ratio) for score in encoder]
+    # Decoder outputs and the output block are concatenated with the encoder features of the same level,
+    # keep as many channels as the encoder does so that the widths match `channels`
+    decoder = [torch.topk(score, len(encoder[k])).indices.sort().values for k, score in enumerate(decoder)]
+    output = torch.topk(output, len(encoder[0])).indices.sort().values
+    new_channels = tuple(len(idx) for idx in encoder)
+
+    plan = index_plan(generator, encoder, decoder, output)
+    state_dict = {}
+    for name, tensor in generator.state_dict().items():
+        for dim, idx in enumerate(plan.get(name, ())):
+            if idx is not None:
+                tensor = tensor.index_select(dim, idx.to(tensor.device))
+        state_dict[name] = tensor.clone()
+
+    pruned = CombinFeatureGenerator(ifAdaIN=generator.ifAdaIN, ifAttention=generator.ifAttention,
+                                    ifTwoInput=generator.ifTwoInput, outputM=generator.outputM,
+                                    channels=new_channels, ifFused=generator.ifFused)
+    pruned.load_state_dict(state_dict)
+    return pruned.to(next(generator.parameters()).device), new_channels
+
+
+@torch.no_grad()
+def forward_time(generator, batch_size, patch_size, device, steps=5):
+    inputs, _ = synthetic_batch(batch_size, patch_size, device)
+    generator.eval()
+    generator(inputs)
+    synchronize(device)
+    t_start = timer()
+    for _ in range(steps):
+        generator(inputs)
+    synchronize(device)
+    return (timer() - t_start) / steps
+
+
+def load_pruned_generator(checkpoint, option, map_location=None):
+    """
+    Builds a CombinFeatureGenerator with the channel widths of a pruned checkpoint and loads it.
+
+    The widths are read from the checkpoint, or for checkpoints written without them from the
+    pruning.json of the run directory (next to the checkpoint or one level up).
+    """
+    checkpoint = Path(checkpoint)
+    channels = torch.load(checkpoint, map_location='cpu').get('channels')
+    if channels is None:
+        summaries = [directory / 'pruning.json' for directory in (checkpoint.parent, checkpoint.parent.parent)]
+        summary = next((path for path in summaries if path.exists()), None)
+        if summary is None:
+            raise FileNotFoundError(f'No channel widths in {checkpoint} and no pruning.json next to it')
+        with open(summary) as file:
+            channels = json.load(file)['pruned_channels']
+
+    generator = CombinFeatureGenerator(ifAdaIN=option.ifAdaIN, ifAttention=option.ifAttention, ifTwoInput=option.ifTwoInput,
+                                       channels=tuple(channels), ifFused=getattr(option, 'ifFused', False))
+    load_checkpoint(checkpoint, generator, map_location=map_location)
+    return generator
+
+
+def prune_and_finetune(option, checkpoint, save_dir, ratio=0.5, epochs=5, patch_stride=None, batch_size=None):
+    """
+    Prunes a trained generator and fine-tunes the result for a few epochs.
+
+    Args:
+        option: Options of the trained run (see tutorials/04.py).
+        checkpoint (Path): Generator checkpoint to prune (e.g. best.pth).
+        save_dir (Path): Run directory of the pruned model.
+        ratio (float): Fraction of channels to remove at each level.
+        epochs (int): Number of fine-tuning epochs.
+
+    Returns:
+        Experiment: The fine-tuning experiment; its checkpoints store the pruned widths and load
+        through load_pruned_generator.
+    """
+    logger = get_logger()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    generator = CombinFeatureGenerator(ifAdaIN=option.ifAdaIN, ifAttention=option.ifAttention, ifTwoInput=option.ifTwoInput,
+                                       channels=tuple(getattr(option, 'channels', CHANNELS)),
+                                       ifFused=getattr(option, 'ifFused', False)).to(device)
+    load_checkpoint(checkpoint, generator, map_location=device)
+    pruned, new_channels = prune_generator(generator, ratio)
+
+    # Fine-tune the pruned generator (with a fresh discriminator) in its own run directory
+    opt = copy.copy(option)
+    opt.channels = new_channels
+    opt.save_dir = save_dir
+    experiment = Experiment(opt)
+    target = experiment.generator.module if isinstance(experiment.generator, nn.DataParallel) else experiment.generator
+    target.load_state_dict(pruned.state_dict())
+
+    summary = {'source': str(checkpoint), 'ratio': ratio,
+               'channels': list(generator.channels), 'pruned_channels': list(new_channels),
+               'parameters': sum(p.numel() for p in generator.parameters()),
+               'pruned_parameters': sum(p.numel() for p in pruned.parameters()),
+               'forward_time': forward_time(generator, 1, option.patch_size, device),
+               'pruned_forward_time': forward_time(pruned, 1, option.patch_size, device)}
+    logger.info(f"Pruned channels {summary['channels']} -> {summary['pruned_channels']}, "
+                f"parameters {summary['parameters']} -> {summary['pruned_parameters']}, "
+                f"forward {summary['forward_time']:.4f}s -> {summary['pruned_forward_time']:.4f}s")
+    with open(experiment.save_dir / 'pruning.json', 'w') as file:
+        json.dump(summary, file, indent=2)
+
+    if epochs > 0:
+        experiment.train(option.train_dir, option.patch_size, patch_stride or option.patch_stride,
+                         batch_size or option.batch_size, epochs=epochs, resume=False)
+    return experiment
@@ -0,0 +1,155 @@
+import copy
+import csv
+from collections import OrderedDict
+from timeit import default_timer as timer
+
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+import sys
+import os
+sys.path.append(os.path.abspath('..'))  # go up to root directory
+
+from runner.experiment import Experiment
+from data_loader.data import PatchSet, load_scenes
+from data_loader.utils import DeviceAverageMeter, StageTimer, get_logger, log_csv
+
+# Options of the shared loader, which a configuration cannot override
+DATA_OPTIONS = ('patch_size', 'patch_stride', 'batch_size', 'derived_inputs', 'tile_size', 'curriculum')
+
+
+def config_name(config):
+    """Run name of a configuration, e.g. {'a': 0.01, 'ifAdaIN': False} -> 'a=0.01_ifAdaIN=False'."""
+    return '_'.join(f'{key}={value}' for key, value in config.items()) or 'base'
+
+
+def run_sweep(option, configs, epochs, patch_size=None, patch_stride=None, batch_size=None, num_workers=1):
+    """
+    Trains several configurations side by side on the same batches.
+
+    The training pairs are decoded once and every batch is moved to the device once, then each model takes
+    its training step on it. Each configuration gets its own Experiment in save_dir/sweep/<name> (suffixed
+    with _2, _3... when names repeat), with its history.csv, checkpoints and learning rate schedule
+    (option.lr_schedule, warmup_epochs) as in Experiment.train. The results of all runs are written to
+    save_dir/sweep/sweep_summary.csv.
+
+    All runs share one PatchSet loader, so the data options (DATA_OPTIONS) cannot differ between runs,
+    and large-tile mode and the curriculum are not supported; plateau early stopping is not applied.
+
+    Args:
+        option: Base options (see tutorials/04.py).
+        configs (list of dict): Option overrides per run, e.g. [{'a': 1e-2}, {'a': 1e-3, 'ifAttention': False}].
+        epochs (int): Epochs per run.
+
+    Returns:
+        list of dict: One summary row per configuration.
+    """
+    logger = get_logger()
+    sweep_dir = option.save_dir / 'sweep'
+    patch_size = patch_size or option.patch_size
+    patch_stride = patch_stride or option.patch_stride
+    batch_size = batch_size or option.batch_size
+
+    overridden = sorted({key for config in configs for key in config if key in DATA_OPTIONS})
+    if overridden:
+        raise ValueError(f'Sweep runs share one data loader, {overridden} cannot differ between configurations')
+    if getattr(option, 'tile_size', None) or getattr(option, 'curriculum', None):
+        raise ValueError('Sweeps train on fixed PatchSet patches, large-tile mode and the curriculum are not supported')
+
+    experiments = OrderedDict()
+    for config in configs:
+        opt = copy.copy(option)
+        for key, value in config.items():
+            setattr(opt, key, value)
+        name, n = config_name(config), 2
+        while name in experiments:
+            name, n = f'{config_name(config)}_{n}', n + 1
+        opt.save_dir = sweep_dir / name
+        experiments[name] = Experiment(opt)
+        experiments[name].set_lr_schedule(experiments[name].schedule_epochs or epochs)
+    device = next(iter(experiments.values())).device
+
+    logger.info('Loading data...')
+    derived = getattr(option, 'derived_inputs', False)
+    train_set = PatchSet(option.train_dir, option.image_size, patch_size, patch_stride,
+                         scenes=load_scenes(option.train_dir, derived=derived), derived=derived)
+    train_loader = DataLoader(train_set, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                              drop_last=True, pin_memory=device.type == 'cuda')
+    logger.info(f'Sweeping {len(experiments)} configurations on {len(train_set)} samples.')
+
+    train_time = {name: 0.0 for name in experiments}  # Time spent in the training steps of each run
+    # The steps are timed with device events, resolved once per epoch instead of synchronizing every step
+    step_timers = {name: StageTimer(device, enabled=True) for name in experiments}
+    data_time = 0.0  # Time spent loading and moving the shared batches
+    best = {name: float('inf') for name in experiments}
+    history = {name: None for name in experiments}
+    t_sweep = timer()
+
+    for epoch in range(epochs):
+        meters = {}
+        for name, experiment in experiments.items():
+            experiment.g_scheduler.step()
+            experiment.pd_scheduler.step()
+            experiment.generator.train()
+            experiment.nlayerdiscriminator.train()
+            meters[name] = (DeviceAverageMeter(), DeviceAverageMeter(), DeviceAverageMeter())
+
+        t_fetch = timer()
+        for images, _ in tqdm(train_loader, desc=f'Sweep epoch {epoch}'):
+            images = [im.to(device, non_blocking=True) for im in images]
+            inputs, target = images[:-1], images[-1:]
+            data_time += timer() - t_fetch
+
+            # Every run steps on the same batch
+            for name, experiment in experiments.items():
+                step_timers[name].start_step()
+                with step_timers[name].stage('train'):
+                    g_loss, pd_loss, mse = experiment.train_step(inputs, target)
+                step_timers[name].end_step(len(target[0]))
+                for meter, value in zip(meters[name], (g_loss, pd_loss, mse)):
+                    meter.update(value)
+            t_fetch = timer()
+
+        for name, experiment in experiments.items():
+            stages = step_timers[name].summary()['stages']
+            train_time[name] += stages['train']['total'] if 'train' in stages else 0.0
+            step_timers[name].reset()
+            train_g_loss, train_pd_loss, train_g_error = (meter.avg for meter in meters[name])
+            history[name] = (train_g_loss, train_pd_loss, train_g_error)
+            log_csv(experiment.history, [epoch, train_g_loss, train_pd_loss, train_g_error],
+                    header=['epoch', 'train_g_loss', 'train_pd_loss', 'train_g_error'])
+            experiment.checkpoint_writer.save(experiment.generator, experiment.g_optimizer, experiment.last_g, epoch=epoch)
+            experiment.checkpoint_writer.save(experiment.nlayerdiscriminator, experiment.pd_optimizer, experiment.last_pd, epoch=epoch)
+            if train_g_loss < best[name]:
+                best[name] = train_g_loss
+                experiment.checkpoint_writer.link(experiment.last_g, experiment.best)
+            logger.info(f'Epoch[{epoch}] {name}: g_loss {train_g_loss:.4f}, pd_loss {train_pd_loss:.4f}, '
+                        f'error {train_g_error:.4f}')
+
+    for experiment in experiments.values():
+        experiment.checkpoint_writer.wait()
+    sweep_time = timer() - t_sweep
+
+    # Serial runs would each load and move the data themselves
+    serial_time = sum(train_time.values()) + data_time * len(experiments)
+    logger.info(f'Sweep took {sweep_time:.1f}s, an estimated {serial_time:.1f}s when run serially '
+                f'({serial_time / sweep_time:.2f}x).')
+
+    keys = sorted({key for config in configs for key in config})
+    csv_header = ['name'] + keys + ['best_g_loss', 'final_g_loss', 'final_pd_loss', 'final_g_error', 'train_time']
+    rows = []
+    for config, (name, experiment) in zip(configs, experiments.items()):
+        row = OrderedDict([('name', name)])
+        for key in keys:
+            row[key] = config.get(key, getattr(option, key, None))
+        row['best_g_loss'] = best[name]
+        row['final_g_loss'], row['final_pd_loss'], row['final_g_error'] = history[name]
+        row['train_time'] = train_time[name]
+        rows.append(row)
+
+    # Rewritten on every sweep, rows of a previous sweep in the same save_dir are not kept
+    with open(sweep_dir / 'sweep_summary.csv', 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=csv_header)
+        writer.writeheader()
+        writer.writerows(rows)
+    return rows
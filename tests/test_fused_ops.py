@@ -0,0 +1,70 @@
+import os
+import sys
+
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # repository root
+
+from model.WGAST import (adaptive_instance_normalization, fused_adaptive_instance_normalization,
+                         calc_mean_std, fused_calc_mean_std, SimilarityFeatureRefiner, FusedCosineRefine,
+                         fused_blend)
+
+SHAPE = (2, 4, 5, 5)
+
+
+def random_inputs(*shapes, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return [torch.randn(*shape, generator=generator, dtype=torch.float64, requires_grad=True) for shape in shapes]
+
+
+def assert_same_outputs_and_grads(reference, fused, tensors, atol=1e-10):
+    out_ref = reference(*tensors)
+    out_fused = fused(*tensors)
+    assert out_fused.dtype == out_ref.dtype == torch.float64
+    torch.testing.assert_close(out_fused, out_ref, rtol=0, atol=atol)
+    weights = torch.randn_like(out_ref)  # a non-uniform upstream gradient
+    grads_ref = torch.autograd.grad((out_ref * weights).sum(), tensors)
+    grads_fused = torch.autograd.grad((out_fused * weights).sum(), tensors)
+    for g_ref, g_fused in zip(grads_ref, grads_fused):
+        torch.testing.assert_close(g_fused, g_ref, rtol=0, atol=atol)
+
+
+def test_fused_cosine_refine_gradcheck():
+    assert torch.autograd.gradcheck(FusedCosineRefine.apply, random_inputs(SHAPE, SHAPE, SHAPE))
+
+
+def test_fused_cosine_refine_matches_reference():
+    assert_same_outputs_and_grads(SimilarityFeatureRefiner(method='cosine'), FusedCosineRefine.apply,
+                                  random_inputs(SHAPE, SHAPE, SHAPE))
+
+
+def test_fused_refiner_module_matches_reference():
+    assert_same_outputs_and_grads(SimilarityFeatureRefiner(method='cosine'),
+                                  SimilarityFeatureRefiner(method='cosine', ifFused=True),
+                                  random_inputs(SHAPE, SHAPE, SHAPE))
+
+
+def test_fused_adain_gradcheck():
+    assert torch.autograd.gradcheck(fused_adaptive_instance_normalization, random_inputs(SHAPE, SHAPE))
+
+
+def test_fused_adain_matches_reference():
+    assert_same_outputs_and_grads(adaptive_instance_normalization, fused_adaptive_instance_normalization,
+                                  random_inputs(SHAPE, SHAPE))
+
+
+def test_fused_mean_std_matches_reference():
+    feat, = random_inputs(SHAPE)
+    for out_ref, out_fused in zip(calc_mean_std(feat), fused_calc_mean_std(feat)):
+        torch.testing.assert_close(out_fused, out_ref, rtol=0, atol=1e-12)
+
+
+def test_fused_blend_matches_reference():
+    assert_same_outputs_and_grads(lambda a, b, m: a * m + b * (1 - m), fused_blend,
+                                  random_inputs(SHAPE, SHAPE, (2, 1, 5, 5)))
+
+
+def test_half_inputs_keep_their_dtype():
+    content, style = (torch.randn(*SHAPE).to(torch.bfloat16) for _ in range(2))
+    assert adaptive_instance_normalization(content, style).dtype == torch.bfloat16
+    assert fused_adaptive_instance_normalization(content, style).dtype == torch.bfloat16
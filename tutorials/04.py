@@ -46,12 +46,25 @@ class Options:
         # Training settings
         self.lr = 2e-4                  # Learning rate
         self.batch_size = 32           # Batch size
+        self.accumulation_steps = 1    # Micro-batches per update (gradient accumulation, see runner/autotune.py)
         self.epochs = 110              # Number of training epochs
+        self.lr_schedule = 'constant'  # Learning rate schedule: 'constant', 'cosine' or 'one_cycle'
+        self.warmup_epochs = 0         # Epochs of learning rate warmup (cosine, one_cycle)
+        self.plateau_patience = None   # Stop after this many epochs without train error improvement (None: never)
+        self.target_error = None       # Train error whose time-to-target is reported in train/convergence.json
 
         # Hardware settings
         self.cuda = True               # Enable CUDA if available
         self.ngpu = 1                  # Number of GPUs to use
         self.num_workers = 8           # Number of data loading workers
+        self.precision = 'fp32'        # 'fp32', or mixed precision with 'bf16' / 'fp16'
+        self.single_forward = False    # Run the generator forward once per step for both updates
+        self.log_interval = 50         # Steps between progress bar loss updates
+        self.timing = False            # Record per-stage timings to train/timing.jsonl
+        self.profile = None            # torch.profiler window (skip, warmup, active) steps, e.g. (20, 5, 10)
+        self.keep_checkpoints = 0      # Number of per-epoch checkpoints kept in train/ (0: only the latest)
+        self.snapshot_interval = 0     # Steps between step-level snapshots for mid-epoch resume (0: disabled)
+        self.snapshot_deadline = 30    # Seconds allowed to flush a snapshot after SIGTERM
 
         # Data paths
         self.save_dir = Path('./data/Tdivision')      # Where to save outputs
@@ -62,19 +75,29 @@ class Options:
         # Image and patch parameters
         self.image_size = [400, 400]   # Size of input images
         self.patch_size = [32, 32]     # Size of image patches
+        self.tile_size = None          # Train on random large tiles (e.g. [192, 192]) instead of patches
+        self.coverage = 1.0            # Times each training pixel is covered per epoch with tile_size
+        self.curriculum = None         # Patch-size stages, e.g. [{'patch_size': [16, 16], 'batch_size': 128, 'epochs': 10},
+                                       #                       {'patch_size': [32, 32], 'batch_size': 32}]
+        self.curriculum_patience = None  # Move to the next stage after this many epochs without improvement
         self.patch_stride = 8          # Stride for patch extraction
+        self.derived_inputs = False    # Use the layers precomputed by DerivedInputs().prepare(train_dir)
         self.test_patch = 32           # Patch size during testing
 
         # Model options
         self.ifAdaIN = True            # Use AdaIN for feature normalization
         self.ifAttention = True        # Use attention mechanism
         self.ifTwoInput = False        # Use two input streams (if applicable)
+        self.ifCheckpoint = False      # Recompute encoder/decoder activations in backward to save memory
+        self.channels = (16, 32, 64, 128, 256)  # Channel widths of the encoder levels (one entry per level)
+        self.ifFused = False           # Use the fused AdaIN, similarity refinement and attention blending
         
         # Loss weights (used in final objective function)
         self.a = 1e-2
         self.b = 1
         self.c = 1
         self.d = 1
+        self.ssim_val_range = None     # Fixed MS-SSIM dynamic range (None: inferred from the prediction)
 
 # === Set Options ===
 opt = Options()
@@ -108,12 +131,14 @@ if opt.epochs > 0:
     # - batch_size: Number of samples per training batch
     # - num_workers: Number of subprocesses used for data loading
     # - epochs: Number of full passes over the dataset
+    # - profile: Optional window of steps traced with torch.profiler (traces written to save_dir)
     predictions = experiment.train(opt.train_dir,
                                    opt.patch_size, 
                                    opt.patch_stride, 
                                    opt.batch_size,
                                    num_workers=1, 
-                                   epochs=opt.epochs)
+                                   epochs=opt.epochs,
+                                   profile=opt.profile)
 
     end_time = time.time()  # Stop measuring training time
     
@@ -129,10 +154,12 @@ if opt.epochs > 0:
 # - opt.test_dir: Path to the test dataset (should be pre-generated in earlier steps)
 # - patch_size: Size of the patches used for testing
 # - num_workers: Number of parallel data loading workers
+# - profile: Optional window of patches traced with torch.profiler
 
 results = experiment.test(opt.test_dir,
                           opt.patch_size,
-                          num_workers=1)
+                          num_workers=1,
+                          profile=opt.profile)
 
 # Print or log the results as needed
 print("Testing completed.")
@@ -9,51 +9,13 @@ import os
 # Add the project root to sys.path to allow imports from other folders
 sys.path.append(os.path.abspath('..'))
 
-from runner.experiment import Experiment as OriginalExperiment # Rename to avoid conflict
+from runner.experiment import Experiment
 
-# === Modified Experiment Class ===
-class ResumableExperiment(OriginalExperiment):
-    
-    def train(self, train_dir, patch_size, patch_stride, batch_size, num_workers, epochs):
-        """
-        Trains the WGAST model with checkpointing for resumable training.
-        """
-        start_epoch = 0
-        checkpoint_path = Path(self.opt.save_dir) / 'checkpoint.pth'
-
-        # Check for and load a previous checkpoint
-        if checkpoint_path.exists():
-            print("Checkpoint found. Resuming training...")
-            checkpoint = torch.load(checkpoint_path, map_location=self.device)
-            self.model.load_state_dict(checkpoint['model_state_dict'])
-            self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
-            start_epoch = checkpoint['epoch']
-            print(f"Resuming from epoch {start_epoch}.")
-        else:
-            print("No checkpoint found. Starting training from scratch.")
-
-        # Your original training code goes here, but the loop needs to be adjusted
-        for epoch in range(start_epoch, epochs):
-            # ... The rest of your training loop for a single epoch goes here ...
-            
-            # Placeholder for the actual training logic
-            # For demonstration, let's assume a simple loop
-            print(f"Training epoch {epoch+1}/{epochs}")
-            
-            # --- The actual training step for a single epoch ---
-            # self.model.train()
-            # ...
-            
-            # Save a checkpoint at the end of each epoch
-            torch.save({
-                'epoch': epoch + 1,
-                'model_state_dict': self.model.state_dict(),
-                'optimizer_state_dict': self.optimizer.state_dict(),
-            }, checkpoint_path)
-            print(f"Checkpoint saved for epoch {epoch + 1}.")
-
-        print("Training completed.")
-        return self.model # Or whatever your original method returned
+# === Resumable training ===
+# Experiment.train resumes at epoch granularity from history.csv and the last checkpoints, and
+# mid-epoch at the exact next batch from train/snapshot.pth. The snapshot (models, optimizers,
+# schedulers, RNG states and sampler position) is written every `snapshot_interval` steps and
+# when the job receives SIGTERM (e.g. on preemption), within `snapshot_deadline` seconds.
 
 # === Configuration Class ===
 class Options:
@@ -80,6 +42,9 @@ class Options:
         self.b = 1
         self.c = 1
         self.d = 1
+        self.snapshot_interval = 200   # Steps between snapshots
+        self.snapshot_deadline = 30    # Seconds allowed to flush the snapshot after SIGTERM
+        self.seed = 2024               # Seed of the shuffling order, needed to continue an epoch
 
 # === Main execution block ===
 opt = Options()
@@ -92,8 +57,7 @@ if opt.cuda:
     cudnn.benchmark = True
     cudnn.deterministic = True
 
-# Use the modified ResumableExperiment class
-experiment = ResumableExperiment(opt)
+experiment = Experiment(opt)
 
 # --- Training and Testing ---
 if opt.epochs > 0:
@@ -105,7 +69,8 @@ if opt.epochs > 0:
                                    opt.patch_stride, 
                                    opt.batch_size,
                                    num_workers=1, 
-                                   epochs=opt.epochs)
+                                   epochs=opt.epochs,
+                                   resume=True)
     
     end_time = time.time()
     elapsed_time = end_time - start_time